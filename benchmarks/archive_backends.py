@@ -0,0 +1,170 @@
+# coding: utf-8
+
+''' 解压后端性能对比
+    在临时目录中生成不同大小、不同固实方式的字幕包，
+    分别用各个可用的后端打开、列出文件、读取单个字幕与全部字幕并计时。
+
+    用法: python -m benchmarks.archive_backends [--repeat N]
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import zipfile
+import argparse
+import tempfile
+import subprocess
+from io import BytesIO
+
+from getsub.archive_backends import BACKENDS
+
+
+# (名称, 字幕数, 每个字幕的行数)
+SIZES = (
+    ('small', 5, 400),
+    ('medium', 40, 800),
+    ('large', 150, 1200)
+)
+
+WORDS = ('the', 'you', 'what', 'we', 'know', 'going', 'here', 'right',
+         '我们', '什么', '知道', '这里', '没有', '现在', '一个', '不是')
+
+
+def make_subtitle(seed, lines):
+    rnd = random.Random(seed)
+    parts = []
+    for i in range(lines):
+        start = i * 3
+        parts.append('%d\n00:%02d:%02d,000 --> 00:%02d:%02d,500\n%s\n\n' % (
+            i + 1, start // 60 % 60, start % 60,
+            (start + 2) // 60 % 60, (start + 2) % 60,
+            ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 9)))))
+    return ''.join(parts).encode('utf-8')
+
+
+def make_files(directory, count, lines):
+    names = []
+    for i in range(count):
+        name = 'Show.S01E%02d.chs.srt' % (i + 1)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(make_subtitle(i, lines))
+        names.append(name)
+    return names
+
+
+def build_archives(directory, count, lines):
+
+    """ 生成字幕包，返回 [(描述, 格式, 数据)]，无法生成的格式被跳过 """
+
+    source = os.path.join(directory, 'files')
+    os.makedirs(source)
+    names = make_files(source, count, lines)
+    archives = []
+
+    buff = BytesIO()
+    with zipfile.ZipFile(buff, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name in names:
+            z.write(os.path.join(source, name), name)
+    archives.append(('zip', '.zip', buff.getvalue()))
+
+    seven_zip = shutil.which('7z') or shutil.which('7zz') \
+        or shutil.which('7za')
+    for solid in ('on', 'off'):
+        if not seven_zip:
+            break
+        path = os.path.join(directory, 'solid-%s.7z' % solid)
+        subprocess.run([seven_zip, 'a', '-ms=' + solid, path] + names,
+                       cwd=source, stdout=subprocess.DEVNULL, check=True)
+        with open(path, 'rb') as f:
+            archives.append(('7z solid=%s' % solid, '.7z', f.read()))
+    if not seven_zip:
+        # libarchive 写出的 7z 为固实压缩
+        path = os.path.join(directory, 'solid.7z')
+        bsdtar = shutil.which('bsdtar')
+        if bsdtar:
+            subprocess.run([bsdtar, '--format', '7zip', '-cf', path] + names,
+                           cwd=source, check=True)
+            with open(path, 'rb') as f:
+                archives.append(('7z solid', '.7z', f.read()))
+
+    rar = shutil.which('rar')
+    if rar:
+        path = os.path.join(directory, 'solid.rar')
+        subprocess.run([rar, 'a', '-s', '-idq', path] + names,
+                       cwd=source, check=True)
+        with open(path, 'rb') as f:
+            archives.append(('rar solid', '.rar', f.read()))
+    return archives
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func()
+        cost = time.perf_counter() - begin
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def bench(backend, datatype, data, repeat):
+
+    """ 返回 (打开并列出文件, 读取最后一个字幕, 读取全部字幕) 的最短用时 """
+
+    def open_archive():
+        handler = backend.open(BytesIO(data))
+        handler.namelist()
+        return handler
+
+    handler = open_archive()
+    names = [name for name in handler.namelist() if not name.endswith('/')]
+
+    def read_last():
+        handler.read(names[-1])
+
+    def read_all():
+        h = open_archive()
+        for name in names:
+            h.read(name)
+
+    return (measure(open_archive, repeat), measure(read_last, repeat),
+            measure(read_all, repeat))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='archive backend benchmark')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    backends = [b for b in BACKENDS if b.available()]
+    print('available backends: ' + ', '.join(b.name for b in backends))
+    print('%-8s %-14s %9s  %-10s %10s %10s %10s' % (
+        'size', 'archive', 'bytes', 'backend', 'open(ms)', 'read1(ms)',
+        'all(ms)'))
+    for size, count, lines in SIZES:
+        directory = tempfile.mkdtemp(prefix='getsub-bench-')
+        try:
+            archives = build_archives(directory, count, lines)
+        finally:
+            shutil.rmtree(directory, True)
+        for title, datatype, data in archives:
+            for backend in backends:
+                if datatype not in backend.formats:
+                    continue
+                try:
+                    costs = bench(backend, datatype, data, args.repeat)
+                except Exception as e:
+                    print('%-8s %-14s %9d  %-10s failed: %s' % (
+                        size, title, len(data), backend.name, e))
+                    continue
+                print('%-8s %-14s %9d  %-10s %10.1f %10.1f %10.1f' % (
+                    (size, title, len(data), backend.name)
+                    + tuple(cost * 1000 for cost in costs)))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
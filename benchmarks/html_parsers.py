@@ -0,0 +1,207 @@
+# coding: utf-8
+
+''' HTML 解析性能对比
+    对各网站的搜索页、详情页分别用各个可用的解析器完整解析、
+    按下载器的 strainer 只解析需要的节点，并计算吞吐量。
+
+    页面默认按各网站的页面结构生成；
+    可用 --fixtures 指定保存网页的目录，文件名为 <网站>-<页面>.html，
+    如 zimuku-search.html，存在的文件代替生成的页面。
+
+    用法: python -m benchmarks.html_parsers [--repeat N] [--fixtures DIR]
+'''
+
+import os
+import sys
+import time
+import random
+import argparse
+
+from getsub.downloader.html_parser import PARSERS, available
+from getsub.downloader.html_parser import set_parser, parse_html
+from getsub.downloader.subhd import SubHDDownloader
+from getsub.downloader.zimuzu import ZimuzuDownloader
+from getsub.downloader.zimuku import ZimukuDownloader
+
+
+WORDS = ('Show', 'Season', 'WEB', 'HDTV', '1080p', '720p', 'x264', 'GRP',
+         '简体', '繁体', '双语', '字幕', '翻译', '校对', '时间轴', '压制')
+
+
+def words(rnd, count):
+    return ' '.join(rnd.choice(WORDS) for _ in range(count))
+
+
+def page(rnd, body):
+
+    """ 加上网站共有的头部、导航、侧栏与脚本 """
+
+    head = ''.join(
+        '<link rel="stylesheet" href="/static/css/%d.css">'
+        '<script src="/static/js/%d.js"></script>' % (i, i)
+        for i in range(12))
+    script = '<script>var data = %s;</script>' % repr(
+        [words(rnd, 8) for _ in range(60)])
+    nav = '<ul class="nav">%s</ul>' % ''.join(
+        '<li class="nav-item"><a href="/c/%d">%s</a></li>'
+        % (i, words(rnd, 2)) for i in range(40))
+    side = '<div class="sidebar">%s</div>' % ''.join(
+        '<div class="hot"><a href="/d/%d.html">%s</a><span>%d</span></div>'
+        % (i, words(rnd, 6), i) for i in range(50))
+    footer = '<div class="footer">%s</div>' % ''.join(
+        '<p><a href="/about/%d">%s</a></p>' % (i, words(rnd, 3))
+        for i in range(20))
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8">'
+            '<title>%s</title>%s</head><body>%s<div class="container">'
+            '%s%s</div>%s%s</body></html>'
+            % (words(rnd, 4), head, nav, body, side, footer, script))
+
+
+def zimuku_search(rnd):
+    items = []
+    for i in range(10):
+        rows = ''.join(
+            '<tr class="odd"><td class="first"><a href="/detail/%d.html" '
+            'target="_blank">%s</a></td><td class="tac lang">'
+            '<img src="/static/img/lang/china.gif"/>'
+            '<img src="/static/img/lang/uk.gif"/></td>'
+            '<td class="tac hidden-xs">%d</td></tr>'
+            % (i * 100 + j, words(rnd, 8), j) for j in range(8))
+        items.append(
+            '<div class="item prel clearfix"><div class="litpic hidden-xs">'
+            '<img src="/static/img/%d.jpg"/></div><div class="title">'
+            '<p class="tt clearfix"><a href="/subs/%d.html"><b>Show</b></a>'
+            '</p><p>Show</p></div><table class="table">%s</table></div>'
+            % (i, i, rows))
+    return page(rnd, ''.join(items))
+
+
+def zimuku_detail(rnd):
+    info = ('<ul class="subinfo clearfix"><li>语言：'
+            '<img src="/static/img/lang/china.gif"/>'
+            '<img src="/static/img/lang/jollyroger.gif"/></li>%s</ul>'
+            % ''.join('<li>%s</li>' % words(rnd, 4) for _ in range(8)))
+    links = ('<div class="dl"><a id="down1" class="btn btn-danger" '
+             'href="/dld/123.html">下载字幕</a></div>')
+    content = '<div class="content">%s</div>' % ''.join(
+        '<p>%s</p>' % words(rnd, 12) for _ in range(40))
+    return page(rnd, '<div class="md">' + info + links + content + '</div>')
+
+
+def zimuku_down(rnd):
+    links = ''.join(
+        '<li><a rel="nofollow" href="/download/%d">线路%d</a></li>'
+        % (i, i) for i in range(4))
+    return page(rnd, '<div class="down clearfix"><ul>%s</ul></div>' % links)
+
+
+def subhd_search(rnd):
+    boxes = ''.join(
+        '<div class="mb-4 bg-white rounded shadow-sm"><div class="row">'
+        '<div class="col-2"><img src="/p/%d.jpg"/></div><div class="col">'
+        '<div class="f12 pt-1"><a href="/a/%d">%s</a></div>'
+        '<div class="f12 text-secondary">%s</div>'
+        '<span class="p-1 mr-1">简体</span><span class="p-1">英文</span>'
+        '</div></div></div>' % (i, i, words(rnd, 8), words(rnd, 10))
+        for i in range(20))
+    return page(rnd, '<small>总共 20 条</small>' + boxes)
+
+
+def subhd_detail(rnd):
+    content = ''.join('<p>%s</p>' % words(rnd, 12) for _ in range(40))
+    return page(rnd, '<div class="pt-2">%s<button id="down" class="btn" '
+                     'sid="1" dtoken="abc">下载</button></div>' % content)
+
+
+def zimuzu_search(rnd):
+    items = ''.join(
+        '<div class="search-item"><div class="fl-img"><img src="/%d.jpg"/>'
+        '</div><div class="fl-info"><a href="/subtitle/%d">'
+        '<strong class="list_title">%s</strong>简体 英文</a>'
+        '<p>%s</p></div></div>' % (i, i, words(rnd, 6), words(rnd, 10))
+        for i in range(20))
+    return page(rnd, '<div class="article-tab">字幕(20)</div>' + items)
+
+
+def zimuzu_detail(rnd):
+    content = ''.join('<p>%s</p>' % words(rnd, 12) for _ in range(40))
+    return page(rnd, '<div class="subtitle-info">%s</div>'
+                     '<div class="subtitle-links"><a href="http://got001.com/'
+                     'subtitle?code=1">下载</a></div>' % content)
+
+
+# (网站, 页面, 生成函数, strainer)
+PAGES = (
+    ('zimuku', 'search', zimuku_search, ZimukuDownloader.search_only),
+    ('zimuku', 'detail', zimuku_detail, ZimukuDownloader.detail_only),
+    ('zimuku', 'down', zimuku_down, ZimukuDownloader.down_only),
+    ('subhd', 'search', subhd_search, SubHDDownloader.search_only),
+    ('subhd', 'detail', subhd_detail, SubHDDownloader.detail_only),
+    ('zimuzu', 'search', zimuzu_search, ZimuzuDownloader.search_only),
+    ('zimuzu', 'detail', zimuzu_detail, ZimuzuDownloader.detail_only)
+)
+
+
+def load_pages(fixtures):
+
+    """ 返回 [(网站, 页面, HTML, strainer, 是否为保存的网页)] """
+
+    rnd = random.Random(0)
+    pages = []
+    for site, name, make_page, only in PAGES:
+        path = fixtures and os.path.join(fixtures, '%s-%s.html' % (site, name))
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                html = f.read().decode('utf-8', 'ignore')
+            pages.append((site, name, html, only, True))
+        else:
+            pages.append((site, name, make_page(rnd), only, False))
+    return pages
+
+
+def measure(func, repeat, number):
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        for _ in range(number):
+            func()
+        cost = (time.perf_counter() - begin) / number
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='html parser benchmark')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--number', type=int, default=20,
+                        help='parses per measurement')
+    parser.add_argument('--fixtures', help='directory of saved pages')
+    args = parser.parse_args()
+
+    parsers = [name for name in PARSERS if available(name)]
+    print('available parsers: ' + ', '.join(parsers))
+    print('%-7s %-7s %8s  %-12s %10s %10s %8s %9s' % (
+        'site', 'page', 'bytes', 'parser', 'full(ms)', 'only(ms)',
+        'pages/s', 'MB/s'))
+    try:
+        for site, name, html, only, saved in load_pages(args.fixtures):
+            size = len(html.encode('utf-8'))
+            title = name + ('*' if saved else '')
+            for parser_name in parsers:
+                set_parser(parser_name)
+                full = measure(lambda: parse_html(html), args.repeat,
+                               args.number)
+                part = measure(lambda: parse_html(html, only), args.repeat,
+                               args.number)
+                print('%-7s %-7s %8d  %-12s %10.2f %10.2f %8.0f %9.2f' % (
+                    site, title, size, parser_name, full * 1000,
+                    part * 1000, 1 / part, size / part / 1024 / 1024))
+    finally:
+        set_parser(None)
+    print('* saved page')
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
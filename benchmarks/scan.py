@@ -0,0 +1,114 @@
+# coding: utf-8
+
+''' 视频目录扫描性能对比
+    在临时目录（或 --dir 指定的目录，如网络文件系统上的目录）中生成视频与字幕文件，
+    分别用原来的 os.walk + 列表查找与 DirectoryScanner 扫描并计时。
+
+    用法: python -m benchmarks.scan [--files N] [--store-files N]
+                                    [--jobs N] [--legacy] [--dir DIR]
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from io import StringIO
+from contextlib import redirect_stdout
+
+from getsub.main import GetSubtitles
+
+
+def make_tree(directory, files, per_dir=100):
+
+    """ 生成 files 个文件，每个目录 per_dir 个，约一半为视频 """
+
+    count = 0
+    season = 0
+    while count < files:
+        path = os.path.join(directory, 'Show%03d' % (season // 10),
+                            'Season%02d' % (season % 10))
+        os.makedirs(path)
+        for i in range(min(per_dir, files - count)):
+            episode = i // 2 + 1
+            if i % 2 == 0:
+                name = 'Show.S%02dE%02d.1080p.WEB-GRP.mkv' % (season, episode)
+            elif episode % 3:
+                name = 'Show.S%02dE%02d.1080p.WEB-GRP.zh.srt' % (
+                    season, episode)
+            else:
+                name = 'Show.S%02dE%02d.nfo' % (season, episode)
+            open(os.path.join(path, name), 'w').close()
+        count += per_dir
+        season += 1
+
+
+def legacy_scan(getsub, videos, store):
+
+    """ 改动前的扫描方式 """
+
+    store_path_files = []
+    for root, dirs, files in os.walk(store):
+        store_path_files.extend(files)
+    video_dict = {}
+    for root, dirs, files in os.walk(videos):
+        for one_name in files:
+            suffix = os.path.splitext(one_name)[1]
+            if suffix not in getsub.video_format_list:
+                continue
+            v_name_no_format = os.path.splitext(one_name)[0]
+            sub_exists = max(
+                int(v_name_no_format + sub_type in files + store_path_files
+                    or v_name_no_format + '.zh' + sub_type
+                    in files + store_path_files)
+                for sub_type in getsub.sub_format_list)
+            video_dict[one_name] = {'path': store,
+                                    'have_subtitle': sub_exists}
+    return video_dict
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='directory scan benchmark')
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--store-files', type=int, default=5000)
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--legacy', action='store_true',
+                        help='also time the os.walk scan (slow)')
+    parser.add_argument('--dir', help='create files in this directory')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='getsub-bench-', dir=args.dir)
+    try:
+        videos = os.path.join(directory, 'videos')
+        store = os.path.join(directory, 'store')
+        make_tree(videos, args.files)
+        make_tree(store, args.store_files)
+        print('%d files, %d files in subtitle directory'
+              % (args.files, args.store_files))
+
+        getsub = GetSubtitles('', False, False, False, False, False,
+                              False, False, 5, None, None)
+        runs = [('scandir', None), ('scandir x%d' % args.jobs, args.jobs)]
+        results = {}
+        for title, jobs in runs:
+            getsub.scan_jobs = jobs
+            begin = time.perf_counter()
+            with redirect_stdout(StringIO()):
+                results[title] = getsub.get_path_name(videos, store)
+            print('%-14s %8.2f s  %d videos' % (
+                title, time.perf_counter() - begin, len(results[title])))
+        if args.legacy:
+            begin = time.perf_counter()
+            video_dict = legacy_scan(getsub, videos, store)
+            print('%-14s %8.2f s  %d videos' % (
+                'os.walk', time.perf_counter() - begin, len(video_dict)))
+            assert video_dict == dict(results['scandir'])
+    finally:
+        shutil.rmtree(directory, True)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+# coding: utf-8
+
+import os
+import re
+import gzip
+from io import BytesIO
+
+from getsub.archive_backends import get_backend, read_members
+
+
+''' 字幕包索引
+    记录字幕包内的文件名、大小与嵌套路径，文件名只解码一次。
+    嵌套的压缩包在其中的文件被选中时才打开并解压。
+    字幕包格式由文件头判断，不依赖下载链接或文件名。
+'''
+
+
+# (文件头, 格式)
+SIGNATURES = (
+    (b'PK\x03\x04', '.zip'),
+    (b'PK\x05\x06', '.zip'),  # 空 zip
+    (b'PK\x07\x08', '.zip'),  # 分卷 zip
+    (b'Rar!\x1a\x07\x01\x00', '.rar'),  # rar5
+    (b'Rar!\x1a\x07\x00', '.rar'),  # rar4
+    (b'7z\xbc\xaf\x27\x1c', '.7z'),
+    (b'\x1f\x8b', '.gz')
+)
+HEADER_SIZE = 4096
+_srt_re = re.compile(r'\d+\s*\n\s*\d+:\d+:\d+[,.]\d+\s*-->')
+
+
+def _header_text(header):
+    for bom, encoding in ((b'\xef\xbb\xbf', 'utf-8'),
+                          (b'\xff\xfe', 'utf-16-le'),
+                          (b'\xfe\xff', 'utf-16-be')):
+        if header.startswith(bom):
+            return header[len(bom):].decode(encoding, 'ignore')
+    return header.decode('gbk', 'ignore')
+
+
+def sniff_format(data):
+
+    """ 根据文件头判断字幕包格式
+    Args:
+        data: bytes 或可 seek 的文件对象，只读取文件头，读取后恢复位置
+    Return:
+        '.zip', '.rar', '.7z', '.gz', 纯文本字幕 '.srt', '.ass'，
+        无法识别返回 None
+    """
+
+    if hasattr(data, 'read'):
+        position = data.tell()
+        data.seek(0)
+        header = data.read(HEADER_SIZE)
+        data.seek(position)
+    else:
+        header = data[:HEADER_SIZE]
+
+    for signature, datatype in SIGNATURES:
+        if header.startswith(signature):
+            return datatype
+    text = _header_text(header).replace('\r\n', '\n').lstrip()
+    if text.startswith('[Script Info]'):
+        return '.ass'
+    if _srt_re.match(text):
+        return '.srt'
+    return None
+
+
+def decode_name(name):
+
+    """ zipfile 对未标记 UTF-8 的文件名按 cp437 解码，
+        国内字幕包多为 gbk 编码，尝试还原 """
+
+    try:
+        return name.encode('cp437').decode('gbk')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return name
+
+
+class SingleFile(object):
+
+    """ 将单个字幕文件作为只含一个文件的压缩包处理 """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def namelist(self):
+        return [self.name]
+
+    def read(self, name):
+        return self.data
+
+
+def open_archive(file, datatype, name='subtitle'):
+
+    """ 按字幕包格式打开文件对象，返回压缩文件控制对象，
+        zip / rar / 7z 由 archive_backends 中选定的后端打开
+    Args:
+        file: 可 seek 的文件对象
+        datatype: sniff_format 得到的格式
+        name: 纯文本字幕或 gzip 内文件使用的文件名（不含后缀）
+    """
+
+    file.seek(0)
+    if datatype in ('.zip', '.rar', '.7z'):
+        return get_backend(datatype).open(file)
+    elif datatype == '.gz':
+        with gzip.GzipFile(fileobj=file, mode='rb') as f:
+            inner = BytesIO(f.read())
+        inner_type = sniff_format(inner)
+        if inner_type is None or inner_type == '.gz':
+            raise ValueError('unsupported file type in gzip')
+        return open_archive(inner, inner_type, name)
+    elif datatype in ('.srt', '.ass', '.ssa', '.sub'):
+        return SingleFile(name + datatype, file.read())
+    raise ValueError('unsupported file type %s' % datatype)
+
+
+def _member_sizes(handler):
+    sizes = {}
+    if hasattr(handler, 'infolist'):
+        for info in handler.infolist():
+            sizes[info.filename] = info.file_size
+    return sizes
+
+
+class ArchiveEntry(object):
+
+    """ 字幕包中的一个文件 """
+
+    def __init__(self, index, name, size):
+        self.index = index  # 所在的 ArchiveIndex
+        self.name = name  # 压缩包内原始文件名
+        self.size = size
+        self.display_name = decode_name(name)
+        self.ext = os.path.splitext(name)[-1]
+
+    @property
+    def path(self):
+        """ 嵌套路径，如 ('pack.zip', 'S01E01.srt') """
+        return self.index.path + (self.name,)
+
+    @property
+    def display_path(self):
+        return '/'.join(decode_name(name) for name in self.path)
+
+    def read(self):
+        return self.index.handler.read(self.name)
+
+
+class ArchiveIndex(object):
+
+    def __init__(self, handler, sub_formats, archive_formats, path=()):
+        """
+        Args:
+            handler: 压缩文件控制对象
+            sub_formats: 字幕后缀列表
+            archive_formats: 可嵌套解压的压缩包后缀列表
+            path: 该压缩包在外层字幕包中的嵌套路径
+        """
+        self.handler = handler
+        self.sub_formats = sub_formats
+        self.archive_formats = archive_formats
+        self.path = path
+        self.subtitles = []  # 字幕文件
+        self.archives = []  # 嵌套的压缩包
+        self.children = {}  # 已打开的嵌套压缩包 {文件名: ArchiveIndex}
+
+        sizes = _member_sizes(handler)
+        for name in handler.namelist():
+            if name[-1] == '/':
+                continue
+            entry = ArchiveEntry(self, name, sizes.get(name))
+            if entry.ext in sub_formats:
+                self.subtitles.append(entry)
+            elif entry.ext in archive_formats:
+                self.archives.append(entry)
+
+    def read(self, entries):
+
+        """ 一次读取本压缩包中的多个文件，返回 {文件名: 数据} """
+
+        return read_members(self.handler, [entry.name for entry in entries])
+
+    def expand(self, entry, data=None):
+
+        """ 打开嵌套的压缩包，返回其索引
+        Args:
+            data: 已读取的压缩包数据，为 None 时读取
+        """
+
+        child = self.children.get(entry.name)
+        if child is None:
+            if data is None:
+                data = entry.read()
+            handler = open_archive(BytesIO(data),
+                                   sniff_format(data) or entry.ext,
+                                   os.path.splitext(entry.display_name)[0])
+            child = ArchiveIndex(handler, self.sub_formats,
+                                 self.archive_formats, path=entry.path)
+            self.children[entry.name] = child
+        return child
+
+    def all_subtitles(self):
+
+        """ 包括所有嵌套压缩包在内的字幕文件 """
+
+        pending = [entry for entry in self.archives
+                   if entry.name not in self.children]
+        if len(pending) > 1:
+            data = self.read(pending)
+            for entry in pending:
+                self.expand(entry, data[entry.name])
+
+        subtitles = list(self.subtitles)
+        for entry in self.archives:
+            subtitles += self.expand(entry).all_subtitles()
+        return subtitles
+
+    def get(self, name):
+
+        """ 按原始文件名查找本压缩包中的字幕文件 """
+
+        for entry in self.subtitles:
+            if entry.name == name:
+                return entry
+        return None
@@ -0,0 +1,481 @@
+# coding: utf-8
+
+import os
+import re
+import shutil
+import weakref
+import zipfile
+import tempfile
+import subprocess
+from io import BytesIO
+from collections import namedtuple
+
+import rarfile
+
+
+''' 压缩包解压后端
+    各后端打开字幕包后提供相同的接口：namelist() / infolist() / read(name) / open(name)。
+    按格式选择第一个可用的后端，顺序可通过 set_preference 配置。
+'''
+
+
+ArchiveInfo = namedtuple('ArchiveInfo', ['filename', 'file_size'])
+
+
+class ArchiveError(Exception):
+    """ 外部解压程序执行失败 """
+
+
+class Backend(object):
+
+    name = ''
+    formats = ()  # 支持的字幕包格式
+
+    @classmethod
+    def available(cls):
+        """ 依赖的模块或程序是否存在 """
+        return True
+
+    @classmethod
+    def open(cls, file):
+        """ 打开可 seek 的文件对象，返回压缩文件控制对象 """
+        raise NotImplementedError
+
+
+class ZipfileBackend(Backend):
+
+    name = 'zipfile'
+    formats = ('.zip',)
+
+    @classmethod
+    def open(cls, file):
+        file.seek(0)
+        return zipfile.ZipFile(file, mode='r')
+
+
+def _escape_pattern(name):
+    # bsdtar 将成员名作为通配符处理
+    return re.sub(r'([\[\]*?\\])', r'\\\1', name)
+
+
+def _write_names(path, names):
+    # 成员名较多时不放在命令行中，写入列表文件交给外部程序
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(names) + '\n')
+
+
+def _read_extracted(directory, names):
+    result = {}
+    for name in names:
+        with open(os.path.join(directory, *name.split('/')), 'rb') as f:
+            result[name] = f.read()
+    return result
+
+
+class RarArchive(rarfile.RarFile):
+
+    """ 可一次解压多个文件的 RarFile，
+        rarfile 读取每个压缩文件都会启动一次 unrar，字幕包内文件较多时开销明显 """
+
+    batch_tools = ('unrar', 'bsdtar')
+
+    def __init__(self, file):
+        super(RarArchive, self).__init__(file, mode='r')
+        self.file = file
+
+    def read_many(self, names):
+
+        """ 读取多个文件，返回 {文件名: 数据}；
+            需要解压的文件通过一次外部程序调用全部解压 """
+
+        result = {}
+        packed = []
+        for name in names:
+            info = self.getinfo(name)
+            if info.compress_type == rarfile.RAR_M0 \
+                    and not info.needs_password():
+                result[name] = self.read(name)  # 未压缩，直接读取
+            else:
+                packed.append(name)
+        if len(packed) == 1:
+            result[packed[0]] = self.read(packed[0])
+        elif packed:
+            result.update(self._extract_batch(packed))
+        return result
+
+    def _batch_command(self, path, names, directory):
+        for tool in self.batch_tools:
+            executable = shutil.which(tool)
+            if not executable:
+                continue
+            if tool == 'unrar':
+                # unrar 无法转义通配符，成员名由 -n@ 列表文件给出，
+                # 含 * ? 的成员名至多多解压几个文件
+                listfile = directory + '.list'
+                _write_names(listfile, names)
+                return [executable, 'x', '-o+', '-p-', '-idq', '-scfl',
+                        '-n@' + listfile, path, directory + os.sep]
+            return [executable, '-xf', path, '-C', directory] \
+                + [_escape_pattern(name) for name in names]
+        return None
+
+    def _extract_batch(self, names):
+        directory = tempfile.mkdtemp(prefix='getsub-')
+        try:
+            path = os.path.join(directory, 'archive.rar')
+            self.file.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(self.file, f)
+            output = os.path.join(directory, 'files')
+            os.mkdir(output)
+            args = self._batch_command(path, names, output)
+            if args is None:
+                return {name: self.read(name) for name in names}
+            try:
+                subprocess.run(args, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, check=True)
+            except subprocess.CalledProcessError as e:
+                raise ArchiveError('%s failed: %s' % (
+                    args[0], e.stderr.decode('utf-8', 'ignore').strip()))
+            return _read_extracted(output, names)
+        finally:
+            shutil.rmtree(directory, True)
+
+
+def read_members(handler, names):
+
+    """ 读取压缩包中的多个文件，返回 {文件名: 数据}，
+        后端支持时一次完成 """
+
+    if hasattr(handler, 'read_many'):
+        return handler.read_many(list(names))
+    return {name: handler.read(name) for name in names}
+
+
+class RarfileBackend(Backend):
+
+    name = 'rarfile'
+    formats = ('.rar',)
+    _available = None
+
+    @classmethod
+    def available(cls):
+        # 读取文件需要 unrar / unar / bsdtar 等程序
+        if cls._available is None:
+            try:
+                rarfile.tool_setup()
+                cls._available = True
+            except rarfile.RarCannotExec:
+                cls._available = False
+            except AttributeError:  # rarfile 3.x
+                cls._available = True
+        return cls._available
+
+    @classmethod
+    def open(cls, file):
+        file.seek(0)
+        return RarArchive(file)
+
+
+class PylzmaBackend(Backend):
+
+    name = 'pylzma'
+    formats = ('.7z',)
+
+    @classmethod
+    def available(cls):
+        try:
+            import py7zlib
+        except ImportError:
+            return False
+        return True
+
+    @classmethod
+    def open(cls, file):
+        from getsub.py7z import Py7z
+
+        file.seek(0)
+        return Py7z(file)
+
+
+class LibarchiveArchive(object):
+
+    """ 基于 libarchive-c 的压缩文件控制对象 """
+
+    # 顺序读取时保留的文件总大小上限
+    max_cache_size = 16 * 1024 * 1024
+
+    def __init__(self, file):
+        import libarchive
+
+        self.libarchive = libarchive
+        file.seek(0)
+        self.data = file.read()
+        self.infos = []
+        with libarchive.memory_reader(self.data) as archive:
+            for entry in archive:
+                name = entry.pathname
+                if entry.isdir and not name.endswith('/'):
+                    name += '/'
+                self.infos.append(ArchiveInfo(name, entry.size))
+        self.reader = None
+        self.cache = {}
+        self.cache_size = 0
+
+    def namelist(self):
+        return [info.filename for info in self.infos]
+
+    def infolist(self):
+        return list(self.infos)
+
+    def _entries(self):
+        with self.libarchive.memory_reader(self.data) as archive:
+            for entry in archive:
+                yield entry.pathname, b''.join(entry.get_blocks())
+
+    def _keep(self, name, data):
+        if self.cache_size + len(data) <= self.max_cache_size:
+            self.cache[name] = data
+            self.cache_size += len(data)
+
+    def read(self, name):
+        # 固实压缩包中每个文件都需要从头解压，
+        # 因此顺序读取时沿用同一个读取器，并在大小上限内保留途经的文件；
+        # 未保留的文件再次读取时从头解压
+        if name in self.cache:
+            return self.cache[name]
+        for restart in (False, True):
+            if restart or self.reader is None:
+                self.reader = self._entries()
+            for pathname, data in self.reader:
+                self._keep(pathname, data)
+                if pathname == name:
+                    return data
+        raise KeyError(name)
+
+    def read_many(self, names):
+
+        """ 读取多个文件，返回 {文件名: 数据}；
+            从头解压一次，只保留需要的文件 """
+
+        result = {name: self.cache[name] for name in names
+                  if name in self.cache}
+        wanted = set(names) - set(result)
+        if wanted:
+            for pathname, data in self._entries():
+                if pathname in wanted:
+                    result[pathname] = data
+                    wanted.discard(pathname)
+                    if not wanted:
+                        break
+        if wanted:
+            raise KeyError(wanted.pop())
+        return result
+
+    def open(self, name):
+        return BytesIO(self.read(name))
+
+
+class LibarchiveBackend(Backend):
+
+    name = 'libarchive'
+    formats = ('.zip', '.rar', '.7z')
+
+    @classmethod
+    def available(cls):
+        try:
+            import libarchive
+        except (ImportError, OSError):
+            return False
+        return True
+
+    @classmethod
+    def open(cls, file):
+        return LibarchiveArchive(file)
+
+
+class CommandArchive(object):
+
+    """ 调用外部解压程序的压缩文件控制对象，
+        字幕包写入临时文件后按文件路径交给外部程序 """
+
+    def __init__(self, backend, file):
+        self.backend = backend
+        self.directory = tempfile.mkdtemp(prefix='getsub-')
+        weakref.finalize(self, shutil.rmtree, self.directory, True)
+        self.path = os.path.join(self.directory, 'archive')
+        file.seek(0)
+        with open(self.path, 'wb') as f:
+            shutil.copyfileobj(file, f)
+        self.infos = backend.parse_list(
+            self.run(backend.list_args(self.path)))
+
+    def run(self, args):
+        try:
+            return subprocess.run(args, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, check=True).stdout
+        except subprocess.CalledProcessError as e:
+            raise ArchiveError('%s failed: %s' % (
+                args[0], e.stderr.decode('utf-8', 'ignore').strip()))
+
+    def namelist(self):
+        return [info.filename for info in self.infos]
+
+    def infolist(self):
+        return list(self.infos)
+
+    def read(self, name):
+        return self.run(self.backend.read_args(self.path, name))
+
+    def read_many(self, names):
+
+        """ 读取多个文件，返回 {文件名: 数据}；
+            通过一次外部程序调用全部解压到临时文件夹后读取 """
+
+        if len(names) <= 1:
+            return {name: self.read(name) for name in names}
+        directory = tempfile.mkdtemp(dir=self.directory)
+        try:
+            listfile = os.path.join(directory, 'names.txt')
+            _write_names(listfile, names)
+            output = os.path.join(directory, 'files')
+            os.mkdir(output)
+            self.run(self.backend.extract_args(
+                self.path, names, listfile, output))
+            return _read_extracted(output, names)
+        finally:
+            shutil.rmtree(directory, True)
+
+    def open(self, name):
+        return BytesIO(self.read(name))
+
+
+class CommandBackend(Backend):
+
+    commands = ()  # 可用的程序名，按顺序查找
+
+    @classmethod
+    def executable(cls):
+        for command in cls.commands:
+            path = shutil.which(command)
+            if path:
+                return path
+        return None
+
+    @classmethod
+    def available(cls):
+        return cls.executable() is not None
+
+    @classmethod
+    def open(cls, file):
+        return CommandArchive(cls, file)
+
+
+class SevenZipBackend(CommandBackend):
+
+    name = '7z'
+    formats = ('.7z', '.zip', '.rar')
+    commands = ('7z', '7zz', '7za')
+
+    @classmethod
+    def list_args(cls, path):
+        return [cls.executable(), 'l', '-slt', '-ba', '-sccUTF-8', path]
+
+    @classmethod
+    def read_args(cls, path, name):
+        # -spd：成员名不作为通配符，字幕名中常有 [ ]
+        return [cls.executable(), 'e', '-so', '-spd', '-scsUTF-8',
+                '-sccUTF-8', path, name]
+
+    @classmethod
+    def extract_args(cls, path, names, listfile, directory):
+        # -spd：成员名不作为通配符
+        return [cls.executable(), 'x', '-y', '-spd', '-scsUTF-8',
+                '-sccUTF-8', '-o' + directory, path, '@' + listfile]
+
+    @staticmethod
+    def parse_list(output):
+        infos = []
+        for block in output.decode('utf-8', 'ignore').split('\n\n'):
+            fields = dict(re.findall(r'^(\w+) = (.*)$', block, re.M))
+            if 'Path' not in fields:
+                continue
+            name = fields['Path'].replace(os.sep, '/')
+            if fields.get('Folder') == '+':
+                name += '/'
+            size = fields.get('Size')
+            infos.append(ArchiveInfo(name, int(size) if size else None))
+        return infos
+
+
+class BsdtarBackend(CommandBackend):
+
+    name = 'bsdtar'
+    formats = ('.zip', '.rar', '.7z')
+    commands = ('bsdtar',)
+
+    @classmethod
+    def list_args(cls, path):
+        return [cls.executable(), '-tf', path]
+
+    @classmethod
+    def read_args(cls, path, name):
+        return [cls.executable(), '-xOf', path, _escape_pattern(name)]
+
+    @classmethod
+    def extract_args(cls, path, names, listfile, directory):
+        return [cls.executable(), '-xf', path, '-C', directory] \
+            + [_escape_pattern(name) for name in names]
+
+    @staticmethod
+    def parse_list(output):
+        names = output.decode('utf-8', 'ignore').splitlines()
+        return [ArchiveInfo(name, None) for name in names if name]
+
+
+BACKENDS = (ZipfileBackend, RarfileBackend, PylzmaBackend,
+            LibarchiveBackend, SevenZipBackend, BsdtarBackend)
+# 默认顺序：标准库 zipfile 之后优先使用 C 实现的解压库与外部程序
+DEFAULT_ORDER = ('zipfile', 'libarchive', '7z', 'rarfile', 'bsdtar', 'pylzma')
+
+_order = list(DEFAULT_ORDER)
+
+
+def set_preference(names):
+
+    """ 设置后端优先顺序，未列出的后端按默认顺序排在之后
+    Args:
+        names: 后端名列表，如 ['7z', 'libarchive']
+    """
+
+    global _order
+    for name in names:
+        if name not in DEFAULT_ORDER:
+            raise ValueError('unknown archive backend %s, choose from %s'
+                             % (name, ', '.join(DEFAULT_ORDER)))
+    _order = list(names) + [n for n in DEFAULT_ORDER if n not in names]
+
+
+def preference():
+    """ 当前的后端优先顺序 """
+    return list(_order)
+
+
+def get_backend(datatype, names=None):
+
+    """ 返回支持该格式的第一个可用后端，都不可用时返回第一个支持该格式的后端
+    Args:
+        datatype: 字幕包格式，如 '.7z'
+        names: 只在这些后端中选择，默认为全部
+    """
+
+    by_name = {backend.name: backend for backend in BACKENDS}
+    candidates = [by_name[name] for name in _order
+                  if datatype in by_name[name].formats
+                  and (names is None or name in names)]
+    if not candidates:
+        raise ValueError('unsupported file type %s' % datatype)
+    for backend in candidates:
+        if backend.available():
+            return backend
+    return candidates[0]
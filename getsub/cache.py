@@ -0,0 +1,555 @@
+# coding: utf-8
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import re
+import hashlib
+import threading
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict as order_dict
+
+
+''' 本地缓存
+    SearchCache: 以视频解析结果为键，保存各下载器的搜索结果
+    ArchiveStore: 按内容哈希保存下载的字幕包，以下载器名与下载链接索引
+    HTTPCache: 保存网页响应，按 Cache-Control / ETag / Last-Modified 重新验证
+    NegativeCache: 记录没有搜索结果的查询
+    LibraryState: 记录每个视频文件上次的处理结果，跳过未改变的视频
+'''
+
+
+def default_cache_dir():
+
+    """ 默认缓存目录 """
+
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'getsub')
+
+
+class SearchCache(object):
+
+    def __init__(self, path, ttl=24 * 3600, max_size=50 * 1024 * 1024):
+        """
+        Args:
+            path: SQLite 数据库文件路径
+            ttl: 缓存有效时间（秒）
+            max_size: 缓存结果总字节数上限，超出时删除最久未使用的结果
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS search ('
+                'site TEXT, identity TEXT, sub_num INTEGER, value TEXT, '
+                'size INTEGER, created REAL, accessed REAL, '
+                'PRIMARY KEY (site, identity, sub_num))')
+
+    @staticmethod
+    def identity(keywords):
+        """ 由 Downloader.get_keywords 得到的关键字构造视频标识 """
+        return '|'.join(keyword.lower() for keyword in keywords)
+
+    def get(self, site, identity, sub_num):
+
+        """ 读取未过期的搜索结果
+        Return:
+            字幕字典，不存在或已过期返回 None
+        """
+
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value, created FROM search '
+                'WHERE site=? AND identity=? AND sub_num=?',
+                (site, identity, sub_num)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                with self.conn:
+                    self.conn.execute(
+                        'DELETE FROM search '
+                        'WHERE site=? AND identity=? AND sub_num=?',
+                        (site, identity, sub_num))
+                return None
+            with self.conn:
+                self.conn.execute(
+                    'UPDATE search SET accessed=? '
+                    'WHERE site=? AND identity=? AND sub_num=?',
+                    (now, site, identity, sub_num))
+        return order_dict(json.loads(row[0]))
+
+    def put(self, site, identity, sub_num, sub_dict):
+
+        """ 保存搜索结果，结果无法序列化时不保存 """
+
+        try:
+            value = json.dumps(list(sub_dict.items()), ensure_ascii=False)
+        except TypeError:
+            return
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO search VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (site, identity, sub_num, value, len(value), now, now))
+            self._evict()
+
+    def _evict(self):
+        total = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM search').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.conn.execute(
+            'SELECT site, identity, sub_num, size FROM search '
+            'ORDER BY accessed').fetchall()
+        for site, identity, sub_num, size in rows:
+            if total <= self.max_size:
+                break
+            self.conn.execute(
+                'DELETE FROM search WHERE site=? AND identity=? AND sub_num=?',
+                (site, identity, sub_num))
+            total -= size
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class ArchiveStore(object):
+
+    def __init__(self, directory, max_size=200 * 1024 * 1024):
+        """
+        Args:
+            directory: 字幕包保存目录
+            max_size: 字幕包总字节数上限，超出时删除最久未使用的字幕包
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.sqlite'),
+                                    check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS link ('
+                'site TEXT, link TEXT, hash TEXT, datatype TEXT, '
+                'PRIMARY KEY (site, link))')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS blob ('
+                'hash TEXT PRIMARY KEY, size INTEGER, accessed REAL)')
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, site, link):
+
+        """ 读取已保存的字幕包
+        Return:
+            (datatype, 字幕包二进制数据)，不存在返回 None
+        """
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT hash, datatype FROM link WHERE site=? AND link=?',
+                (site, link)).fetchone()
+            if row is None:
+                return None
+            digest, datatype = row
+            try:
+                with open(self._path(digest), 'rb') as f:
+                    data = f.read()
+            except IOError:
+                with self.conn:
+                    self.conn.execute('DELETE FROM blob WHERE hash=?',
+                                      (digest,))
+                    self.conn.execute('DELETE FROM link WHERE hash=?',
+                                      (digest,))
+                return None
+            with self.conn:
+                self.conn.execute('UPDATE blob SET accessed=? WHERE hash=?',
+                                  (time.time(), digest))
+        return datatype, data
+
+    def put(self, site, link, datatype, data):
+
+        """ 保存字幕包，内容相同的字幕包只保存一份
+        Return:
+            字幕包内容哈希
+        """
+
+        # data 为 bytes 或 DownloadBuffer
+        chunks = data.chunks() if hasattr(data, 'chunks') else [data]
+        sha256 = hashlib.sha256()
+        for chunk in chunks:
+            sha256.update(chunk)
+        digest = sha256.hexdigest()
+        path = self._path(digest)
+        with self.lock:
+            if not os.path.exists(path):
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    chunks = data.chunks() if hasattr(data, 'chunks') \
+                        else [data]
+                    for chunk in chunks:
+                        f.write(chunk)
+                os.replace(tmp_path, path)
+            with self.conn:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO blob VALUES (?, ?, ?)',
+                    (digest, len(data), time.time()))
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO link VALUES (?, ?, ?, ?)',
+                    (site, link, digest, datatype))
+                self._evict()
+        return digest
+
+    def _evict(self):
+        total = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM blob').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.conn.execute(
+            'SELECT hash, size FROM blob ORDER BY accessed').fetchall()
+        for digest, size in rows:
+            if total <= self.max_size:
+                break
+            self.conn.execute('DELETE FROM blob WHERE hash=?', (digest,))
+            self.conn.execute('DELETE FROM link WHERE hash=?', (digest,))
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+            total -= size
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class HTTPCache(object):
+
+    # 保存的响应头
+    stored_headers = ('ETag', 'Last-Modified', 'Cache-Control', 'Expires',
+                      'Content-Type')
+
+    def __init__(self, path, max_size=50 * 1024 * 1024):
+        """
+        Args:
+            path: SQLite 数据库文件路径
+            max_size: 响应内容总字节数上限，超出时删除最久未使用的响应
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS response ('
+                'url TEXT PRIMARY KEY, headers TEXT, encoding TEXT, '
+                'body BLOB, expires REAL, accessed REAL)')
+
+    @staticmethod
+    def freshness(headers):
+
+        """ 根据响应头计算响应过期时间
+        Return:
+            过期时间戳；响应不可保存返回 None
+        """
+
+        cache_control = headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control:
+            return None
+        now = time.time()
+        if 'no-cache' in cache_control:
+            return now
+        max_age = re.search(r'(?:s-maxage|max-age)=(\d+)', cache_control)
+        if max_age:
+            return now + int(max_age.group(1))
+        if headers.get('Expires'):
+            try:
+                return parsedate_to_datetime(headers['Expires']).timestamp()
+            except (TypeError, ValueError):
+                return now
+        return now
+
+    def get(self, url):
+
+        """ 读取保存的响应
+        Return:
+            {'headers', 'encoding', 'body', 'fresh'}，不存在返回 None
+        """
+
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT headers, encoding, body, expires FROM response '
+                'WHERE url=?', (url,)).fetchone()
+            if row is None:
+                return None
+            with self.conn:
+                self.conn.execute(
+                    'UPDATE response SET accessed=? WHERE url=?', (now, url))
+        return {'headers': json.loads(row[0]), 'encoding': row[1],
+                'body': row[2], 'fresh': now < row[3]}
+
+    @staticmethod
+    def validators(entry):
+        """ 条件请求头 """
+
+        headers = {}
+        if entry['headers'].get('ETag'):
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+    def put(self, url, headers, encoding, body):
+
+        """ 保存响应，需要重新验证却没有验证信息的响应不保存 """
+
+        headers = self._select(headers)
+        expires = self.freshness(headers)
+        if expires is None:
+            return
+        if expires <= time.time() and not self.validators({'headers': headers}):
+            return
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?)',
+                (url, json.dumps(headers), encoding, body, expires,
+                 time.time()))
+            self._evict()
+
+    @classmethod
+    def _select(cls, headers):
+        """ 取出需要保存的响应头，响应头名不区分大小写 """
+
+        lower = {k.lower(): v for k, v in headers.items()}
+        return {name: lower[name.lower()] for name in cls.stored_headers
+                if name.lower() in lower}
+
+    def revalidated(self, url, headers):
+
+        """ 收到 304 后将其响应头合并到保存的响应头（RFC 7234 4.3.4），
+            按合并后的响应头更新过期时间
+        Return:
+            合并后的响应头，响应不存在返回 None
+        """
+
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                'SELECT headers FROM response WHERE url=?', (url,)).fetchone()
+            if row is None:
+                return None
+            merged = json.loads(row[0])
+            merged.update(self._select(headers))
+            expires = self.freshness(merged)
+            self.conn.execute(
+                'UPDATE response SET headers=?, expires=? WHERE url=?',
+                (json.dumps(merged), expires or time.time(), url))
+        return merged
+
+    def _evict(self):
+        total = self.conn.execute(
+            'SELECT COALESCE(SUM(LENGTH(body)), 0) FROM response'
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.conn.execute(
+            'SELECT url, LENGTH(body) FROM response ORDER BY accessed'
+        ).fetchall()
+        for url, size in rows:
+            if total <= self.max_size:
+                break
+            self.conn.execute('DELETE FROM response WHERE url=?', (url,))
+            total -= size
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class NegativeCache(object):
+
+    def __init__(self, path=':memory:', ttl=3600):
+        """
+        Args:
+            path: SQLite 数据库文件路径，默认只保存在内存中
+            ttl: 记录有效时间（秒）
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS negative ('
+                'site TEXT, query TEXT, created REAL, '
+                'PRIMARY KEY (site, query))')
+
+    def get(self, site, query):
+        """ 查询是否已知没有结果 """
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT created FROM negative WHERE site=? AND query=?',
+                (site, query)).fetchone()
+        return row is not None and time.time() - row[0] <= self.ttl
+
+    def add(self, site, query):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO negative VALUES (?, ?, ?)',
+                (site, query, time.time()))
+            self.conn.execute('DELETE FROM negative WHERE created < ?',
+                              (time.time() - self.ttl,))
+
+    def clear(self):
+        """ 删除全部记录 """
+
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM negative')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class LibraryState(object):
+
+    def __init__(self, path, backoff=24 * 3600, max_backoff=30 * 24 * 3600):
+        """
+        Args:
+            path: SQLite 数据库文件路径
+            backoff: 没有搜索结果的视频首次重试间隔（秒），之后每次失败加倍
+            max_backoff: 重试间隔上限（秒）
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS video ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                'attempted REAL, outcome TEXT, candidate TEXT, archive TEXT, '
+                'error TEXT, failures INTEGER, retry_after REAL, '
+                'subtitles TEXT)')
+            columns = [row[1] for row in
+                       self.conn.execute('PRAGMA table_info(video)')]
+            if 'subtitles' not in columns:  # 旧版本创建的数据库
+                self.conn.execute(
+                    'ALTER TABLE video ADD COLUMN subtitles TEXT')
+
+    @staticmethod
+    def stat(path):
+        """ 视频文件的 (大小, 修改时间)，无法读取返回 None """
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def get(self, path):
+
+        """ 读取视频上次的处理结果
+        Return:
+            {'size', 'mtime', 'attempted', 'outcome', 'candidate', 'archive',
+             'error', 'failures', 'retry_after', 'subtitles'}，不存在返回 None
+        """
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime, attempted, outcome, candidate, archive, '
+                'error, failures, retry_after, subtitles FROM video '
+                'WHERE path=?', (path,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(('size', 'mtime', 'attempted', 'outcome',
+                          'candidate', 'archive', 'error', 'failures',
+                          'retry_after', 'subtitles'), row))
+        entry['subtitles'] = \
+            entry['subtitles'].split('\n') if entry['subtitles'] else []
+        return entry
+
+    def check(self, path, size, mtime):
+
+        """ 判断视频是否可以跳过
+        Return:
+            'success': 文件未改变且上次已下载字幕，字幕文件仍然存在
+            'backoff': 文件未改变且上次没有搜索结果，未到重试时间
+            None: 需要处理
+        """
+
+        entry = self.get(path)
+        if entry is None or entry['size'] != size \
+                or entry['mtime'] != mtime:
+            return None
+        if entry['outcome'] == 'success':
+            if entry['subtitles'] \
+                    and all(os.path.exists(one) for one in entry['subtitles']):
+                return 'success'
+            # 下载的字幕已被删除，清除记录后重新处理
+            with self.lock, self.conn:
+                self.conn.execute('DELETE FROM video WHERE path=?', (path,))
+            return None
+        if entry['retry_after'] and time.time() < entry['retry_after']:
+            return 'backoff'
+        return None
+
+    def record(self, path, size, mtime, outcome, candidate=None,
+               archive=None, error=None, subtitles=None):
+
+        """ 记录处理结果
+        Args:
+            outcome: 'success' 或 'failed'
+            candidate: 下载的候选字幕名
+            archive: 下载的字幕包链接
+            subtitles: 保存的字幕文件路径列表
+            error: 失败原因，'no_results' 为没有搜索结果，按次数加倍重试间隔；
+                   其它为异常类名等，下次运行时重试
+        """
+
+        now = time.time()
+        entry = self.get(path)
+        failures = 0
+        retry_after = None
+        if error == 'no_results':
+            if entry is not None and entry['error'] == 'no_results' \
+                    and entry['size'] == size and entry['mtime'] == mtime:
+                failures = entry['failures'] or 0
+            failures += 1
+            retry_after = now + min(self.backoff * 2 ** (failures - 1),
+                                    self.max_backoff)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO video '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (path, size, mtime, now, outcome, candidate, archive, error,
+                 failures, retry_after, '\n'.join(subtitles or []) or None))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
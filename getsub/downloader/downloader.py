@@ -1,10 +1,139 @@
 # coding: utf-8
 
 import re
-import sys
+import time
+import asyncio
+import tempfile
+import threading
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-from guessit import guessit
-from requests.utils import quote
+from requests.utils import quote, DEFAULT_ACCEPT_ENCODING
+
+from getsub.guess import guessit
+from getsub.downloader.transport import Transport, AsyncTransport
+from getsub.downloader.transport import translate_errors
+from getsub.sys_global_var import prefix
+from getsub.progress_bar import ProgressBar
+from getsub.cache import NegativeCache
+
+
+class Request(object):
+
+    """ 下载器流程产出的 HTTP 请求，由同步或异步驱动执行。
+        download 为字幕包名时流式读取响应并显示进度，
+        返回 (response, DownloadBuffer)，
+        否则返回 response。
+        return_error 为 True 时请求出错返回异常对象而不抛出，
+        同一批请求中个别请求失败不影响其它请求的结果。 """
+
+    def __init__(self, method, url, download=None, return_error=False,
+                 **kwargs):
+        self.method = method
+        self.url = url
+        self.download = download
+        self.return_error = return_error
+        self.kwargs = kwargs
+
+
+class Sleep(object):
+
+    """ 下载器流程产出的等待指令 """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class DownloadBuffer(object):
+
+    """ 字幕包下载缓冲区
+        数据先保存在内存中，超过 max_size 后转存到临时文件；
+        已知内容大小且超过 max_size 时直接写入临时文件。
+        可作为文件对象直接交给 zipfile / rarfile 等读取。 """
+
+    def __init__(self, size=None, max_size=8 * 1024 * 1024):
+        """
+        Args:
+            size: 预期的内容大小，未知为 None
+            max_size: 内存中保存的最大字节数
+        """
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        if size and size > max_size:
+            self.file.rollover()
+        self.size = 0
+
+    @property
+    def spilled(self):
+        """ 是否已转存到临时文件 """
+        return self.file._rolled
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def seekable(self):
+        return True
+
+    def getvalue(self):
+        """ 返回全部数据 """
+
+        position = self.file.tell()
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(position)
+        return data
+
+    def chunks(self, chunk_size=1024 * 1024):
+        """ 从头依次读取数据块，生成器 """
+
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return self.size
+
+
+class RequestStats(object):
+
+    """ 一次搜索发出的请求数与因无结果记录跳过的查询数 """
+
+    def __init__(self):
+        self.requests = 0
+        self.skipped = 0
+
+
+class SearchCancelled(Exception):
+
+    """ 下载器流程被取消：结果数已满或超过搜索时限后不再需要其结果 """
+
+
+class _StatsLocal(threading.local):
+
+    """ 各线程当前的 RequestStats 与取消流程的 Event；
+        异步流程开始时取得后显式传递 """
+
+    stats = None
+    cancel = None
+
+
+_request_stats = _StatsLocal()
 
 
 class Downloader(object):
@@ -14,13 +143,77 @@ class Downloader(object):
                             AppleWebKit 537.36 (KHTML, like Gecko) Chrome",
         "Accept-Language": "zh-CN,zh;q=0.8",
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,\
-                            image/webp,*/*;q=0.8"
+                            image/webp,*/*;q=0.8",
+        # 安装 brotli 后同时支持 br 压缩
+        "Accept-Encoding": DEFAULT_ACCEPT_ENCODING
     }
 
     service_short_names = {
         'amazon prime': 'amzn'
     }
 
+    # 进程内所有下载器共享的连接层
+    transport = Transport(headers=header, timeout=10)
+    async_transport = AsyncTransport(headers=header, timeout=10)
+
+    # 同时执行一批请求时的最大并发数，None 为不限制
+    concurrency = None
+
+    # 下载字幕包时内存中保存的最大字节数，超出后转存到临时文件
+    spool_size = 8 * 1024 * 1024
+    # 下载读取块大小的范围
+    min_chunk_size = 16 * 1024
+    max_chunk_size = 1024 * 1024
+
+    # 关键字放宽搜索时每批同时发出的查询数
+    query_width = 2
+    # 没有结果的查询记录
+    negative_cache = NegativeCache()
+
+    @staticmethod
+    @contextmanager
+    def request_stats(stats=None):
+        """ 统计当前线程中下载器发出的请求数，返回 RequestStats """
+
+        if stats is None:
+            stats = RequestStats()
+        previous = _request_stats.stats
+        _request_stats.stats = stats
+        try:
+            yield stats
+        finally:
+            _request_stats.stats = previous
+
+    @staticmethod
+    @contextmanager
+    def cancel_on(event):
+        """ event 被设置后，当前线程中的下载器流程在下一条指令前停止，
+            抛出 SearchCancelled """
+
+        previous = _request_stats.cancel
+        _request_stats.cancel = event
+        try:
+            yield event
+        finally:
+            _request_stats.cancel = previous
+
+    @staticmethod
+    def count_requests(number=1, stats=None):
+        if stats is None:
+            stats = _request_stats.stats
+        if stats is not None:
+            stats.requests += number
+
+    @staticmethod
+    def count_skipped(number=1):
+        stats = _request_stats.stats
+        if stats is not None:
+            stats.skipped += number
+
+    def session(self):
+        """ 当前下载器网站的共享 Session """
+        return Downloader.transport.session(self.__class__.name)
+
     @classmethod
     def num_to_cn(cls, number):
 
@@ -92,6 +285,31 @@ class Downloader(object):
         keywords = [quote(_keyword) for _keyword in keywords]
         return keywords, info_dict
 
+    def search(self, video_name, sub_num):
+
+        """ 搜索字幕流程，生成器
+            产出 Request / Sleep 指令或 Request 列表（同时执行）并接收执行结果，
+            返回值同 get_subtitles """
+
+        raise NotImplementedError
+
+    def fetch(self, file_name, sub_url, session=None):
+
+        """ 下载字幕包流程，生成器
+            产出 Request / Sleep 指令并接收执行结果，
+            返回值同 download_file """
+
+        raise NotImplementedError
+
+    def resolve(self, sub_url, page):
+
+        """ 解析最终下载链接的流程，生成器
+            候选字幕中带有 'resolve' 值时，'link' 为尚未解析的页面链接，
+            在该候选字幕被选中下载时才执行此流程，返回值同 resolve_link """
+
+        return sub_url
+        yield
+
     def get_subtitles(self, video_name, sub_num=5):
 
         """ 搜索字幕
@@ -102,9 +320,10 @@ class Downloader(object):
             字幕字典: 按语言值降序排列
             eg: {'字幕名': {'lan': '语言值', 'link': '字幕链接', 'session': '查询session'}}
             字幕包含语言值：英文加1， 繁体加2， 简体加4， 双语加8
+            带有 'resolve' 值的字幕需先经 resolve_link 得到下载链接
         """
 
-        raise NotImplementedError
+        return self.run_sync(self.search(video_name, sub_num))
 
     def download_file(self, file_name, sub_url, session=None):
 
@@ -114,9 +333,231 @@ class Downloader(object):
             sub_url: 下载链接，为 'get_subtitles' 返回结果中 'link' 值
             session: 查询session
         Return:
-            data_type: 压缩文件类型，如 '.rar', '.zip', '.7z'
-            sub_data_bytes: 字幕包二进制数据
+            data_type: 由文件头判断的字幕包类型，如 '.rar', '.zip', '.7z',
+                       '.gz', '.srt'，无法识别为 'Unknown'
+            sub_data_bytes: 字幕包数据 DownloadBuffer，可作为文件对象读取
             err_msg : 错误消息，无则返回 ''
         """
 
-        raise NotImplementedError
\ No newline at end of file
+        return self.run_sync(self.fetch(file_name, sub_url, session=session))
+
+    def resolve_link(self, sub_url, page):
+
+        """ 解析候选字幕的最终下载链接
+        Args:
+            sub_url: 'get_subtitles' 返回结果中 'link' 值
+            page: 'get_subtitles' 返回结果中 'resolve' 值，为链接所指页面的类型
+        Return:
+            download_link: 可直接交给 download_file 的下载链接
+        """
+
+        return self.run_sync(self.resolve(sub_url, page))
+
+    async def async_get_subtitles(self, video_name, sub_num=5):
+
+        """ get_subtitles 的异步版本 """
+
+        return await self.run_async(self.search(video_name, sub_num))
+
+    async def async_download_file(self, file_name, sub_url, session=None):
+
+        """ download_file 的异步版本，session 参数被忽略 """
+
+        return await self.run_async(
+            self.fetch(file_name, sub_url, session=session))
+
+    @staticmethod
+    def _check_cancel(flow, cancel):
+        if cancel is not None and cancel.is_set():
+            flow.close()
+            raise SearchCancelled()
+
+    def run_sync(self, flow, cancel=None):
+
+        """ 使用共享连接层同步执行下载器流程
+        Args:
+            cancel: threading.Event，被设置后不再执行流程的其余指令，
+                    抛出 SearchCancelled；默认为 cancel_on 设置的 Event
+        """
+
+        if cancel is None:
+            cancel = _request_stats.cancel
+        value, error = None, None
+        while True:
+            try:
+                if error is not None:
+                    command = flow.throw(error)
+                else:
+                    command = flow.send(value)
+            except StopIteration as e:
+                return e.value
+            self._check_cancel(flow, cancel)
+            value, error = None, None
+            try:
+                value = self._perform_sync(command)
+            except Exception as e:
+                error = e
+
+    async def run_async(self, flow, cancel=None):
+
+        """ 使用异步连接层执行下载器流程，cancel 同 run_sync """
+
+        # 同一事件循环中的其它流程可能改变当前线程的统计对象
+        stats = _request_stats.stats
+        if cancel is None:
+            cancel = _request_stats.cancel
+        value, error = None, None
+        while True:
+            try:
+                if error is not None:
+                    command = flow.throw(error)
+                else:
+                    command = flow.send(value)
+            except StopIteration as e:
+                return e.value
+            self._check_cancel(flow, cancel)
+            value, error = None, None
+            try:
+                value = await self._perform_async(command, stats)
+            except Exception as e:
+                error = e
+
+    def _perform_sync(self, command):
+        if isinstance(command, list):
+            # 同时执行一批请求，结果按顺序返回
+            if not command:
+                return []
+            Downloader.count_requests(len(command))
+            workers = min(len(command), self.concurrency or len(command))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(self._perform_sync_one, command))
+        if isinstance(command, Request):
+            Downloader.count_requests()
+        return self._perform_sync_one(command)
+
+    def _perform_sync_one(self, command):
+        if isinstance(command, Sleep):
+            time.sleep(command.seconds)
+            return None
+        if command.return_error:
+            try:
+                return self._perform_sync_request(command)
+            except Exception as e:
+                return e
+        return self._perform_sync_request(command)
+
+    def _perform_sync_request(self, command):
+        site = self.__class__.name
+        if not command.download:
+            return Downloader.transport.request(
+                site, command.method, command.url, **command.kwargs)
+        with closing(Downloader.transport.request(
+                site, command.method, command.url,
+                stream=True, **command.kwargs)) as response:
+            bar = self._progress_bar(command.download, response)
+            data = self._download_buffer(response)
+            for chunk in response.iter_content(
+                    chunk_size=self._chunk_size(response)):
+                data.write(chunk)
+                self._refresh_bar(bar, data)
+            self._refresh_bar(bar, data, end=True)
+        data.seek(0)
+        return response, data
+
+    async def _perform_async(self, command, stats=None):
+        if isinstance(command, list):
+            Downloader.count_requests(len(command), stats)
+            if self.concurrency:
+                semaphore = asyncio.Semaphore(self.concurrency)
+
+                async def perform(one):
+                    async with semaphore:
+                        return await self._perform_async_one(one)
+            else:
+                perform = self._perform_async_one
+            return list(await asyncio.gather(
+                *[perform(one) for one in command]))
+        if isinstance(command, Request):
+            Downloader.count_requests(stats=stats)
+        return await self._perform_async_one(command)
+
+    async def _perform_async_one(self, command):
+        if isinstance(command, Sleep):
+            await asyncio.sleep(command.seconds)
+            return None
+        if command.return_error:
+            try:
+                return await self._perform_async_request(command)
+            except Exception as e:
+                return e
+        return await self._perform_async_request(command)
+
+    async def _perform_async_request(self, command):
+        site = self.__class__.name
+        kwargs = dict(command.kwargs)
+        kwargs.pop('session', None)
+        transport = Downloader.async_transport
+        if not command.download:
+            return await transport.request(
+                site, command.method, command.url, **kwargs)
+        async with transport.stream(
+                site, command.method, command.url, **kwargs) as response:
+            bar = self._progress_bar(command.download, response)
+            data = self._download_buffer(response)
+            with translate_errors():
+                async for chunk in response.aiter_bytes(
+                        chunk_size=self._chunk_size(response)):
+                    data.write(chunk)
+                    self._refresh_bar(bar, data)
+            self._refresh_bar(bar, data, end=True)
+        data.seek(0)
+        return response, data
+
+    @staticmethod
+    def _content_size(response):
+        """ 响应头中的内容体总大小，未知或经过压缩时返回 None """
+
+        if response.headers.get('content-encoding', 'identity') != 'identity':
+            return None
+        try:
+            return int(response.headers.get('content-length'))
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def _download_buffer(cls, response):
+        return DownloadBuffer(cls._content_size(response),
+                              max_size=cls.spool_size)
+
+    @classmethod
+    def _chunk_size(cls, response):
+        """ 按内容大小选择读取块大小，约分 64 次读完 """
+
+        size = cls._content_size(response)
+        if size is None:
+            return cls.min_chunk_size * 4
+        return max(cls.min_chunk_size, min(cls.max_chunk_size, size // 64))
+
+    @classmethod
+    def _progress_bar(cls, file_name, response):
+        content_size = response.headers.get('content-length')
+        if content_size:
+            # 内容体总大小
+            bar = ProgressBar(prefix + ' Get',
+                              file_name.strip(), int(content_size))
+        else:
+            bar = ProgressBar(prefix + ' Get', file_name.strip())
+        bar.shown = -1  # 已显示的进度，每增加 1% 刷新一次
+        return bar
+
+    @staticmethod
+    def _refresh_bar(bar, data, end=False):
+        if bar.total:
+            if not end:
+                percent = min(100, len(data) * 100 // bar.total)
+                if percent > bar.shown:
+                    bar.shown = percent
+                    bar.refresh(len(data))
+        elif end or len(data) // Downloader.max_chunk_size > bar.shown:
+            bar.shown = len(data) // Downloader.max_chunk_size
+            bar.point_wait(end=end)
@@ -0,0 +1,110 @@
+# coding: utf-8
+
+import re
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+
+''' 下载器的 HTML 解析
+    搜索页、详情页只读取少数节点，解析时用 SoupStrainer 只保留需要的子树。
+    优先使用 C 实现的 lxml 解析器，未安装时使用标准库 html.parser。
+'''
+
+
+PARSERS = ('lxml', 'html.parser')
+
+_parser = None
+
+
+def available(name):
+
+    """ 解析器依赖的模块是否存在 """
+
+    if name == 'lxml':
+        try:
+            import lxml
+        except ImportError:
+            return False
+    return name in PARSERS
+
+
+def set_parser(name):
+
+    """ 指定解析器，为 None 时自动选择第一个可用的解析器 """
+
+    global _parser
+    if name is not None and name not in PARSERS:
+        raise ValueError('unknown html parser %s, choose from %s'
+                         % (name, ', '.join(PARSERS)))
+    _parser = name
+
+
+def parser():
+
+    """ 当前使用的解析器名 """
+
+    if _parser is not None:
+        return _parser
+    for name in PARSERS:
+        if available(name):
+            return name
+
+
+def strainer(name=None, attrs=None):
+
+    """ 只保留匹配的节点及其子节点
+    Args:
+        name: 标签名或标签名列表
+        attrs: 属性字典，属性值为列表时节点属性含其中任一单词即匹配，
+               如 {'class': ['item', 'persub']}；
+               解析过程中 class / rel 等属性尚未按空格拆分，因此按单词匹配
+    """
+
+    words = {}
+    for key, value in (attrs or {}).items():
+        if isinstance(value, (list, tuple)):
+            value = re.compile(r'(?:^|\s)(?:%s)(?:\s|$)'
+                               % '|'.join(map(re.escape, value)))
+        words[key] = value
+    return SoupStrainer(name, words)
+
+
+class _AnyOf(SoupStrainer):
+
+    """ 匹配任一 strainer 的节点都保留 """
+
+    def __init__(self, strainers):
+        super(_AnyOf, self).__init__()
+        self.strainers = strainers
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        # beautifulsoup4 4.13 及之后的版本
+        return any(one.allow_tag_creation(nsprefix, name, attrs)
+                   for one in self.strainers)
+
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        # beautifulsoup4 4.13 之前的版本
+        for one in self.strainers:
+            found = one.search_tag(markup_name, markup_attrs)
+            if found:
+                return found
+        return None
+
+
+def any_of(*strainers):
+
+    """ 组合多个 strainer，保留匹配其中任一个的节点，
+        如 any_of(strainer('small'), strainer('div', {'class': ['box']})) """
+
+    return _AnyOf(list(strainers))
+
+
+def parse_html(text, only=None):
+
+    """ 解析 HTML，返回 BeautifulSoup 对象
+    Args:
+        text: HTML 文本
+        only: strainer 返回的过滤条件，为 None 时解析全部节点
+    """
+
+    return BeautifulSoup(text, parser(), parse_only=only)
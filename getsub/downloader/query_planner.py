@@ -0,0 +1,85 @@
+# coding: utf-8
+
+from getsub.downloader.downloader import Downloader
+
+
+''' 搜索关键字计划
+    从完整关键字开始，每次去掉最后一个关键字放宽搜索条件。
+    每批同时发出 width 个查询，按顺序处理结果；
+    已知没有结果的查询记录在 Downloader.negative_cache 中，有效期内不再发出。
+'''
+
+
+class QueryPlanner(object):
+
+    def __init__(self, site, keyword, keywords, strip=False, width=None):
+        """
+        Args:
+            site: 下载器名
+            keyword: 完整关键字字符串
+            keywords: 关键字列表，依次从末尾去掉
+            strip: 去掉关键字后是否去除首尾空格
+            width: 每批同时发出的查询数，默认为 Downloader.query_width
+        """
+        self.site = site
+        self.width = width or Downloader.query_width
+        self.pending = []
+        keywords = list(keywords)
+        while True:
+            self.pending.append(keyword)
+            if len(keywords) <= 1:
+                break
+            keyword = keyword.replace(keywords[-1], '')
+            if strip:
+                keyword = keyword.strip()
+            keywords.pop(-1)
+        self.current = []
+        self.stopped = False  # 结果数已满
+
+    @property
+    def finished(self):
+        return self.stopped or not self.pending
+
+    def next_batch(self, make_request):
+
+        """ 发出下一批查询，生成器
+        Args:
+            make_request: 由查询字符串构造 Request 的函数
+        Return:
+            [(查询字符串, response)]，已知无结果的查询被跳过
+        """
+
+        batch = []
+        negative_cache = Downloader.negative_cache
+        while self.pending and len(batch) < self.width:
+            query = self.pending.pop(0)
+            if negative_cache is not None \
+                    and negative_cache.get(self.site, query):
+                Downloader.count_skipped()
+                continue
+            batch.append(query)
+        self.current = batch
+        if not batch:
+            return []
+        responses = yield [make_request(query) for query in batch]
+        return list(zip(batch, responses))
+
+    def empty(self, query):
+        """ 记录没有结果的查询 """
+
+        if Downloader.negative_cache is not None:
+            Downloader.negative_cache.add(self.site, query)
+
+    def retry(self, query):
+        """ 重新发出当前批次中该查询及其之后的查询 """
+
+        index = self.current.index(query)
+        self.pending = self.current[index:] + self.pending
+        self.current = []
+
+    def finish(self):
+        """ 结果数已满，不再发出其余查询 """
+
+        self.stopped = True
+        self.pending = []
+        self.current = []
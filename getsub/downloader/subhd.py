@@ -1,17 +1,15 @@
 # coding: utf-8
 
-import time
 import json
 import re
-from contextlib import closing
 from collections import OrderedDict as order_dict
 
 import requests
-from bs4 import BeautifulSoup
-
-from getsub.downloader.downloader import Downloader
+from getsub.downloader.downloader import Downloader, Request, Sleep
+from getsub.downloader.html_parser import parse_html, strainer, any_of
+from getsub.downloader.query_planner import QueryPlanner
+from getsub.archive import sniff_format
 from getsub.sys_global_var import prefix
-from getsub.progress_bar import ProgressBar
 
 
 ''' SubHD 字幕下载器
@@ -24,8 +22,13 @@ class SubHDDownloader(Downloader):
     choice_prefix = '[SUBHD]'
     site_url = 'https://subhd.la'
     search_url = 'https://subhd.la/search/'
+    # 解析页面时只保留需要的节点
+    search_only = any_of(
+        strainer('small'),
+        strainer('div', {'class': 'mb-4 bg-white rounded shadow-sm'}))
+    detail_only = strainer('button', {'id': 'down'})
 
-    def get_subtitles(self, video_name, sub_num=5):
+    def search(self, video_name, sub_num=5):
 
         print(prefix + ' Searching SUBHD...', end='\r')
 
@@ -33,25 +36,29 @@ class SubHDDownloader(Downloader):
         keyword = ' '.join(keywords)
 
         sub_dict = order_dict()
-        s = requests.session()
-        while True:
+        planner = QueryPlanner(SubHDDownloader.name, keyword, keywords)
+        while not planner.finished:
             # 当前关键字查询
-            r = s.get(SubHDDownloader.search_url + keyword,
-                      headers=Downloader.header, timeout=10)
-            bs_obj = BeautifulSoup(r.text, 'html.parser')
-            try:
-                small_text = bs_obj.find('small').text
-            except AttributeError as e:
-                char_error = 'The URI you submitted has disallowed characters'
-                if char_error in bs_obj.text:
-                    print(prefix + ' [SUBHD ERROR] '
-                          + char_error + ': ' + keyword)
-                    return sub_dict
-                # 搜索验证按钮
-                time.sleep(2)
-                continue
-
-            if "总共 0 条" not in small_text:
+            batch = yield from planner.next_batch(
+                lambda query: Request('GET', SubHDDownloader.search_url + query))
+            for keyword, r in batch:
+                bs_obj = parse_html(r.text, SubHDDownloader.search_only)
+                try:
+                    small_text = bs_obj.find('small').text
+                except AttributeError as e:
+                    char_error = 'The URI you submitted has disallowed characters'
+                    if char_error in r.text:
+                        print(prefix + ' [SUBHD ERROR] '
+                              + char_error + ': ' + keyword)
+                        return sub_dict
+                    # 搜索验证按钮
+                    yield Sleep(2)
+                    planner.retry(keyword)
+                    break
+
+                if "总共 0 条" in small_text:
+                    planner.empty(keyword)
+                    continue
 
                 results = bs_obj.find_all("div", class_="mb-4 bg-white rounded shadow-sm")
 
@@ -77,15 +84,11 @@ class SubHDDownloader(Downloader):
                             'session': None
                         }
                     if len(sub_dict) >= sub_num:
-                        del keywords[:]  # 字幕条数达到上限，清空keywords
+                        planner.finish()  # 字幕条数达到上限，不再查询
                         break
 
-            if len(keywords) > 1:  # 字幕数未满，更换关键词继续查询
-                keyword = keyword.replace(keywords[-1], '')
-                keywords.pop(-1)
-                continue
-
-            break
+                if planner.stopped:
+                    break
 
         if (len(sub_dict.items()) > 0
                 and list(sub_dict.items())[0][1]['lan'] < 8):
@@ -96,16 +99,15 @@ class SubHDDownloader(Downloader):
             )
         return sub_dict
 
-    def download_file(self, file_name, sub_url, session=None):
+    def fetch(self, file_name, sub_url, session=None):
 
         sid = sub_url.split('/')[-1]
-        r = requests.get(sub_url, headers=Downloader.header)
-        bs_obj = BeautifulSoup(r.text, 'html.parser')
+        r = yield Request('GET', sub_url)
+        bs_obj = parse_html(r.text, SubHDDownloader.detail_only)
         dtoken = bs_obj.find('button', {'id': 'down'})['dtoken']
 
-        r = requests.post(SubHDDownloader.site_url + '/ajax/down_ajax',
-                          data={'sub_id': sid, 'dtoken': dtoken},
-                          headers=Downloader.header)
+        r = yield Request('POST', SubHDDownloader.site_url + '/ajax/down_ajax',
+                          data={'sub_id': sid, 'dtoken': dtoken})
 
         content = r.content.decode('unicode-escape')
         if json.loads(content)['success'] is False:
@@ -115,26 +117,10 @@ class SubHDDownloader(Downloader):
         res = re.search('http:.*(?=")', r.content.decode('unicode-escape'))
         download_link = res.group(0).replace('\\/', '/')
         try:
-            with closing(requests.get(download_link, stream=True)) as response:
-                chunk_size = 1024  # 单次请求最大值
-                # 内容体总大小
-                content_size = int(response.headers['content-length'])
-                bar = ProgressBar(prefix + ' Get',
-                                  file_name.strip(), content_size)
-                sub_data_bytes = b''
-                for data in response.iter_content(chunk_size=chunk_size):
-                    sub_data_bytes += data
-                    bar.refresh(len(sub_data_bytes))
-            # sub_data_bytes = requests.get(download_link, timeout=10).content
+            response, sub_data_bytes = yield Request(
+                'GET', download_link, download=file_name)
         except requests.Timeout:
             return None, None, 'false'
-        if 'rar' in download_link:
-            datatype = '.rar'
-        elif 'zip' in download_link:
-            datatype = '.zip'
-        elif '7z' in download_link:
-            datatype = '.7z'
-        else:
-            datatype = 'Unknown'
+        datatype = sniff_format(sub_data_bytes) or 'Unknown'
 
         return datatype, sub_data_bytes, ''
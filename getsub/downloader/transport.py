@@ -0,0 +1,185 @@
+# coding: utf-8
+
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+''' 下载器共享的 HTTP 连接层
+    每个网站使用一个 Session：独立的 Cookie，按主机复用的长连接池，默认超时。
+    设置 cache 后 GET 请求的响应按 Cache-Control / ETag / Last-Modified 缓存，
+    过期后发送条件请求重新验证。
+    AsyncTransport 为异步版本，基于 httpx，可在同一主机上通过 HTTP/2 复用连接。
+'''
+
+
+class Transport(object):
+
+    def __init__(self, headers=None, timeout=10,
+                 pool_connections=10, pool_maxsize=20):
+        """
+        Args:
+            headers: 所有请求的默认请求头
+            timeout: 未指定 timeout 时使用的默认超时（秒）
+            pool_connections: 每个 Session 缓存的主机连接池数
+            pool_maxsize: 每个主机连接池保持的最大连接数
+        """
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.cache = None  # getsub.cache.HTTPCache
+
+    def session(self, site):
+        """ 返回网站对应的 Session，不存在时创建 """
+
+        with self.lock:
+            s = self.sessions.get(site)
+            if s is None:
+                s = requests.session()
+                s.headers.update(self.headers)
+                adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                      pool_maxsize=self.pool_maxsize)
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                self.sessions[site] = s
+            return s
+
+    def request(self, site, method, url, session=None, **kwargs):
+        """ 使用网站 Session 发送请求，未指定超时时使用默认超时 """
+
+        kwargs.setdefault('timeout', self.timeout)
+        if session is None:
+            session = self.session(site)
+        cache = self.cache
+        if cache is None or method != 'GET' or kwargs.get('stream'):
+            return session.request(method, url, **kwargs)
+
+        # 缓存只以 URL 为键而不考虑 Vary：
+        # 同一网站的请求头（包括 Accept-Encoding）固定不变，响应不随请求头变化
+        entry = cache.get(url)
+        if entry is not None:
+            if entry['fresh']:
+                return self._cached_response(url, entry)
+            headers = dict(kwargs.get('headers') or {})
+            headers.update(cache.validators(entry))
+            kwargs['headers'] = headers
+        r = session.request(method, url, **kwargs)
+        if entry is not None and r.status_code == 304:
+            entry['headers'] = cache.revalidated(url, r.headers) \
+                or entry['headers']
+            return self._cached_response(url, entry)
+        if r.status_code == 200:
+            cache.put(url, r.headers, r.encoding, r.content)
+        return r
+
+    @staticmethod
+    def _cached_response(url, entry):
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r.headers = CaseInsensitiveDict(entry['headers'])
+        r.encoding = entry['encoding']
+        r._content = entry['body']
+        r.from_cache = True
+        return r
+
+    def close(self):
+        with self.lock:
+            for s in self.sessions.values():
+                s.close()
+            self.sessions.clear()
+
+
+@contextmanager
+def translate_errors():
+    """ 将 httpx 的网络异常转换为 requests 对应异常，
+        使下载器与调用方只需处理 requests 异常 """
+
+    import httpx
+
+    try:
+        yield
+    except httpx.TimeoutException as e:
+        raise requests.Timeout(str(e))
+    except httpx.TransportError as e:
+        raise requests.ConnectionError(str(e))
+
+
+class AsyncTransport(object):
+
+    def __init__(self, headers=None, timeout=10, http2=True,
+                 max_connections=100):
+        """
+        Args:
+            headers: 所有请求的默认请求头
+            timeout: 未指定 timeout 时使用的默认超时（秒）
+            http2: 是否启用 HTTP/2，需要安装 h2
+            max_connections: 每个网站客户端的最大连接数
+        """
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.http2 = http2
+        self.max_connections = max_connections
+        self.clients = {}  # {site: (event loop, httpx.AsyncClient)}
+
+    def client(self, site):
+        """ 返回当前事件循环中网站对应的 AsyncClient，不存在时创建 """
+
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError('async downloaders require httpx, '
+                              'try: pip install httpx[http2]')
+        loop = asyncio.get_event_loop()
+        cached = self.clients.get(site)
+        if cached is not None and cached[0] is loop:
+            return cached[1]
+        http2 = self.http2
+        if http2:
+            try:
+                import h2
+            except ImportError:
+                http2 = False
+        client = httpx.AsyncClient(
+            headers=self.headers, timeout=self.timeout, http2=http2,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=self.max_connections))
+        self.clients[site] = (loop, client)
+        return client
+
+    async def request(self, site, method, url, **kwargs):
+        """ 使用网站客户端发送请求 """
+
+        with translate_errors():
+            return await self.client(site).request(method, url, **kwargs)
+
+    def stream(self, site, method, url, **kwargs):
+        """ 流式请求，返回异步上下文管理器 """
+
+        transport = self
+
+        class _Stream(object):
+            async def __aenter__(self):
+                self.context = transport.client(site).stream(
+                    method, url, **kwargs)
+                with translate_errors():
+                    return await self.context.__aenter__()
+
+            async def __aexit__(self, *args):
+                return await self.context.__aexit__(*args)
+
+        return _Stream()
+
+    async def aclose(self):
+        loop = asyncio.get_event_loop()
+        for site, (client_loop, client) in list(self.clients.items()):
+            if client_loop is loop:
+                await client.aclose()
+                del self.clients[site]
@@ -1,16 +1,16 @@
 # coding: utf-8
 
-from urllib.parse import urljoin
-from contextlib import closing
+import re
+from urllib.parse import urljoin, urlparse
 from collections import OrderedDict as order_dict
 
 import requests
-from bs4 import BeautifulSoup
-from guessit import guessit
-
-from getsub.downloader.downloader import Downloader
+from getsub.guess import guessit
+from getsub.downloader.downloader import Downloader, Request
+from getsub.downloader.html_parser import parse_html, strainer
+from getsub.downloader.query_planner import QueryPlanner
+from getsub.archive import sniff_format
 from getsub.sys_global_var import prefix
-from getsub.progress_bar import ProgressBar
 
 
 ''' Zimuku 字幕下载器
@@ -23,13 +23,26 @@ class ZimukuDownloader(Downloader):
     choice_prefix = '[ZIMUKU]'
     site_url = 'http://www.zimuku.la'
     search_url = 'http://www.zimuku.la/search?q='
+    # 同时获取的详情页数与单个详情页超时
+    concurrency = 4
+    detail_timeout = 20
+    # 解析页面时只保留需要的节点
+    search_only = strainer('div', {'class': ['item', 'persub']})
+    detail_only = strainer(['ul', 'a'])
+    down_only = strainer('a', {'rel': ['nofollow']})
+    # 语言图标 /lang/<文件名> 对应的语言值
+    lang_scores = {'uk': 1, 'hongkong': 2, 'china': 4, 'jollyroger': 8}
+    lang_icon = re.compile(r'/lang/(\w+)\.\w+$')
 
-    def get_subtitles(self, video_name, sub_num=10):
+    def search(self, video_name, sub_num=10):
 
         print(prefix + ' Searching ZIMUKU...', end='\r')
 
         keywords, info_dict = Downloader.get_keywords(video_name)
         keyword = ' '.join(keywords)
+        # 按季搜索，见 getsub.season
+        season_query = info_dict.get('type') == 'episode' \
+            and not info_dict.get('episode')
 
         info = guessit(keyword)
         keywords.pop(0)
@@ -39,16 +52,22 @@ class ZimukuDownloader(Downloader):
             keywords.insert(1, 's' + season)
 
         sub_dict = order_dict()
-        s = requests.session()
-        s.headers.update(Downloader.header)
+        planner = QueryPlanner(
+            ZimukuDownloader.name, keyword, keywords, strip=True)
 
-        while True:
+        while not planner.finished:
             # 当前关键字搜索
-            r = s.get(ZimukuDownloader.search_url + keyword, timeout=10)
-            html = r.text
+            batch = yield from planner.next_batch(
+                lambda query: Request(
+                    'GET', ZimukuDownloader.search_url + query))
+            for keyword, r in batch:
+                html = r.text
+
+                if '搜索不到相关字幕' in html:
+                    planner.empty(keyword)
+                    continue
 
-            if '搜索不到相关字幕' not in html:
-                bs_obj = BeautifulSoup(r.text, 'html.parser')
+                bs_obj = parse_html(r.text, ZimukuDownloader.search_only)
 
                 if bs_obj.find('div', {'class': 'item'}):
                     # 综合搜索页面
@@ -85,14 +104,25 @@ class ZimukuDownloader(Downloader):
                                     or sum2 / len(info_title_split) >= 0.5):
                                 # 标题不匹配，跳过
                                 continue
-                        for a in item.find_all('td', {'class': 'first'})[:3]:
+                        rows = item.find_all('td', {'class': 'first'})
+                        if not season_query:
+                            # 按季搜索时保留所有集的字幕
+                            rows = rows[:3]
+                        for a in rows:
+                            row = a.parent
                             a = a.a
                             a_link = ZimukuDownloader.site_url + \
                                 a.attrs['href']
                             a_title = a.text
                             a_title = ZimukuDownloader.choice_prefix + a_title
-                            sub_dict[a_title] = {'type': 'default',
-                                                 'link': a_link}
+                            sub_info = {'type': 'default', 'link': a_link,
+                                        'resolve': 'detail', 'session': None}
+                            # 搜索结果中有语言图标时不必获取详情页
+                            type_score = self._lang_score(
+                                row.find('td', {'class': 'lang'}))
+                            if type_score:
+                                sub_info['lan'] = type_score
+                            sub_dict[a_title] = sub_info
                 elif bs_obj.find('div', {'class': 'persub'}):
                     # 射手字幕页面
                     for persub in bs_obj.find_all('div', {'class': 'persub'}):
@@ -100,71 +130,41 @@ class ZimukuDownloader(Downloader):
                         a_link = ZimukuDownloader.site_url + \
                             persub.h1.a.attrs['href']
                         a_title = ZimukuDownloader.choice_prefix + a_title
-                        sub_dict[a_title] = {'type': 'shooter', 'link': a_link}
+                        sub_dict[a_title] = {'type': 'shooter', 'link': a_link,
+                                             'resolve': 'shooter',
+                                             'session': None}
                 else:
                     raise ValueError('Zimuku搜索结果出现未知结构页面')
 
-            if len(sub_dict) >= sub_num:
-                del keywords[:]
-                break
+                if len(sub_dict) >= sub_num:
+                    planner.finish()
+                    break
 
-            if len(keywords) > 1:
-                keyword = keyword.replace(keywords[-1], '').strip()
-                keywords.pop(-1)
+        # 同时获取缺少语言值的候选字幕的详情页，按原顺序保留结果；
+        # 出错或超时的候选字幕语言值记为 0，保留详情页链接，被选中时由 resolve 重试。
+        # 下载页在候选字幕被选中下载时才解析，见 resolve。
+        # 按季搜索的结果较多，不获取详情页，缺少的语言值记为 0
+        pending = [sub_name for sub_name, sub_info in sub_dict.items()
+                   if 'lan' not in sub_info]
+        if season_query:
+            for sub_name in pending:
+                sub_dict[sub_name]['lan'] = 0
+            pending = []
+        responses = yield [
+            Request('GET', sub_dict[sub_name]['link'], return_error=True,
+                    timeout=ZimukuDownloader.detail_timeout)
+            for sub_name in pending]
+        for sub_name, r in zip(pending, responses):
+            sub_info = sub_dict[sub_name]
+            try:
+                sub_info['lan'], sub_info['link'], sub_info['resolve'] = \
+                    self._parse_detail(r, sub_info['resolve'])
+            except (requests.RequestException, AttributeError,
+                    KeyError, TypeError):
+                sub_info['lan'] = 0
                 continue
-
-            break
-
-        for sub_name, sub_info in sub_dict.items():
-            if sub_info['type'] == 'default':
-                # 综合搜索字幕页面
-                r = s.get(sub_info['link'], timeout=60)
-                bs_obj = BeautifulSoup(r.text, 'html.parser')
-                lang_box = bs_obj.find('ul', {'class': 'subinfo'}).find('li')
-                type_score = 0
-                for lang in lang_box.find_all('img'):
-                    if 'uk' in lang.attrs['src']:
-                        type_score += 1
-                    elif 'hongkong' in lang.attrs['src']:
-                        type_score += 2
-                    elif 'china' in lang.attrs['src']:
-                        type_score += 4
-                    elif 'jollyroger' in lang.attrs['src']:
-                        type_score += 8
-                sub_info['lan'] = type_score
-                download_link = bs_obj.find('a', {'id': 'down1'}).attrs['href']
-                download_link = urljoin(
-                    ZimukuDownloader.site_url, download_link)
-                r = s.get(download_link, timeout=60)
-                bs_obj = BeautifulSoup(r.text, 'html.parser')
-                download_link = bs_obj.find('a', {'rel': 'nofollow'})
-                download_link = download_link.attrs['href']
-                download_link = urljoin(
-                    ZimukuDownloader.site_url, download_link)
-                sub_info['link'] = download_link
-            else:
-                # 射手字幕页面
-                r = s.get(sub_info['link'], timeout=60)
-                bs_obj = BeautifulSoup(r.text, 'html.parser')
-                lang_box = bs_obj.find('ul', {'class': 'subinfo'}).find('li')
-                type_score = 0
-                text = lang_box.text
-                if '英' in text:
-                    type_score += 1
-                elif '繁' in text:
-                    type_score += 2
-                elif '简' in text:
-                    type_score += 4
-                elif '双语' in text:
-                    type_score += 8
-                sub_info['lan'] = type_score
-                download_link = bs_obj.find('a', {'id': 'down1'}).attrs['href']
-                sub_info['link'] = download_link
-            backup_session = requests.session()
-            backup_session.headers.update(s.headers)
-            backup_session.headers['Referer'] = sub_info['link']
-            backup_session.cookies.update(s.cookies)
-            sub_info['session'] = backup_session
+            if sub_info['resolve'] is None:
+                del sub_info['resolve']
 
         if (len(sub_dict.items()) > 0
                 and list(sub_dict.items())[0][1]['lan'] < 8):
@@ -176,31 +176,92 @@ class ZimukuDownloader(Downloader):
         keys = list(sub_dict.keys())[:sub_num]
         return {key: sub_dict[key] for key in keys}
 
-    def download_file(self, file_name, download_link, session=None):
+    @classmethod
+    def _lang_score(cls, lang_box):
+
+        """ 由语言格中的语言图标计算语言值，没有语言格时为 0 """
+
+        type_score = 0
+        if lang_box is None:
+            return type_score
+        for lang in lang_box.find_all('img'):
+            match = cls.lang_icon.search(
+                urlparse(lang.attrs.get('src', '')).path)
+            if match:
+                type_score += cls.lang_scores.get(match.group(1), 0)
+        return type_score
+
+    @staticmethod
+    def _raise_error(r):
+        if isinstance(r, Exception):
+            raise r
+
+    @classmethod
+    def _parse_detail(cls, r, page):
+
+        """ 解析字幕详情页
+        Args:
+            page: 'detail' 综合搜索字幕页面，'shooter' 射手字幕页面
+        Return:
+            语言值, 下一步链接, 下一步链接的页面类型（下载链接为 None）
+        """
+
+        cls._raise_error(r)
+        bs_obj = parse_html(r.text, ZimukuDownloader.detail_only)
+        lang_box = bs_obj.find('ul', {'class': 'subinfo'}).find('li')
+        download_link = bs_obj.find('a', {'id': 'down1'}).attrs['href']
+        if page == 'detail':
+            type_score = cls._lang_score(lang_box)
+            download_link = urljoin(ZimukuDownloader.site_url, download_link)
+            return type_score, download_link, 'down'
+        text = lang_box.text
+        type_score = 0
+        if '英' in text:
+            type_score += 1
+        elif '繁' in text:
+            type_score += 2
+        elif '简' in text:
+            type_score += 4
+        elif '双语' in text:
+            type_score += 8
+        return type_score, download_link, None
+
+    @classmethod
+    def _parse_down_page(cls, r):
+
+        """ 解析下载页，返回字幕包下载链接 """
+
+        cls._raise_error(r)
+        bs_obj = parse_html(r.text, ZimukuDownloader.down_only)
+        download_link = bs_obj.find('a', {'rel': 'nofollow'})
+        download_link = download_link.attrs['href']
+        return urljoin(ZimukuDownloader.site_url, download_link)
+
+    def resolve(self, sub_url, page):
+
+        """ 依次获取详情页、下载页得到字幕包下载链接，解析失败返回 None """
+
+        try:
+            while page:
+                r = yield Request('GET', sub_url,
+                                  timeout=ZimukuDownloader.detail_timeout)
+                if page == 'down':
+                    sub_url, page = self._parse_down_page(r), None
+                else:
+                    _, sub_url, page = self._parse_detail(r, page)
+        except (requests.RequestException, AttributeError,
+                KeyError, TypeError):
+            return None
+        return sub_url
+
+    def fetch(self, file_name, download_link, session=None):
 
         try:
-            if not session:
-                session = requests.session()
-            with closing(session.get(download_link, stream=True)) as response:
-                filename = response.headers['Content-Disposition']
-                chunk_size = 1024  # 单次请求最大值
-                # 内容体总大小
-                content_size = int(response.headers['content-length'])
-                bar = ProgressBar(prefix + ' Get',
-                                  file_name.strip(), content_size)
-                sub_data_bytes = b''
-                for data in response.iter_content(chunk_size=chunk_size):
-                    sub_data_bytes += data
-                    bar.refresh(len(sub_data_bytes))
+            response, sub_data_bytes = yield Request(
+                'GET', download_link, download=file_name, session=session,
+                headers={'Referer': download_link})
         except requests.Timeout:
             return None, None, 'false'
-        if '.rar' in filename:
-            datatype = '.rar'
-        elif '.zip' in filename:
-            datatype = '.zip'
-        elif '.7z' in filename:
-            datatype = '.7z'
-        else:
-            datatype = 'Unknown'
+        datatype = sniff_format(sub_data_bytes) or 'Unknown'
 
         return datatype, sub_data_bytes, ''
@@ -1,15 +1,14 @@
 # coding: utf-8
 
 from collections import OrderedDict as order_dict
-from contextlib import closing
 import json
 
 import requests
-from bs4 import BeautifulSoup
-
-from getsub.downloader.downloader import Downloader
+from getsub.downloader.downloader import Downloader, Request
+from getsub.downloader.html_parser import parse_html, strainer
+from getsub.downloader.query_planner import QueryPlanner
+from getsub.archive import sniff_format
 from getsub.sys_global_var import prefix
-from getsub.progress_bar import ProgressBar
 
 
 ''' Zimuzu 字幕下载器
@@ -22,8 +21,11 @@ class ZimuzuDownloader(Downloader):
     choice_prefix = '[ZIMUZU]'
     site_url = 'http://www.rrys2019.com'
     search_url = 'http://www.rrys2019.com/search?keyword={0}&type=subtitle'
+    # 解析页面时只保留需要的节点
+    search_only = strainer('div', {'class': ['article-tab', 'search-item']})
+    detail_only = strainer('div', {'class': ['subtitle-links']})
 
-    def get_subtitles(self, video_name, sub_num=5):
+    def search(self, video_name, sub_num=5):
 
         print(prefix + ' Searching ZIMUZU...', end='\r')
 
@@ -31,14 +33,18 @@ class ZimuzuDownloader(Downloader):
         keyword = ' '.join(keywords)
 
         sub_dict = order_dict()
-        s = requests.session()
-        while True:
+        planner = QueryPlanner(ZimuzuDownloader.name, keyword, keywords)
+        while not planner.finished:
             # 当前关键字查询
-            r = s.get(ZimuzuDownloader.search_url.format(keyword),
-                      headers=Downloader.header, timeout=10)
-            bs_obj = BeautifulSoup(r.text, 'html.parser')
-            tab_text = bs_obj.find('div', {'class': 'article-tab'}).text
-            if '字幕(0)' not in tab_text:
+            batch = yield from planner.next_batch(
+                lambda query: Request(
+                    'GET', ZimuzuDownloader.search_url.format(query)))
+            for keyword, r in batch:
+                bs_obj = parse_html(r.text, ZimuzuDownloader.search_only)
+                tab_text = bs_obj.find('div', {'class': 'article-tab'}).text
+                if '字幕(0)' in tab_text:
+                    planner.empty(keyword)
+                    continue
                 for one_box in bs_obj.find_all('div',
                                                {'class': 'search-item'}):
                     sub_name = ZimuzuDownloader.choice_prefix + \
@@ -57,15 +63,11 @@ class ZimuzuDownloader(Downloader):
                     type_score += ('中英' in text) * 8
                     sub_dict[sub_name] = {'lan': type_score, 'link': sub_url, 'session': None}
                     if len(sub_dict) >= sub_num:
-                        del keywords[:]  # 字幕条数达到上限，清空keywords
+                        planner.finish()  # 字幕条数达到上限，不再查询
                         break
 
-            if len(keywords) > 1:  # 字幕数未满，更换关键词继续查询
-                keyword = keyword.replace(keywords[-1], '')
-                keywords.pop(-1)
-                continue
-
-            break
+                if planner.stopped:
+                    break
 
         # 第一个候选字幕没有双语
         if (len(sub_dict.items()) > 0
@@ -77,57 +79,23 @@ class ZimuzuDownloader(Downloader):
             )
         return sub_dict
 
-    def download_file(self, file_name, sub_url, session=None):
+    def fetch(self, file_name, sub_url, session=None):
 
-        s = requests.session()
-        header = Downloader.header.copy()
-        r = s.get(sub_url, headers=Downloader.header)
-        bs_obj = BeautifulSoup(r.text, 'html.parser')
+        r = yield Request('GET', sub_url)
+        bs_obj = parse_html(r.text, ZimuzuDownloader.detail_only)
         a = bs_obj.find('div', {'class': 'subtitle-links'}).a
         download_link = a.attrs['href']
-        header['Referer'] = download_link
         ajax_url = 'http://got001.com/api/v1/static/subtitle/detail?'
         ajax_url += download_link.split('?')[-1]
-        r = s.get(ajax_url, headers=header)
+        r = yield Request('GET', ajax_url, headers={'Referer': download_link})
         json_obj = json.loads(r.text)
         download_link = json_obj['data']['info']['file']
 
         try:
-            with closing(requests.get(download_link, stream=True)) as response:
-                chunk_size = 1024  # 单次请求最大值
-                if response.headers.get('content-length'):
-                    # 内容体总大小
-                    content_size = int(response.headers['content-length'])
-                    bar = ProgressBar(prefix + ' Get',
-                                      file_name.strip(), content_size)
-                    sub_data_bytes = b''
-                    for data in response.iter_content(chunk_size=chunk_size):
-                        sub_data_bytes += data
-                        bar.refresh(len(sub_data_bytes))
-                else:
-                    bar = ProgressBar(prefix + ' Get', file_name.strip())
-                    sub_data_bytes = b''
-                    for data in response.iter_content(chunk_size=chunk_size):
-                        sub_data_bytes += data
-                        bar.point_wait()
-                    bar.point_wait(end=True)
-            # sub_data_bytes = requests.get(download_link, timeout=10).content
+            response, sub_data_bytes = yield Request(
+                'GET', download_link, download=file_name)
         except requests.Timeout:
             return None, None
-        if 'rar' in download_link:
-            datatype = '.rar'
-        elif 'zip' in download_link:
-            datatype = '.zip'
-        elif '7z' in download_link:
-            datatype = '.7z'
-        else:
-            if '.rar' in file_name:
-                datatype = '.rar'
-            elif '.zip' in file_name:
-                datatype = '.zip'
-            elif '.7z' in file_name:
-                datatype = '.7z'
-            else:
-                datatype = 'Unknown'
+        datatype = sniff_format(sub_data_bytes) or 'Unknown'
 
         return datatype, sub_data_bytes, ''
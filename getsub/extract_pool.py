@@ -0,0 +1,108 @@
+# coding: utf-8
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from io import StringIO
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+
+import getsub.guess
+from getsub.guess import GuessCache
+from getsub.archive_backends import preference, set_preference
+
+
+''' 解压进程池
+    打开字幕包、猜测字幕与解压在独立进程中进行，不阻塞下载与搜索线程。
+    字幕包先写入临时文件，进程间只传递文件路径；子进程的输出返回后由调用线程打印。
+    调用线程在等待解压结果时阻塞，因此只在流水线模式下使用。
+'''
+
+
+_worker_ready = False
+
+
+def _init_worker(backend_order):
+    global _worker_ready
+    set_preference(backend_order)
+    if not _worker_ready:
+        # 以 fork 启动时子进程复制了父进程的解析缓存，
+        # 其锁可能正被其它线程持有，数据库连接也属于父进程，改用新的内存缓存
+        getsub.guess.guess_cache = GuessCache()
+        _worker_ready = True
+
+
+def _extract(state, method, archive_path, args, kwargs, backend_order):
+
+    """ 子进程中解压字幕包，返回 (解压方法的结果, 输出) """
+
+    from getsub.main import GetSubtitles
+
+    _init_worker(backend_order)
+    getsub = GetSubtitles.__new__(GetSubtitles)
+    getsub.__dict__.update(state)
+    output = StringIO()
+    with open(archive_path, 'rb') as f, redirect_stdout(output):
+        result = getattr(getsub, method)(*args, sub_data_b=f, **kwargs)
+    return result, output.getvalue()
+
+
+class ExtractPool(object):
+
+    def __init__(self, processes):
+        """
+        Args:
+            processes: 解压进程数
+        """
+        self.processes = processes
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                kwargs = {}
+                if sys.version_info >= (3, 7):
+                    # 父进程中有多个线程，fork 得到的子进程可能复制到被持有的锁
+                    kwargs['mp_context'] = multiprocessing.get_context('spawn')
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.processes, **kwargs)
+            return self.executor
+
+    def extract(self, state, data, args, kwargs, method='extract_subtitle'):
+
+        """ 在进程池中执行 GetSubtitles.extract_subtitle
+        Args:
+            state: 解压所需的 GetSubtitles 属性
+            data: 字幕包数据，bytes 或 DownloadBuffer
+            args, kwargs: 解压方法除 sub_data_b 外的参数
+            method: 解压方法，'extract_subtitle' 或 'extract_subtitles'
+        Return:
+            解压方法的返回值
+        """
+
+        directory = tempfile.mkdtemp(prefix='getsub-')
+        try:
+            path = os.path.join(directory, 'archive')
+            with open(path, 'wb') as f:
+                if hasattr(data, 'chunks'):
+                    for chunk in data.chunks():
+                        f.write(chunk)
+                else:
+                    f.write(data)
+            future = self._executor().submit(
+                _extract, state, method, path, args, kwargs, preference())
+            result, output = future.result()
+        finally:
+            shutil.rmtree(directory, True)
+        print(output, end='')
+        return result
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
@@ -0,0 +1,240 @@
+# coding: utf-8
+
+import os
+import re
+import atexit
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict as order_dict
+
+from guessit import guessit as _guessit
+from guessit import __version__ as guessit_version
+
+
+''' guessit 结果缓存
+    同一名称只解析一次：内存中保留最近使用的结果，可选保存到本地数据库供下次运行使用。
+    标准的 scene 命名先用正则快速解析，无法确定时再交给 guessit。
+'''
+
+
+# 快速解析支持的标签，未列出的标签一律交给 guessit
+_containers = ('mkv', 'mp4', 'avi', 'ts', 'wmv', 'mov', 'm4v', 'rmvb',
+               'flv', 'webm', 'mpg', 'srt', 'ass', 'ssa', 'sub')
+_sources = (
+    (r'WEB-?DL|WEB(?:Rip)?', 'Web'),
+    (r'Blu-?Ray|BDRip|BRRip', 'Blu-ray'),
+    (r'HDTV', 'HDTV'),
+    (r'DVDRip', 'DVD')
+)
+_services = {'AMZN': 'Amazon Prime', 'NF': 'Netflix', 'HULU': 'Hulu'}
+_others = (r'x26[45]|h\.?26[45]|HEVC|AVC|XviD|MPEG2|10bit|'
+           r'DD\+?P?(?:[25]\.[01])?|AAC(?:[25]\.[01])?|E?AC3|DTS|TrueHD|'
+           r'Atmos|FLAC|[257]\.[01]|PROPER|REPACK|INTERNAL|LIMITED|HDR')
+_tag_re = re.compile(
+    r'(?P<screen_size>(?:480|576|720|1080|2160)[pi])|'
+    + '|'.join(r'(?P<source%d>%s)' % (i, pattern)
+               for i, (pattern, _) in enumerate(_sources)) + '|'
+    r'(?P<other>%s)' % _others, re.I)
+_service_re = re.compile('|'.join(_services))
+_episode_re = re.compile(r'S(\d{1,2})E(\d{1,3})$', re.I)
+_year_re = re.compile(r'(?:19|20)\d{2}$')
+_split_tag_re = re.compile(r'h|(?:DD\+?P?|AAC|TrueHD)?[257]', re.I)
+# 标题中出现时 guessit 可能另作解释的词
+_risky_words = {
+    'extended', 'uncut', 'remastered', 'proper', 'repack', 'complete',
+    'season', 'episode', 'part', 'vol', 'dubbed', 'subbed', 'multi',
+    'english', 'french', 'german', 'spanish', 'italian', 'japanese',
+    'chinese', 'korean', 'russian', 'final', 'special', 'web', 'hdtv'
+}
+
+
+def _parse_tag(token):
+    """ 解析单个标签，返回 (字段, 值)，未知标签返回 None """
+
+    if _service_re.fullmatch(token):
+        return 'streaming_service', _services[token]
+    match = _tag_re.fullmatch(token)
+    if not match:
+        return None
+    if match.group('screen_size'):
+        return 'screen_size', token.lower()
+    for i, (_, source) in enumerate(_sources):
+        if match.group('source%d' % i):
+            return 'source', source
+    return 'other', None
+
+
+def parse_release(name):
+
+    """ 快速解析标准 scene 命名，如
+        Show.S01E01.1080p.WEB-DL.DDP5.1.H.264-GRP.mkv
+        Movie.2016.1080p.BluRay.x264-GRP.mkv
+    Return:
+        含 title, season, episode, year, type, source, release_group,
+        screen_size, streaming_service 中已识别字段的字典；
+        命名不标准或可能有歧义时返回 None
+    """
+
+    if not re.fullmatch(r'[A-Za-z0-9.+-]+', name):
+        return None
+    stem, _, ext = name.rpartition('.')
+    if ext.lower() not in _containers:
+        stem = name
+    match = re.fullmatch(r'(.+)-([A-Za-z0-9]{2,})', stem)
+    if not match:
+        return None
+    body, group = match.groups()
+    # 合并被 '.' 分开的 H.264 / DDP5.1 / 7.1 等标签
+    tokens = []
+    for token in body.split('.'):
+        if tokens and token.isdigit() and _split_tag_re.fullmatch(tokens[-1]):
+            tokens[-1] += '.' + token
+        else:
+            tokens.append(token)
+
+    if tokens[-1].upper() == 'DTS':
+        return None  # guessit 将 DTS-GRP 整体作为发布组
+
+    info = {}
+    for i, token in enumerate(tokens):
+        episode = _episode_re.match(token)
+        if episode:
+            info['season'] = int(episode.group(1))
+            info['episode'] = int(episode.group(2))
+            info['type'] = 'episode'
+            break
+        if _year_re.match(token):
+            info['year'] = int(token)
+            info['type'] = 'movie'
+            break
+    else:
+        return None
+
+    title_words = tokens[:i]
+    if not title_words:
+        return None
+    for word in title_words:
+        if not word.isalpha() or word.lower() in _risky_words \
+                or (word.isupper() and len(word) <= 3) \
+                or _parse_tag(word):
+            return None
+    info['title'] = ' '.join(title_words)
+
+    rest = tokens[i + 1:]
+    if info['type'] == 'episode':
+        # 剧集名，到第一个标签为止
+        while rest and not _parse_tag(rest[0]):
+            if not rest[0].isalpha() or rest[0].lower() in _risky_words:
+                return None
+            rest = rest[1:]
+    for token in rest:
+        tag = _parse_tag(token)
+        if tag is None:
+            return None
+        field, value = tag
+        if field == 'other':
+            continue
+        if field in info:
+            return None
+        info[field] = value
+    info['release_group'] = group
+    return info
+
+
+class GuessCache(object):
+
+    def __init__(self, max_size=4096):
+        """
+        Args:
+            max_size: 内存中保留的结果数
+        """
+        self.max_size = max_size
+        self.results = order_dict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fast = 0  # 未命中缓存时由快速解析得到结果的次数
+        self.conn = None
+        self.pending = []  # 尚未写入数据库的结果
+
+    def open(self, path):
+        """ 使用本地数据库保存解析结果 """
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self.lock:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            with self.conn:
+                self.conn.execute(
+                    'CREATE TABLE IF NOT EXISTS guess ('
+                    'name TEXT, version TEXT, value BLOB, '
+                    'PRIMARY KEY (name, version))')
+        atexit.register(self.close)
+
+    def guess(self, name):
+
+        """ 解析名称，返回 guessit 结果的副本 """
+
+        with self.lock:
+            result = self.results.get(name)
+            if result is not None:
+                self.results.move_to_end(name)
+                self.hits += 1
+                return order_dict(result)
+            if self.conn is not None:
+                row = self.conn.execute(
+                    'SELECT value FROM guess WHERE name=? AND version=?',
+                    (name, guessit_version)).fetchone()
+                if row is not None:
+                    result = pickle.loads(row[0])
+                    self._remember(name, result)
+                    self.hits += 1
+                    return order_dict(result)
+            self.misses += 1
+
+        result = parse_release(name)
+        if result is not None:
+            self.fast += 1
+            result = order_dict(result)
+        else:
+            result = order_dict(_guessit(name))
+        with self.lock:
+            self._remember(name, result)
+            if self.conn is not None:
+                self.pending.append(
+                    (name, guessit_version, pickle.dumps(result)))
+                if len(self.pending) >= 100:
+                    self._flush()
+        return order_dict(result)
+
+    def _remember(self, name, result):
+        self.results[name] = result
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+    def _flush(self):
+        if self.pending:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO guess VALUES (?, ?, ?)',
+                    self.pending)
+            self.pending = []
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self._flush()
+                self.conn.close()
+                self.conn = None
+
+
+guess_cache = GuessCache()
+
+
+def guessit(name):
+
+    """ 带缓存的 guessit """
+
+    return guess_cache.guess(name)
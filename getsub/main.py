@@ -3,22 +3,40 @@
 import os
 import re
 import sys
+import time
+import shutil
+import threading
 import zipfile
 import rarfile
 import argparse
 from io import BytesIO
 from collections import OrderedDict as order_dict
 from traceback import format_exc
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
 import chardet
-from guessit import guessit
 from requests import exceptions
 from requests.utils import quote
 
+from getsub.guess import guessit, guess_cache
 from getsub.__version__ import __version__
 from getsub.sys_global_var import prefix
-from getsub.py7z import Py7z
+from getsub.archive import ArchiveIndex, open_archive, sniff_format
+from getsub.archive_backends import ArchiveError, DEFAULT_ORDER
+from getsub.archive_backends import set_preference
+from getsub.extract_pool import ExtractPool
+from getsub.scan import DirectoryScanner, subtitle_stems, list_dir
+from getsub.watch import Inotify, VideoWatcher
+from getsub.season import SeasonSearch, SeasonPacks
 from getsub.downloader import DownloaderManager
+from getsub.downloader.downloader import Downloader, RequestStats
+from getsub.downloader.downloader import SearchCancelled
+from getsub.cache import SearchCache, ArchiveStore, HTTPCache, NegativeCache
+from getsub.cache import LibraryState
+from getsub.cache import default_cache_dir
+from getsub.pipeline import Pipeline, VideoTask
+from getsub.pipeline import parse_stage_jobs, propagate_output
 
 
 class GetSubtitles(object):
@@ -29,7 +47,13 @@ class GetSubtitles(object):
         output_encode = 'utf8'
 
     def __init__(self, name, query, single,
-                 more, both, over, plex, debug, sub_num, downloader, sub_path):
+                 more, both, over, plex, debug, sub_num, downloader, sub_path,
+                 jobs=None, stage_jobs=None, search_timeout=None,
+                 cache_dir=None, cache_ttl=24, negative_ttl=1, refresh=False,
+                 archive_cache_size=200, archive_backends=None,
+                 extract_procs=None, scan_jobs=None, stream=False,
+                 retry_backoff=24, watch=False, season_search=True,
+                 season_packs=True):
         self.video_format_list = ['.webm', '.mkv', '.flv', '.vob', '.ogv',
                                   '.ogg', '.drc', '.gif', '.gifv', '.mng',
                                   '.avi', '.mov', '.qt', '.wmv', '.yuv',
@@ -39,9 +63,21 @@ class GetSubtitles(object):
                                   '.3gp', '.3g2', '.mxf', '.roq', '.nsv',
                                   '.flv', '.f4v', '.f4p', '.f4a', '.f4b']
         self.sub_format_list = ['.ass', '.srt', '.ssa', '.sub']
-        self.support_file_list = ['.zip', '.rar', '.7z']
+        self.support_file_list = ['.zip', '.rar', '.7z', '.gz']
         self.arg_name = name
         self.sub_store_path = sub_path
+        self.scan_jobs = scan_jobs  # 同时列出目录的线程数
+        self.stream = stream  # 边扫描边处理视频
+        self.watch = watch  # 监视文件夹，处理新写入的视频
+        self.group_seasons = season_search  # 同一季的视频按季搜索
+        self.season_search = None
+        self.reuse_packs = season_packs  # 季包中的字幕一并解压给同一季的其它视频
+        self.season_packs = None
+        self.watcher = None
+        if watch and not (os.path.isdir(name.replace('"', ''))
+                          and Inotify.available()):
+            print('\n--watch needs a folder and inotify (Linux)\n')
+            sys.exit(1)
         self.both = both
         self.query, self.single = query, single
         self.more, self.over = more, over
@@ -63,45 +99,88 @@ class GetSubtitles(object):
             self.downloader = [
                 DownloaderManager.get_downloader_by_name(downloader)]
         self.failed_list = []  # [{'name', 'path', 'error', 'trace_back'}
+        self.search_requests = 0  # 搜索请求总数
+        self.skipped = 0  # 未到重试时间而跳过的视频数
+        self.start_time = None
+        self.first_subtitle = None  # 开始运行到解压出第一个字幕的秒数
+        self.search_timeout = search_timeout  # 单次搜索时限（秒）
+        self.refresh = refresh  # 忽略缓存的搜索结果
+        self.search_cache = None
+        if cache_dir and cache_ttl:
+            self.search_cache = SearchCache(
+                os.path.join(cache_dir, 'search.sqlite'),
+                ttl=float(cache_ttl) * 3600)
+        if cache_dir:
+            # 下载器共享连接层的网页缓存
+            Downloader.transport.cache = HTTPCache(
+                os.path.join(cache_dir, 'http.sqlite'))
+            guess_cache.open(os.path.join(cache_dir, 'guess.sqlite'))
+            # 没有结果的查询可能很快就有字幕，记录的有效时间远短于搜索结果
+            Downloader.negative_cache = NegativeCache(
+                os.path.join(cache_dir, 'negative.sqlite'),
+                ttl=float(negative_ttl) * 3600)
+            if refresh:
+                Downloader.negative_cache.clear()
+        self.library_state = None  # 各视频上次的处理结果
+        if cache_dir and retry_backoff:
+            self.library_state = LibraryState(
+                os.path.join(cache_dir, 'library.sqlite'),
+                backoff=float(retry_backoff) * 3600)
+        self.archive_store = None
+        if cache_dir and archive_cache_size:
+            self.archive_store = ArchiveStore(
+                os.path.join(cache_dir, 'archives'),
+                max_size=int(float(archive_cache_size) * 1024 * 1024))
+        self.workers = None  # 流水线模式各阶段线程数
+        if jobs or stage_jobs:
+            try:
+                self.workers = parse_stage_jobs(int(jobs or 1), stage_jobs)
+            except ValueError as e:
+                print('\n' + str(e) + '\n')
+                sys.exit(1)
+        self.extract_pool = None  # 解压进程池
+        if extract_procs and not self.workers:
+            # 非流水线模式下解压时仍需等待，解压进程池只增加进程间传递的开销
+            print("\n'--extract-procs' only takes effect with '-j' "
+                  "or '--stage-jobs'\n")
+        elif extract_procs:
+            self.extract_pool = ExtractPool(extract_procs)
+            if 'extract=' not in (stage_jobs or ''):
+                # 解压阶段线程数与进程数一致，使各视频的解压同时进行
+                self.workers['extract'] = max(self.workers['extract'],
+                                              extract_procs)
+        if archive_backends:
+            # 解压后端优先顺序，如 '7z,libarchive'
+            try:
+                set_preference([name.strip() for name
+                                in archive_backends.split(',') if name.strip()])
+            except ValueError as e:
+                print('\n' + str(e) + '\n')
+                sys.exit(1)
 
     def get_path_name(self, args, args1):
         """ 传入输入的视频名称或路径,
             构造一个包含视频路径和是否存在字幕信息的字典返回。
-            video_dict: {'path': path, 'have_subtitle': sub_exists} """
+            video_dict: {'path': path, 'have_subtitle': sub_exists,
+                         'file': 视频文件路径，只有视频名时不存在} """
+
+        return order_dict(self.iter_path_name(args, args1))
+
+    def iter_path_name(self, args, args1, store=None):
+        """ get_path_name 的生成器版本，边扫描边产出 (视频名, 视频信息)，
+            不同文件夹中的同名视频分别产出；
+            store 为已得到的 store_index(args1) 结果，默认重新扫描 """
 
         mix_str = args.replace('"', '')
-        if args1:
-            store_path = args1.replace('"', '')
-        else:
-            store_path = ''
-        store_path_files = []
-        if not os.path.isdir(store_path):
-            print('no valid path specfied,download sub file to video file location.')
-            store_path = ''
-        else:
-            for root, dirs, files in os.walk(store_path):
-                store_path_files.extend(files)
-        video_dict = order_dict()
+        if store is None:
+            store = self.store_index(args1)
+        store_path, store_stems = store
         if os.path.isdir(mix_str):  # 一个文件夹
-            for root, dirs, files in os.walk(mix_str):
-                for one_name in files:
-                    suffix = os.path.splitext(one_name)[1]
-                    # 检查后缀是否为视频格式
-                    if suffix not in self.video_format_list:
-                        continue
-                    v_name_no_format = os.path.splitext(one_name)[0]
-                    sub_exists = max(
-                        list(
-                            map(
-                                lambda sub_type:
-                                    int(v_name_no_format + sub_type in files + store_path_files
-                                        or v_name_no_format + '.zh' + sub_type in files + store_path_files),
-                                    self.sub_format_list
-                            )
-                        )
-                    )
-                    video_dict[one_name] = {'path': next(item for item in [store_path, os.path.abspath(root)] if item != ''),
-                                            'have_subtitle': sub_exists}
+            scanner = DirectoryScanner(self.scan_jobs)
+            for root, files in scanner.walk(mix_str):
+                for video in self.dir_videos(root, files,
+                                             store_path, store_stems):
+                    yield video
 
         elif os.path.isabs(mix_str):  # 视频绝对路径
             v_path, v_name = os.path.split(mix_str)
@@ -121,20 +200,81 @@ class GetSubtitles(object):
                     )
                 )
             )
-            video_dict[v_name] = {'path': s_path,
-                                  'have_subtitle': sub_exists}
+            yield v_name, {'path': s_path, 'have_subtitle': sub_exists,
+                           'file': mix_str}
         else:  # 单个视频名字，无路径
             if not os.path.isdir(store_path):
-                video_dict[mix_str] = {'path': os.getcwd(), 'have_subtitle': 0}
+                yield mix_str, {'path': os.getcwd(), 'have_subtitle': 0}
             else:
-                video_dict[mix_str] = {'path': os.path.abspath(
-                    store_path), 'have_subtitle': 0}
-        return video_dict
+                yield mix_str, {'path': os.path.abspath(store_path),
+                                'have_subtitle': 0}
+
+    def store_index(self, args1):
+        """ 返回字幕存放目录及其中已有字幕的文件名集合，
+            未指定或不是文件夹时为 ('', 空集合) """
+
+        if args1:
+            store_path = args1.replace('"', '')
+        else:
+            store_path = ''
+        if not os.path.isdir(store_path):
+            print('no valid path specfied,download sub file to video file location.')
+            return '', set()
+        scanner = DirectoryScanner(self.scan_jobs)
+        return store_path, scanner.subtitle_index(
+            store_path, self.sub_format_list)
+
+    def dir_videos(self, root, files, store_path, store_stems, names=None):
+        """ 产出目录中视频的 (视频名, 视频信息)
+            Args:
+                files: 目录中的全部文件名，用于判断是否已有字幕
+                names: 只产出这些视频，默认为 files 中的全部视频 """
+
+        stems = None
+        for one_name in files if names is None else names:
+            v_name_no_format, suffix = os.path.splitext(one_name)
+            # 检查后缀是否为视频格式
+            if suffix not in self.video_format_list:
+                continue
+            if stems is None:
+                stems = subtitle_stems(files, self.sub_format_list)
+            sub_exists = int(v_name_no_format in stems
+                             or v_name_no_format in store_stems)
+            yield one_name, {
+                'path': store_path or os.path.abspath(root),
+                'have_subtitle': sub_exists,
+                'file': os.path.abspath(os.path.join(root, one_name))}
+
+    def watch_path_name(self, args, args1):
+        """ 监视文件夹，先产出已有的视频，之后产出新写入或移入的视频，
+            直到 self.watcher.stop() 或 Ctrl-C """
+
+        mix_str = args.replace('"', '')
+        # 先开始监视，扫描期间写入的视频不会遗漏
+        self.watcher = VideoWatcher(mix_str, self.video_format_list,
+                                    self.scan_jobs)
+        store_path, store_stems = self.store_index(args1)
+        seen = {}  # {视频文件路径: (大小, 修改时间)}，避免重复处理
+        for name, info in self.iter_path_name(
+                mix_str, args1, (store_path, store_stems)):
+            seen[info['file']] = LibraryState.stat(info['file'])
+            yield name, info
+        for path in self.watcher:
+            stat = LibraryState.stat(path)
+            if stat is None or seen.get(path) == stat:
+                continue
+            seen[path] = stat
+            root, name = os.path.split(path)
+            files, _ = list_dir(root)
+            for video in self.dir_videos(root, files, store_path,
+                                         store_stems, names=[name]):
+                yield video
 
     def choose_subtitle(self, sub_dict):
         """ 传入候选字幕字典
             若为查询模式返回选择的字幕包名称，字幕包下载地址
-            否则返回字幕字典第一个字幕包的名称，字幕包下载地址 """
+            否则返回字幕字典第一个字幕包的名称，字幕包下载地址
+            下载地址尚未解析时同时返回其页面类型，否则为 None """
 
         exit = False
 
@@ -142,7 +282,8 @@ class GetSubtitles(object):
             chosen_sub = list(sub_dict.keys())[0]
             link = sub_dict[chosen_sub]['link']
             session = sub_dict[chosen_sub].get('session', None)
-            return exit, [[chosen_sub, link, session]]
+            page = sub_dict[chosen_sub].get('resolve', None)
+            return exit, [[chosen_sub, link, session, page]]
 
         print(prefix, '%3s)  Exit. Not downloading any subtitles.' % 0)
         for i, key in enumerate(sub_dict.keys()):
@@ -180,7 +321,8 @@ class GetSubtitles(object):
                     chosen_sub = list(sub_dict.keys())[choice - 1]
                     link = sub_dict[chosen_sub]['link']
                     session = sub_dict[chosen_sub].get('session', None)
-                    chosen_subs.append([chosen_sub, link, session])
+                    page = sub_dict[chosen_sub].get('resolve', None)
+                    chosen_subs.append([chosen_sub, link, session, page])
         return exit, chosen_subs
 
     def guess_subtitle(self, sublist, video_info):
@@ -206,12 +348,6 @@ class GetSubtitles(object):
                 continue
 
             one_sub = os.path.split(one_sub)[-1]  # 提取文件名
-            try:
-                # zipfile:/Lib/zipfile.py:1211 Historical ZIP filename encoding
-                # try cp437 encoding
-                one_sub = one_sub.encode('cp437').decode('gbk')
-            except:
-                pass
             sub_name_info = guessit(one_sub)
             if sub_name_info.get('title'):
                 sub_title = sub_name_info['title'].lower()
@@ -256,148 +392,252 @@ class GetSubtitles(object):
         return sublist[max_pos]
 
     def get_file_list(self, file_handler):
-        """ 传入一个压缩文件控制对象，读取对应压缩文件内文件列表。
-            返回 {one_sub: file_handler} """
+        """ 传入一个压缩文件控制对象，返回压缩包内文件索引 ArchiveIndex。
+            嵌套的压缩包在选中时才解压 """
+
+        return ArchiveIndex(file_handler, self.sub_format_list,
+                            self.support_file_list)
+
+    def choose_archive_entry(self, index, v_info_d, single):
+        """ 在字幕包索引中选择字幕，返回 ArchiveEntry，无最佳猜测返回 None。
+            自动模式下嵌套压缩包与字幕一起按名称打分，选中压缩包时进入其中继续选择；
+            没有符合的名称时（包括进入嵌套压缩包后）展开字幕包中所有嵌套压缩包，
+            在全部字幕中选择。 """
+
+        root = index
+        while True:
+            entries = index.subtitles + index.archives
+            if not single:
+                names = [entry.display_name for entry in entries]
+                sub_name = self.guess_subtitle(names, v_info_d)
+                if sub_name is None:
+                    if index is root and not index.archives:
+                        return None
+                    entries = root.all_subtitles()
+                    names = [entry.display_path for entry in entries]
+                    sub_name = self.guess_subtitle(names, v_info_d)
+                    if sub_name is None:
+                        return None
+                    return entries[names.index(sub_name)]
+                entry = entries[names.index(sub_name)]
+            else:
+                print(prefix)
+                for i, entry in enumerate(entries):
+                    single_subtitle = entry.display_name.split('/')[-1]
+                    if entry in index.archives:
+                        single_subtitle += '/'  # 嵌套的压缩包
+                    info = ' %3s)  %s' % (str(i+1), single_subtitle)
+                    print(prefix + info)
+
+                indexes = range(len(entries))
+                choice = None
+                while not choice:
+                    try:
+                        print(prefix)
+                        choice = int(input(prefix + '  choose subtitle: '))
+                    except ValueError:
+                        print(prefix + '  Error: only numbers accepted')
+                        continue
+                    if not choice - 1 in indexes:
+                        print(prefix + '  Error: numbers not within the range')
+                        choice = None
+                entry = entries[choice - 1]
 
-        sub_lists_dict = dict()
-        for one_file in file_handler.namelist():
+            if entry in index.subtitles:
+                return entry
+            index = index.expand(entry)
 
-            if one_file[-1] == '/':
-                continue
-            if os.path.splitext(one_file)[-1] in self.sub_format_list:
-                sub_lists_dict[one_file] = file_handler
-                continue
+    def open_index(self, archive_name, datatype, sub_data_b):
+        """ 打开下载好的字幕包，返回字幕包索引 ArchiveIndex """
 
-            if os.path.splitext(one_file)[-1] in self.support_file_list:
-                sub_buff = BytesIO(file_handler.read(one_file))
-                datatype = os.path.splitext(one_file)[-1]
-                if datatype == '.zip':
-                    sub_file_handler = zipfile.ZipFile(sub_buff, mode='r')
-                elif datatype == '.rar':
-                    sub_file_handler = rarfile.RarFile(sub_buff, mode='r')
-                elif datatype == '.7z':
-                    sub_file_handler = Py7z(sub_buff)
-                sub_lists_dict.update(self.get_file_list(sub_file_handler))
+        if hasattr(sub_data_b, 'seek'):
+            # 下载得到的 DownloadBuffer 可直接读取
+            sub_buff = sub_data_b
+        else:
+            sub_buff = BytesIO(sub_data_b)
 
-        return sub_lists_dict
+        file_handler = open_archive(sub_buff, datatype,
+                                    archive_name[archive_name.find(']') + 1:])
+        return self.get_file_list(file_handler)
 
     def extract_subtitle(self, v_name, v_path, archive_name,
                          datatype, sub_data_b, rename,
-                         single, both, plex, delete=True):
+                         single, both, plex, delete=True, v_info_d=None):
         """ 接受下载好的字幕包字节数据， 猜测字幕并解压。 """
 
-        v_info_d = guessit(v_name)
+        if v_info_d is None:
+            v_info_d = guessit(v_name)
 
-        sub_buff = BytesIO()
-        sub_buff.write(sub_data_b)
+        index = self.open_index(archive_name, datatype, sub_data_b)
+        entry = self.choose_archive_entry(index, v_info_d, single)
+        if entry is None:  # 自动模式下无最佳猜测
+            return None
 
-        if datatype == '.7z':
-            try:
-                sub_buff.seek(0)
-                file_handler = Py7z(sub_buff)
-            except:
-                # try with zipfile
-                datatype = '.zip'
-        if datatype == '.zip':
-            try:
-                sub_buff.seek(0)
-                file_handler = zipfile.ZipFile(sub_buff, mode='r')
-            except:
-                # try with rarfile
-                datatype = '.rar'
-        if datatype == '.rar':
-            sub_buff.seek(0)
-            file_handler = rarfile.RarFile(sub_buff, mode='r')
-
-        sub_lists_dict = dict()
-        sub_lists_dict.update(self.get_file_list(file_handler))
-
-        # sub_lists = [x for x in file_handler.namelist() if x[-1] != '/']
-
-        if not single:
-            sub_name = self.guess_subtitle(
-                list(sub_lists_dict.keys()), v_info_d)
-        else:
-            print(prefix)
-            for i, single_subtitle in enumerate(sub_lists_dict.keys()):
-                single_subtitle = single_subtitle.split('/')[-1]
-                try:
-                    # zipfile: Historical ZIP filename encoding
-                    # try cp437 encoding
-                    single_subtitle = single_subtitle.\
-                        encode('cp437').decode('gbk')
-                except:
-                    pass
-                info = ' %3s)  %s' % (str(i+1), single_subtitle)
-                print(prefix + info)
-
-            indexes = range(len(sub_lists_dict.keys()))
-            choice = None
-            while not choice:
-                try:
-                    print(prefix)
-                    choice = int(input(prefix + '  choose subtitle: '))
-                except ValueError:
-                    print(prefix + '  Error: only numbers accepted')
-                    continue
-                if not choice - 1 in indexes:
-                    print(prefix + '  Error: numbers not within the range')
-                    choice = None
-            sub_name = list(sub_lists_dict.keys())[choice - 1]
+        return self.save_subtitles(
+            [(v_name, v_path, entry)], archive_name, datatype, sub_data_b,
+            rename, both, plex, delete)[0]
 
-        if not sub_name:  # 自动模式下无最佳猜测
-            return None
+    def extract_subtitles(self, videos, archive_name, datatype, sub_data_b,
+                          both, plex):
+        """ 自动模式下从同一字幕包（如季包）中为多个视频猜测并解压字幕，
+            字幕包只打开一次，选中的字幕一次读取
 
-        os.chdir(v_path)  # 切换到视频所在文件夹
-
-        v_name_without_format = os.path.splitext(v_name)[0]
-        # video_name + sub_type
-        to_extract_types = []
-        sub_title, sub_type = os.path.splitext(sub_name)
-        to_extract_subs = [[sub_name, sub_type]]
-        if both:
-            another_sub_type = '.srt' if sub_type == '.ass' else '.ass'
-            another_sub = sub_name.replace(sub_type, another_sub_type)
-            if another_sub in list(sub_lists_dict.keys()):
-                to_extract_subs.append([another_sub, another_sub_type])
-            else:
-                print(prefix +
-                      ' no %s subtitles in this archive' % another_sub_type)
-
-        if delete:
-            for one_sub_type in self.sub_format_list:  # 删除若已经存在的字幕
-                if os.path.exists(v_name_without_format + one_sub_type):
-                    os.remove(v_name_without_format + one_sub_type)
-                if os.path.exists(v_name_without_format + '.zh' + one_sub_type):
-                    os.remove(v_name_without_format + '.zh' + one_sub_type)
-
-        for one_sub, one_sub_type in to_extract_subs:
-            if rename:
-                if plex:
-                    sub_new_name = v_name_without_format + '.zh' + one_sub_type
+            Args:
+                videos: [(视频名, 视频所在文件夹, guessit 结果)]
+            Return:
+                各视频的解压结果，同 extract_subtitle，无最佳猜测为 None
+        """
+
+        index = self.open_index(archive_name, datatype, sub_data_b)
+        positions, chosen = [], []
+        for i, (v_name, v_path, v_info_d) in enumerate(videos):
+            entry = self.choose_archive_entry(index, v_info_d, False)
+            if entry is not None:
+                positions.append(i)
+                chosen.append((v_name, v_path, entry))
+        results = [None] * len(videos)
+        saved = self.save_subtitles(chosen, archive_name, datatype,
+                                    sub_data_b, True, both, plex, True)
+        for i, result in zip(positions, saved):
+            results[i] = result
+        return results
+
+    def save_subtitles(self, chosen, archive_name, datatype, sub_data_b,
+                       rename, both, plex, delete):
+        """ 保存各视频选中的字幕，同一压缩包中的字幕一次读取
+
+            Args:
+                chosen: [(视频名, 视频所在文件夹, 选中的 ArchiveEntry)]
+            Return:
+                各视频的 [[字幕名, 字幕后缀, 保存的字幕文件路径]]
+        """
+
+        to_extract = []
+        for v_name, v_path, entry in chosen:
+            sub_name = entry.name
+            # 字幕保存在视频所在文件夹
+            v_name_without_format = os.path.join(
+                v_path, os.path.splitext(v_name)[0])
+            # video_name + sub_type
+            sub_title, sub_type = os.path.splitext(sub_name)
+            to_extract_subs = [[entry, sub_type]]
+            if both:
+                another_sub_type = '.srt' if sub_type == '.ass' else '.ass'
+                another_sub = sub_name.replace(sub_type, another_sub_type)
+                another_entry = entry.index.get(another_sub)
+                if another_entry is not None:
+                    to_extract_subs.append([another_entry, another_sub_type])
                 else:
-                    sub_new_name = v_name_without_format + one_sub_type
-            else:
-                sub_new_name = one_sub
-            with open(sub_new_name, 'wb') as sub:  # 保存字幕
-                file_handler = sub_lists_dict[one_sub]
-                sub.write(file_handler.read(one_sub))
-
-        if self.more:  # 保存原字幕压缩包
-            if rename:
-                archive_new_name = v_name_without_format + datatype
-            else:
-                archive_new_name = archive_name + datatype
-            with open(archive_new_name, 'wb') as f:
-                f.write(sub_data_b)
-            print(prefix + ' save original file.')
+                    print(prefix +
+                          ' no %s subtitles in this archive' % another_sub_type)
+
+            if delete:
+                for one_sub_type in self.sub_format_list:  # 删除若已经存在的字幕
+                    if os.path.exists(v_name_without_format + one_sub_type):
+                        os.remove(v_name_without_format + one_sub_type)
+                    if os.path.exists(v_name_without_format + '.zh' + one_sub_type):
+                        os.remove(v_name_without_format + '.zh' + one_sub_type)
+            to_extract.append((v_path, v_name_without_format, to_extract_subs))
+
+        # 要保存的字幕按所在压缩包分组，每个压缩包一次读取
+        indexes, members = [], []
+        for _, _, to_extract_subs in to_extract:
+            for one_sub, _ in to_extract_subs:
+                if one_sub.index not in indexes:
+                    indexes.append(one_sub.index)
+                    members.append([])
+                group = members[indexes.index(one_sub.index)]
+                if one_sub not in group:
+                    group.append(one_sub)
+        sub_data = [index.read(group) for index, group in zip(indexes, members)]
+
+        results = []
+        for v_path, v_name_without_format, to_extract_subs in to_extract:
+            saved = []
+            for one_sub, one_sub_type in to_extract_subs:
+                if rename:
+                    if plex:
+                        sub_new_name = v_name_without_format + '.zh' + one_sub_type
+                    else:
+                        sub_new_name = v_name_without_format + one_sub_type
+                else:
+                    sub_new_name = os.path.join(v_path, one_sub.name)
+                data = sub_data[indexes.index(one_sub.index)][one_sub.name]
+                with open(sub_new_name, 'wb') as sub:  # 保存字幕
+                    sub.write(data)
+                saved.append([one_sub.display_name, one_sub_type,
+                              sub_new_name])
+
+            if self.more:  # 保存原字幕压缩包
+                if rename:
+                    archive_new_name = v_name_without_format + datatype
+                else:
+                    archive_new_name = os.path.join(
+                        v_path, archive_name + datatype)
+                with open(archive_new_name, 'wb') as f:
+                    if hasattr(sub_data_b, 'chunks'):
+                        for chunk in sub_data_b.chunks():
+                            f.write(chunk)
+                    elif hasattr(sub_data_b, 'read'):
+                        sub_data_b.seek(0)
+                        shutil.copyfileobj(sub_data_b, f)
+                    else:
+                        f.write(sub_data_b)
+                print(prefix + ' save original file.')
+
+            results.append(saved)
+        return results
+
+    def extract_state(self):
+        """ 解压进程中 extract_subtitle 需要的属性 """
 
-        return to_extract_subs
+        return {
+            'sub_format_list': self.sub_format_list,
+            'support_file_list': self.support_file_list,
+            'more': self.more,
+            'query': self.query
+        }
+
+    def download_archive(self, sub_choice, link, session, page=None):
+        """ 根据候选字幕名前缀选择下载器下载字幕包，
+            page 不为 None 时先由下载器解析出下载链接
+
+            Return:
+                datatype, sub_data_bytes, err_msg
+        """
+        choice_prefix = sub_choice[:sub_choice.find(']') + 1]
+        downloader = DownloaderManager.get_downloader_by_choice_prefix(
+            choice_prefix)
+        site = downloader.__class__.name
+        if self.archive_store:
+            archive = self.archive_store.get(site, link)
+            if archive is not None:
+                print(prefix + ' Get cached archive')
+                return archive[0], archive[1], ''
+        download_link = link
+        if page is not None:
+            download_link = downloader.resolve_link(link, page)
+            if download_link is None:
+                return None, None, 'failed to resolve download link'
+        datatype, sub_data_bytes, err_msg = downloader.download_file(
+            sub_choice, download_link, session=session)
+        if self.archive_store and not err_msg and sub_data_bytes:
+            # 只保存可识别的字幕包，错误页面、验证页面等下次重新下载
+            stored_type = sniff_format(sub_data_bytes)
+            if stored_type in self.support_file_list \
+                    or stored_type in self.sub_format_list:
+                self.archive_store.put(site, link, stored_type, sub_data_bytes)
+        return datatype, sub_data_bytes, err_msg
 
     def process_archive(self, one_video, video_info,
-                        sub_choice, link, session, rename=True, delete=True):
+                        sub_choice, link, session, rename=True, delete=True,
+                        archive=None, v_info_d=None, page=None):
         """ 解压字幕包，返回字幕包中字幕名列表
 
+            Args:
+                archive: 预先下载好的字幕包 (datatype, sub_data_bytes, err_msg)，
+                         为 None 时现场下载
+                page: 下载地址尚未解析时为其页面类型，见 choose_subtitle
             Return:
                 message: str, 无其它错误则为空
                 extract_sub_names: list
@@ -405,34 +645,53 @@ class GetSubtitles(object):
         message = ''
         if self.query:
             print(prefix + ' ')
-        choice_prefix = sub_choice[:sub_choice.find(']') + 1]
-        datatype, sub_data_bytes, err_msg = DownloaderManager.get_downloader_by_choice_prefix(
-            choice_prefix).download_file(sub_choice, link, session=session)
+        if archive is None:
+            archive = self.download_archive(sub_choice, link, session, page)
+        elif isinstance(archive, Exception):
+            raise archive
+        datatype, sub_data_bytes, err_msg = archive
         if err_msg:
             return err_msg, None
         extract_sub_names = []
-        if datatype not in self.support_file_list:
+        datatype = sniff_format(sub_data_bytes) or datatype
+        if datatype not in self.support_file_list \
+                and datatype not in self.sub_format_list:
             # 不支持的压缩包类型
             message = 'unsupported file type ' + datatype
             return message, None
         # 获得猜测字幕名称
         # 查询模式必有返回值，自动模式无猜测值返回None
-        extract_sub_names = self.extract_subtitle(
-            one_video, video_info['path'],
-            sub_choice, datatype, sub_data_bytes,
-            rename, self.single, self.both, self.plex, delete=delete
-        )
+        others = []  # 同一季尚未开始解压的其它视频
+        if self.season_packs and rename:
+            others = self.season_packs.borrow(one_video, video_info)
+        try:
+            if others:
+                extract_sub_names = self.extract_season_pack(
+                    one_video, video_info, others, sub_choice, link,
+                    datatype, sub_data_bytes, v_info_d=v_info_d)
+            elif self.extract_pool and not self.single:
+                # 在解压进程中猜测字幕并解压
+                if v_info_d is None:
+                    v_info_d = guessit(one_video)
+                extract_sub_names = self.extract_pool.extract(
+                    self.extract_state(), sub_data_bytes,
+                    (one_video, video_info['path'], sub_choice, datatype),
+                    dict(rename=rename, single=False, both=self.both,
+                         plex=self.plex, delete=delete, v_info_d=v_info_d))
+            else:
+                extract_sub_names = self.extract_subtitle(
+                    one_video, video_info['path'],
+                    sub_choice, datatype, sub_data_bytes,
+                    rename, self.single, self.both, self.plex, delete=delete,
+                    v_info_d=v_info_d
+                )
+        finally:
+            if others:
+                self.season_packs.release(others)
         if not extract_sub_names:
             return message, None
-        for extract_sub_name, extract_sub_type in extract_sub_names:
+        for extract_sub_name, extract_sub_type, _ in extract_sub_names:
             extract_sub_name = extract_sub_name.split('/')[-1]
-            try:
-                # zipfile: Historical ZIP filename encoding
-                # try cp437 encoding
-                extract_sub_name = extract_sub_name. \
-                    encode('cp437').decode('gbk')
-            except:
-                pass
             try:
                 print(prefix + ' ' + extract_sub_name)
             except UnicodeDecodeError:
@@ -440,108 +699,426 @@ class GetSubtitles(object):
                       + extract_sub_name.encode('gbk'))
         return message, extract_sub_names
 
-    def start(self):
-
-        all_video_dict = self.get_path_name(self.arg_name, self.sub_store_path)
+    def extract_season_pack(self, one_video, video_info, others,
+                            sub_choice, link, datatype, sub_data_bytes,
+                            v_info_d=None):
+        """ 在字幕包中同时为同一季的其它视频猜测字幕并一次解压，
+            解压出字幕的视频记录在 season_packs 中，返回该视频的解压结果 """
+
+        if v_info_d is None:
+            v_info_d = guessit(one_video)
+        videos = [(one_video, video_info['path'], v_info_d)]
+        videos += [(name, info['path'], guessit(name))
+                   for name, info in others]
+        args = (videos, sub_choice, datatype)
+        kwargs = dict(both=self.both, plex=self.plex)
+        if self.extract_pool:
+            results = self.extract_pool.extract(
+                self.extract_state(), sub_data_bytes, args, kwargs,
+                method='extract_subtitles')
+        else:
+            results = self.extract_subtitles(
+                *args, sub_data_b=sub_data_bytes, **kwargs)
+        served = 0
+        for (name, info), result in zip(others, results[1:]):
+            if result:
+                self.season_packs.serve(name, info, result, (sub_choice, link))
+                served += 1
+        if served:
+            print(prefix + ' season pack: subtitles for %d more episodes'
+                  % served)
+        return results[0]
+
+    def run_step(self, step, task):
+        """ 执行单个处理阶段，记录该视频出现的错误 """
+
+        try:
+            step(task)
+        except rarfile.RarCannotExec:
+            task.s_error += 'Unrar not installed?'
+            task.error = 'RarCannotExec'
+            task.done = True
+        except AttributeError:
+            task.s_error += 'unknown error. try again.'
+            task.f_error += format_exc()
+            task.error = 'AttributeError'
+            task.done = True
+        except Exception as e:
+            task.s_error += str(e) + '. '
+            task.f_error += format_exc()
+            task.error = e.__class__.__name__
+            task.done = True
+
+    def parse_video(self, task):
+        """ 打印视频信息，跳过已有字幕的视频，解析视频名 """
+
+        print('\n' + prefix + ' ' + task.name)  # 打印当前视频及其路径
+        print(prefix + ' ' + task.info['path'] + '\n' + prefix)
+
+        if task.info['have_subtitle'] and not self.over:
+            print(prefix
+                  + " subtitle already exists, add '-o' to replace it.")
+            task.done = True
+            return
+
+        if self.library_state and task.info.get('file'):
+            task.stat = LibraryState.stat(task.info['file'])
+
+        if self.use_served(task):
+            return
+
+        if task.stat and not (self.query or self.single
+                              or self.over or self.refresh):
+            state = self.library_state.check(task.info['file'], *task.stat)
+            if state == 'success':
+                print(prefix + ' subtitle downloaded in an earlier run, '
+                      "add '-o' to download again.")
+                task.done = True
+                return
+            if state == 'backoff':
+                print(prefix + ' no search results in earlier runs, '
+                      "retry later or add '--refresh'.")
+                task.skipped = True
+                task.done = True
+                return
+
+        task.video_info_d = guessit(task.name)
+
+    def pending_video(self, video_info):
+        """ 批量模式下视频是否需要下载字幕：没有字幕，且之前的运行中下载的字幕不存在 """
+
+        if video_info['have_subtitle'] and not self.over:
+            return False
+        if self.library_state and video_info.get('file') \
+                and not (self.query or self.single
+                         or self.over or self.refresh):
+            stat = LibraryState.stat(video_info['file'])
+            if stat and self.library_state.check(
+                    video_info['file'], *stat) == 'success':
+                return False
+        return True
+
+    def use_served(self, task):
+        """ 视频的字幕已从同一季其它视频的字幕包中解压时结束处理，返回 True """
+
+        if not self.season_packs:
+            return False
+        served = self.season_packs.get(task.name, task.info)
+        if served is None:
+            return False
+        task.extract_sub_names, task.chosen = served
+        if task.sub_dict is None:
+            task.sub_dict = order_dict()
+        print(prefix + ' extracted from the season pack of another episode')
+        for extract_sub_name, _, _ in task.extract_sub_names:
+            print(prefix + ' ' + extract_sub_name.split('/')[-1])
+        task.done = True
+        return True
+
+    def search_video(self, task):
+        """ 同时使用各下载器搜索字幕，按下载器顺序合并搜索结果。
+            同一季的多集视频先按季搜索，分配不到候选字幕时再单独搜索。 """
+
+        task.sub_dict = order_dict()
+        if self.use_served(task):
+            return
+        stats = [RequestStats() for _ in self.downloader]  # 各下载器请求数
+
+        sub_dict = None
+        if self.season_search:
+            sub_dict = self.search_season(task.name, stats)
+        if not sub_dict:
+            sub_dict = order_dict()
+            for result in self.search_sites(task.name, self.sub_num, stats):
+                if result:
+                    sub_dict.update(result)
+        task.sub_dict = sub_dict
+
+        task.search_requests = sum(one.requests for one in stats)
+        task.search_skipped = sum(one.skipped for one in stats)
+        if self.debug:
+            print(prefix + ' search requests: %d, skipped empty queries: %d'
+                  % (task.search_requests, task.search_skipped))
+        elif task.search_skipped:
+            print(prefix + ' skipped %d queries without results in the cache, '
+                  "add '--refresh' to search again." % task.search_skipped)
+        if len(sub_dict) == 0:
+            task.s_error += 'no search results. '
+            task.error = 'no_results'
+            task.done = True
+
+    def search_season(self, video_name, stats):
+        """ 同一季的视频共用一次按季搜索，返回分配给该集的候选字幕字典，
+            不按季搜索时返回 None。按季搜索的请求数计入第一个搜索的视频 """
+
+        keyword = self.season_search.group(video_name)
+        if keyword is None:
+            return None
+        results = self.season_search.search(
+            keyword, lambda name, sub_num: self.search_sites(
+                name, sub_num, stats))
+        if results is None:
+            return None
+        sub_dict = self.season_search.assign(results, video_name)
+        if self.debug:
+            print(prefix + ' season search: %s, %d candidates'
+                  % (keyword, len(sub_dict)))
+        return sub_dict
+
+    def search_sites(self, video_name, sub_num, stats):
+        """ 同时使用各下载器搜索字幕，返回各下载器的搜索结果列表，
+            候选字幕数达到 sub_num 或超过搜索时限后不再等待其余下载器，
+            其余下载器的搜索在下一个请求前停止。 """
+
+        results = [None] * len(self.downloader)
+        failed = 0  # 网络错误的下载器数
+
+        identity = None
+        if self.search_cache:
+            identity = SearchCache.identity(
+                Downloader.get_keywords(video_name)[0])
+        cancel = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=len(self.downloader))
+        futures = {
+            executor.submit(
+                propagate_output(self.search_site),
+                downloader, video_name, identity, stats[i], sub_num,
+                cancel): i
+            for i, downloader in enumerate(self.downloader)
+        }
+        try:
+            for future in as_completed(futures, timeout=self.search_timeout):
+                try:
+                    results[futures[future]] = future.result()
+                except ValueError as e:
+                    if str(e) == 'Zimuku搜索结果出现未知结构页面':
+                        print(prefix + ' warn: ' + str(e))
+                    else:
+                        raise(e)
+                except (exceptions.Timeout, exceptions.ConnectionError):
+                    print(prefix + ' connect timeout, search next site.')
+                    failed += 1
+                    if failed == len(self.downloader):
+                        print(prefix + ' PLEASE CHECK YOUR NETWORK STATUS')
+                        sys.exit(0)
+                if sum(len(r) for r in results if r) >= sub_num:
+                    break
+        except FuturesTimeoutError:
+            print(prefix + ' search timeout, skip unfinished sites.')
+        finally:
+            cancel.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+        return results
+
+    def search_site(self, downloader, video_name, identity=None, stats=None,
+                    sub_num=None, cancel=None):
+        """ 使用单个下载器搜索字幕，优先使用缓存的搜索结果，
+            发出的请求数记录在 stats 中；
+            cancel 被设置后停止搜索并返回 None，不缓存不完整的结果 """
+
+        site = downloader.__class__.name
+        sub_num = sub_num or self.sub_num
+        if self.search_cache and not self.refresh:
+            sub_dict = self.search_cache.get(site, identity, sub_num)
+            if sub_dict is not None:
+                print(prefix + ' %s: %d search results from the cache, '
+                      "add '--refresh' to search again."
+                      % (site, len(sub_dict)))
+                return sub_dict
+        try:
+            with Downloader.request_stats(stats), \
+                    Downloader.cancel_on(cancel):
+                sub_dict = downloader.get_subtitles(video_name,
+                                                    sub_num=sub_num)
+        except SearchCancelled:
+            return None
+        if self.search_cache and sub_dict:
+            # 没有结果的查询只记录在有效时间较短的 negative_cache 中
+            self.search_cache.put(site, identity, sub_num, sub_dict)
+        return sub_dict
 
-        for one_video, video_info in all_video_dict.items():
+    def prefetch_archive(self, task):
+        """ 流水线模式下预先下载自动模式会选择的第一个字幕包 """
 
-            self.s_error = ''  # 重置错误记录
-            self.f_error = ''
+        if self.query:
+            return
+        if self.season_packs and self.season_packs.get(task.name, task.info):
+            return
+        exit, sub_choices = self.choose_subtitle(task.sub_dict)
+        sub_choice, link, session, page = sub_choices[0]
+        if self.season_packs and not self.season_packs.prefetch(
+                task.name, task.info, link):
+            return
+        try:
+            task.archives[sub_choice] = self.download_archive(
+                sub_choice, link, session, page)
+        except Exception as e:
+            task.archives[sub_choice] = e
+
+    def fetch_subtitles(self, task):
+        """ 遍历候选字幕包直到解压出猜测字幕 """
+
+        link = None
+        if self.season_packs:
+            link = task.sub_dict[list(task.sub_dict.keys())[0]]['link']
+            if not self.season_packs.claim(task.name, task.info, link):
+                # 等待期间已由同一季其它视频的字幕包解压出字幕
+                self.use_served(task)
+                return
+        try:
+            self.extract_candidates(task)
+        finally:
+            if self.season_packs:
+                self.season_packs.finish(task.name, task.info, link)
+
+    def extract_candidates(self, task):
+        """ 依次下载、解压候选字幕包 """
+
+        sub_dict = task.sub_dict
+        task.extract_sub_names = extract_sub_names = []
+        while not extract_sub_names and len(sub_dict) > 0:
+            exit, sub_choices = self.choose_subtitle(sub_dict)
+            if exit:
+                break
+            for i, choice in enumerate(sub_choices):
+                sub_choice, link, session, page = choice
+                sub_dict.pop(sub_choice)
+                archive = task.archives.pop(sub_choice, None)
+                try:
+                    if i == 0:
+                        error, n_extract_sub_names = self.process_archive(
+                            task.name, task.info,
+                            sub_choice, link, session,
+                            archive=archive, v_info_d=task.video_info_d,
+                            page=page)
+                    else:
+                        error, n_extract_sub_names = self.process_archive(
+                            task.name, task.info,
+                            sub_choice, link, session,
+                            rename=False, delete=False,
+                            archive=archive, v_info_d=task.video_info_d,
+                            page=page)
+                    if error:
+                        print(prefix + ' error: ' + error)
+                        print(prefix)
+                        continue
+                    elif not n_extract_sub_names:
+                        print(prefix
+                              + ' no matched subtitle in this archive')
+                        continue
+                    else:
+                        extract_sub_names += n_extract_sub_names
+                        if task.chosen is None:
+                            task.chosen = (sub_choice, link)
+                        if self.first_subtitle is None:
+                            self.first_subtitle = \
+                                time.monotonic() - self.start_time
+                except TypeError as e:
+                    print(format_exc())
+                    continue
+                except (rarfile.BadRarFile, zipfile.BadZipFile,
+                        ArchiveError) as e:
+                    print(prefix + ' Error:' + str(e))
+                    continue
 
-            try:
-                print('\n' + prefix + ' ' + one_video)  # 打印当前视频及其路径
-                print(prefix + ' ' + video_info['path'] + '\n' + prefix)
+    def finish_video(self, task):
+        """ 汇总视频的错误信息，失败时加入失败列表 """
+
+        if (task.extract_sub_names is not None
+                and not task.extract_sub_names
+                and len(task.sub_dict) == 0):
+            # 自动模式下所有字幕包均没有猜测字幕
+            task.s_error += " failed to guess one subtitle,"
+            task.s_error += "use '-q' to try query mode."
+            task.error = 'no_match'
+
+        self.search_requests += task.search_requests
+        if task.skipped:
+            self.skipped += 1
+
+        if self.library_state and task.stat and task.sub_dict is not None:
+            # 记录搜索过的视频的处理结果
+            if task.extract_sub_names:
+                candidate, archive = task.chosen
+                self.library_state.record(
+                    task.info['file'], task.stat[0], task.stat[1], 'success',
+                    candidate=candidate, archive=archive,
+                    subtitles=[path for _, _, path in task.extract_sub_names])
+            elif task.s_error:
+                self.library_state.record(
+                    task.info['file'], task.stat[0], task.stat[1], 'failed',
+                    error=task.error or 'error')
+
+        if task.s_error and not self.debug:
+            task.s_error += "add --debug to get more info of the error"
+
+        if task.s_error:
+            self.failed_list.append({'name': task.name,
+                                     'path': task.info['path'],
+                                     'error': task.s_error,
+                                     'trace_back': task.f_error})
+            print(prefix + ' error:' + task.s_error)
 
-                if video_info['have_subtitle'] and not self.over:
-                    print(prefix
-                          + " subtitle already exists, add '-o' to replace it.")
-                    continue
+    def start(self):
 
-                sub_dict = order_dict()
-                for i, downloader in enumerate(self.downloader):
-                    try:
-                        sub_dict.update(
-                            downloader.get_subtitles(one_video, sub_num=self.sub_num)
-                        )
-                    except ValueError as e:
-                        if str(e) == 'Zimuku搜索结果出现未知结构页面':
-                            print(prefix + ' warn: ' + str(e))
-                        else:
-                            raise(e)
-                    except (exceptions.Timeout, exceptions.ConnectionError):
-                        print(prefix + ' connect timeout, search next site.')
-                        if i < (len(self.downloader)-1):
-                            continue
-                        else:
-                            print(prefix + ' PLEASE CHECK YOUR NETWORK STATUS')
-                            sys.exit(0)
-                    if len(sub_dict) >= self.sub_num:
-                        break
-                if len(sub_dict) == 0:
-                    self.s_error += 'no search results. '
+        self.start_time = time.monotonic()
+        self.first_subtitle = None
+        if self.watch:
+            all_videos = self.watch_path_name(
+                self.arg_name, self.sub_store_path)
+        elif self.stream:
+            # 边扫描边处理，不等待扫描完成
+            all_videos = self.iter_path_name(
+                self.arg_name, self.sub_store_path)
+        else:
+            video_dict = self.get_path_name(
+                self.arg_name, self.sub_store_path)
+            if self.group_seasons:
+                self.season_search = SeasonSearch(self.sub_num)
+            if self.reuse_packs and not (self.query or self.single):
+                self.season_packs = SeasonPacks()
+            for one_video, video_info in video_dict.items():
+                if not self.pending_video(video_info):
                     continue
-
-                extract_sub_names = []
-                # 遍历字幕包直到有猜测字幕
-                while not extract_sub_names and len(sub_dict) > 0:
-                    exit, sub_choices = self.choose_subtitle(sub_dict)
-                    if exit:
-                        break
-                    for i, choice in enumerate(sub_choices):
-                        sub_choice, link, session = choice
-                        sub_dict.pop(sub_choice)
-                        try:
-                            if i == 0:
-                                error, n_extract_sub_names = self.process_archive(
-                                    one_video, video_info,
-                                    sub_choice, link, session)
-                            else:
-                                error, n_extract_sub_names = self.process_archive(
-                                    one_video, video_info,
-                                    sub_choice, link, session,
-                                    rename=False, delete=False)
-                            if error:
-                                print(prefix + ' error: ' + error)
-                                print(prefix)
-                                continue
-                            elif not n_extract_sub_names:
-                                print(prefix
-                                      + ' no matched subtitle in this archive')
-                                continue
-                            else:
-                                extract_sub_names += n_extract_sub_names
-                        except TypeError as e:
-                            print(format_exc())
-                            continue
-                        except (rarfile.BadRarFile, TypeError) as e:
-                            print(prefix + ' Error:' + str(e))
-                            continue
-            except rarfile.RarCannotExec:
-                self.s_error += 'Unrar not installed?'
-            except AttributeError:
-                self.s_error += 'unknown error. try again.'
-                self.f_error += format_exc()
-            except Exception as e:
-                self.s_error += str(e) + '. '
-                self.f_error += format_exc()
-            finally:
-                if ('extract_sub_names' in dir()
-                        and not extract_sub_names
-                        and len(sub_dict) == 0):
-                    # 自动模式下所有字幕包均没有猜测字幕
-                    self.s_error += " failed to guess one subtitle,"
-                    self.s_error += "use '-q' to try query mode."
-
-                if self.s_error and not self.debug:
-                    self.s_error += "add --debug to get more info of the error"
-
-                if self.s_error:
-                    self.failed_list.append({'name': one_video,
-                                             'path': video_info['path'],
-                                             'error': self.s_error,
-                                             'trace_back': self.f_error})
-                    print(prefix + ' error:' + self.s_error)
+                if self.season_search:
+                    self.season_search.add(one_video)
+                if self.season_packs:
+                    self.season_packs.add(one_video, video_info)
+            all_videos = video_dict.items()
+
+        total = 0
+        try:
+            if self.workers and not (self.query or self.single):
+                # 流水线模式
+                pipeline = Pipeline(self, self.workers)
+                for task in pipeline.run(all_videos):
+                    total += 1
+                    self.finish_video(task)
+                    if task.fatal is not None:
+                        raise task.fatal
+            else:
+                for index, (one_video, video_info) in enumerate(all_videos):
+                    total += 1
+                    task = VideoTask(index, one_video, video_info)
+                    for step in (self.parse_video, self.search_video,
+                                 self.fetch_subtitles):
+                        if task.done:
+                            break
+                        self.run_step(step, task)
+                    self.finish_video(task)
+        except KeyboardInterrupt:
+            # 监视模式用 Ctrl-C 结束，仍输出统计
+            if not self.watch:
+                raise
+            print('\nstop watching ' + self.arg_name)
+        finally:
+            if self.watcher:
+                self.watcher.stop()
+
+        if self.extract_pool:
+            self.extract_pool.shutdown()
 
         if len(self.failed_list):
             print('\n===============================', end='')
@@ -553,17 +1130,29 @@ class GetSubtitles(object):
                 if self.debug:
                     print('%3s TRACE_BACK: %s' % ('', one['trace_back']))
 
-        print('\ntotal: %s  success: %s  fail: %s\n' % (
-            len(all_video_dict),
-            len(all_video_dict) - len(self.failed_list),
-            len(self.failed_list)
-        ))
+        if self.debug:
+            print('\nguessit cache: %s hits, %s misses (%s fast parsed)' % (
+                guess_cache.hits, guess_cache.misses, guess_cache.fast))
+
+        success = total - len(self.failed_list) - self.skipped
+        summary = 'total: %s  success: %s  fail: %s' % (
+            total, success, len(self.failed_list))
+        if self.skipped:
+            summary += '  skipped: %s' % self.skipped
+        if (self.stream or self.debug) and self.first_subtitle is not None:
+            # 边扫描边处理时显示开始运行到解压出第一个字幕的时间
+            summary += '  first subtitle: %.2fs  total time: %.2fs' % (
+                self.first_subtitle, time.monotonic() - self.start_time)
+        print('\n' + summary + '\n')
 
         return {
-            'total': len(all_video_dict),
-            'success': len(all_video_dict) - len(self.failed_list),
+            'total': total,
+            'success': success,
             'fail': len(self.failed_list),
-            'fail_videos': self.failed_list
+            'skipped': self.skipped,
+            'fail_videos': self.failed_list,
+            'search_requests': self.search_requests,
+            'first_subtitle': self.first_subtitle
         }
 
 
@@ -639,6 +1228,111 @@ def main():
         action='store_true',
         help="add .zh to the subtitle's name for plex to recognize"
     )
+    arg_parser.add_argument(
+        '--search-timeout',
+        action='store',
+        type=float,
+        help='stop waiting for other sites after SEARCH_TIMEOUT seconds '
+             'of searching one video'
+    )
+    arg_parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='ignore cached search results and queries without results'
+    )
+    arg_parser.add_argument(
+        '--cache-ttl',
+        action='store',
+        type=float,
+        default=24,
+        help='hours to keep cached search results, 0 to disable the cache'
+    )
+    arg_parser.add_argument(
+        '--negative-cache-ttl',
+        action='store',
+        type=float,
+        default=1,
+        help='hours to skip queries known to have no results'
+    )
+    arg_parser.add_argument(
+        '--archive-cache-size',
+        action='store',
+        type=float,
+        default=200,
+        help='max megabytes of cached subtitle archives, 0 to disable'
+    )
+    arg_parser.add_argument(
+        '--archive-backend',
+        action='store',
+        help='preferred archive backends, comma separated, '
+             'from: ' + ', '.join(DEFAULT_ORDER)
+    )
+    arg_parser.add_argument(
+        '--extract-procs',
+        action='store',
+        type=int,
+        help='extract subtitle archives in EXTRACT_PROCS processes, '
+             'only with -j or --stage-jobs'
+    )
+    arg_parser.add_argument(
+        '--retry-backoff',
+        action='store',
+        type=float,
+        default=24,
+        help='hours before retrying a video without search results, '
+             'doubled after each failed run, 0 to disable the library '
+             'state, default: %(default)s'
+    )
+    arg_parser.add_argument(
+        '--no-season-search',
+        action='store_true',
+        help='search each episode separately instead of searching once '
+             'for all episodes of a season in the folder'
+    )
+    arg_parser.add_argument(
+        '--no-season-packs',
+        action='store_true',
+        help='only extract the subtitle of the current video from an '
+             'archive, not those of other episodes in the folder'
+    )
+    arg_parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='keep watching the folder and process new videos once they '
+             'are completely written (Linux only)'
+    )
+    arg_parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='start processing videos while the folder is still scanned'
+    )
+    arg_parser.add_argument(
+        '--scan-jobs',
+        action='store',
+        type=int,
+        help='list directories in SCAN_JOBS threads when scanning videos, '
+             'useful on network filesystems'
+    )
+    arg_parser.add_argument(
+        '--cache-dir',
+        action='store',
+        default=default_cache_dir(),
+        help='set cache directory, default: %(default)s'
+    )
+    arg_parser.add_argument(
+        '-j',
+        '--jobs',
+        action='store',
+        type=int,
+        help='process videos in a pipeline, with JOBS threads for '
+             'searching and downloading'
+    )
+    arg_parser.add_argument(
+        '--stage-jobs',
+        action='store',
+        help='set threads of each pipeline stage, '
+             'eg: parse=1,search=8,download=4,extract=2'
+    )
 
     args = arg_parser.parse_args()
 
@@ -647,7 +1341,21 @@ def main():
 
     GetSubtitles(args.name, args.query, args.single, args.more,
                  args.both, args.over, args.plex, args.debug, sub_num=args.number,
-                 downloader=args.downloader, sub_path=args.directory,).start()
+                 downloader=args.downloader, sub_path=args.directory,
+                 jobs=args.jobs, stage_jobs=args.stage_jobs,
+                 search_timeout=args.search_timeout,
+                 cache_dir=args.cache_dir, cache_ttl=args.cache_ttl,
+                 negative_ttl=args.negative_cache_ttl,
+                 refresh=args.refresh,
+                 archive_cache_size=args.archive_cache_size,
+                 archive_backends=args.archive_backend,
+                 extract_procs=args.extract_procs,
+                 scan_jobs=args.scan_jobs,
+                 stream=args.stream,
+                 retry_backoff=args.retry_backoff,
+                 watch=args.watch,
+                 season_search=not args.no_season_search,
+                 season_packs=not args.no_season_packs).start()
 
 
 if __name__ == '__main__':
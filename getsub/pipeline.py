@@ -0,0 +1,235 @@
+# coding: utf-8
+
+import re
+import sys
+import threading
+from queue import Queue
+
+
+''' 流水线模式
+    将视频处理拆分为 扫描 -> 解析 -> 搜索 -> 下载 -> 解压 五个阶段，
+    各阶段之间通过有界队列连接，每个阶段拥有独立的线程数。
+'''
+
+
+class VideoTask(object):
+
+    """ 单个视频在各处理阶段之间传递的状态 """
+
+    def __init__(self, index, name, info):
+        self.index = index
+        self.name = name
+        self.info = info  # {'path': path, 'have_subtitle': sub_exists, 'file'}
+        self.video_info_d = None  # guessit 解析结果
+        self.sub_dict = None  # 候选字幕字典
+        self.search_requests = 0  # 搜索发出的请求数
+        self.search_skipped = 0  # 已知无结果而跳过的查询数
+        self.archives = {}  # 预先下载的字幕包 {sub_choice: (datatype, bytes, err_msg)}
+        self.extract_sub_names = None  # 开始解压后为 list
+        self.chosen = None  # 解压出字幕的 (候选字幕名, 字幕包链接)
+        self.stat = None  # 视频文件的 (大小, 修改时间)
+        self.skipped = False  # 未到重试时间而跳过
+        self.error = None  # 失败原因，如 'no_results' 或异常类名
+        self.s_error = ''
+        self.f_error = ''
+        self.done = False  # 为 True 时后续阶段直接跳过
+        self.fatal = None  # 工作线程中出现的 SystemExit / KeyboardInterrupt
+        self.output = []  # 流水线模式下缓存的输出
+
+
+class OutputRouter(object):
+
+    """ 替换 sys.stdout，将工作线程的输出写入当前任务的缓存，
+        由主线程按视频顺序统一输出。 """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def capture(self, buffer):
+        router = self
+
+        class _Capture(object):
+            def __enter__(self):
+                router.local.buffer = buffer
+
+            def __exit__(self, *args):
+                router.local.buffer = None
+
+        return _Capture()
+
+    @staticmethod
+    def render(buffer):
+        """ 合并缓存的输出，每行只保留 '\\r' 覆盖后的最终内容 """
+
+        lines = []
+        for line in ''.join(buffer).split('\n'):
+            parts = [part for part in line.split('\r') if part]
+            lines.append(parts[-1] if parts else '')
+        if lines and ''.join(buffer).endswith('\r'):
+            # 末尾未换行的进度信息会被之后的输出覆盖
+            lines[-1] = ''
+        return '\n'.join(lines)
+
+
+def propagate_output(func):
+
+    """ 包装在其它线程中执行的函数，使其输出写入调用线程当前的任务缓存 """
+
+    router = sys.stdout
+    if not isinstance(router, OutputRouter):
+        return func
+    buffer = getattr(router.local, 'buffer', None)
+
+    def wrapper(*args, **kwargs):
+        with router.capture(buffer):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def parse_stage_jobs(jobs, stage_jobs=None):
+
+    """ 解析各阶段线程数
+    Args:
+        jobs: 网络阶段（搜索、下载）默认线程数
+        stage_jobs: 形如 'search=8,download=4' 的字符串
+    Return:
+        {'parse': n, 'search': n, 'download': n, 'extract': n}
+    """
+
+    workers = {'parse': 1, 'search': jobs, 'download': jobs, 'extract': 1}
+    if not stage_jobs:
+        return workers
+    for one in re.split(',|，', stage_jobs):
+        if not one.strip():
+            continue
+        stage, _, number = one.partition('=')
+        stage = stage.strip()
+        if stage not in workers or not number.strip().isdigit() \
+                or int(number) < 1:
+            raise ValueError('invalid stage jobs: ' + one)
+        workers[stage] = int(number)
+    return workers
+
+
+class Pipeline(object):
+
+    stages = ('parse', 'search', 'download', 'extract')
+
+    def __init__(self, getsub, workers):
+        """
+        Args:
+            getsub: GetSubtitles 实例，提供各阶段的处理函数
+            workers: 各阶段线程数，见 parse_stage_jobs
+        """
+        self.getsub = getsub
+        self.workers = workers
+        self.stop = object()
+        self.lock = threading.Lock()
+        self.router = None
+        self.scan_error = None
+
+    def _worker(self, func, in_q, out_q, remaining, stage, n_next):
+        while True:
+            task = in_q.get()
+            if task is self.stop:
+                break
+            if not task.done:
+                with self.router.capture(task.output):
+                    try:
+                        self.getsub.run_step(func, task)
+                    except BaseException as e:
+                        task.fatal = e
+                        task.done = True
+            out_q.put(task)
+        with self.lock:
+            remaining[stage] -= 1
+            last = remaining[stage] == 0
+        if last:
+            for _ in range(n_next):
+                out_q.put(self.stop)
+
+    def _scan(self, videos, out_q, n_next):
+        # videos 可以是边扫描边产出的生成器，扫描出错时交给主线程抛出
+        try:
+            for index, (name, info) in enumerate(videos):
+                out_q.put(VideoTask(index, name, info))
+        except BaseException as e:
+            self.scan_error = e
+        finally:
+            for _ in range(n_next):
+                out_q.put(self.stop)
+
+    def run(self, videos):
+
+        """ 运行流水线
+        Args:
+            videos: 可迭代的 (视频名, 视频信息) 序列，可为生成器
+        Return:
+            按视频顺序产出处理完成的 VideoTask
+        """
+
+        funcs = {
+            'parse': self.getsub.parse_video,
+            'search': self.getsub.search_video,
+            'download': self.getsub.prefetch_archive,
+            'extract': self.getsub.fetch_subtitles
+        }
+        queues = [Queue(maxsize=self.workers[stage] * 2)
+                  for stage in self.stages]
+        done_q = Queue()
+        queues.append(done_q)
+        remaining = dict(self.workers)
+
+        self.router = OutputRouter(sys.stdout)
+        sys.stdout = self.router
+        try:
+            threads = [threading.Thread(
+                target=self._scan,
+                args=(videos, queues[0], self.workers[self.stages[0]]))]
+            for i, stage in enumerate(self.stages):
+                if i + 1 < len(self.stages):
+                    n_next = self.workers[self.stages[i + 1]]
+                else:
+                    n_next = 1
+                for _ in range(self.workers[stage]):
+                    threads.append(threading.Thread(
+                        target=self._worker,
+                        args=(funcs[stage], queues[i], queues[i + 1],
+                              remaining, stage, n_next)))
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+
+            finished = {}
+            next_index = 0
+            while True:
+                task = done_q.get()
+                if task is self.stop:
+                    break
+                finished[task.index] = task
+                while next_index in finished:
+                    task = finished.pop(next_index)
+                    next_index += 1
+                    self.router.stream.write(
+                        OutputRouter.render(task.output))
+                    self.router.stream.flush()
+                    task.output = []
+                    yield task
+            if self.scan_error is not None:
+                raise self.scan_error
+        finally:
+            sys.stdout = self.router.stream
@@ -1,8 +1,14 @@
 # coding: utf-8
 
+from io import BytesIO
+from collections import namedtuple
+
 from py7zlib import Archive7z
 
 
+Py7zInfo = namedtuple('Py7zInfo', ['filename', 'file_size'])
+
+
 class Py7z:
 
     def __init__(self, file):
@@ -11,5 +17,12 @@ class Py7z:
     def namelist(self):
         return self.archive.getnames()
 
+    def infolist(self):
+        return [Py7zInfo(member.filename, getattr(member, 'size', None))
+                for member in self.archive.getmembers()]
+
     def read(self, name):
         return self.archive.getmember(name).read()
+
+    def open(self, name):
+        return BytesIO(self.read(name))
@@ -0,0 +1,97 @@
+# coding: utf-8
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+''' 视频目录扫描
+    基于 os.scandir 遍历目录，顺序与 os.walk 相同。
+    已有字幕按文件名（不含后缀）建立集合索引，查找视频是否已有字幕为 O(1)。
+    网络文件系统上列出目录的延迟较高，可用多个线程预先列出即将遍历的子目录。
+'''
+
+
+def list_dir(path):
+
+    """ 列出目录，返回 (文件名列表, 子目录路径列表)，无法读取时返回空列表；
+        与 os.walk 相同，指向目录的符号链接不进入 """
+
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+                elif not entry.is_symlink():
+                    dirs.append(entry.path)
+    except OSError:
+        pass
+    return files, dirs
+
+
+def subtitle_stems(files, sub_formats):
+
+    """ 返回已有字幕的文件名集合（不含后缀），
+        'name.zh.srt' 同时记录 'name.zh' 与 'name' """
+
+    stems = set()
+    for name in files:
+        stem, ext = os.path.splitext(name)
+        if ext not in sub_formats:
+            continue
+        stems.add(stem)
+        if stem.endswith('.zh'):
+            stems.add(stem[:-3])
+    return stems
+
+
+class DirectoryScanner(object):
+
+    def __init__(self, workers=None):
+        """
+        Args:
+            workers: 同时列出目录的线程数，为空时在当前线程中依次列出
+        """
+        self.workers = workers
+
+    def walk(self, top):
+
+        """ 生成器，按 os.walk 的顺序产出 (目录路径, 文件名列表) """
+
+        if not self.workers or self.workers <= 1:
+            stack = [top]
+            while stack:
+                root = stack.pop()
+                files, dirs = list_dir(root)
+                yield root, files
+                stack.extend(reversed(dirs))
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            stack = [(top, executor.submit(list_dir, top))]
+            while stack:
+                root, future = stack.pop()
+                files, dirs = future.result()
+                # 先提交子目录，产出当前目录时子目录已在其它线程中列出
+                stack.extend(reversed(
+                    [(path, executor.submit(list_dir, path))
+                     for path in dirs]))
+                yield root, files
+        finally:
+            for _, future in stack:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def subtitle_index(self, top, sub_formats):
+
+        """ 目录及其子目录中所有已有字幕的文件名集合（不含后缀） """
+
+        stems = set()
+        for root, files in self.walk(top):
+            stems |= subtitle_stems(files, sub_formats)
+        return stems
@@ -0,0 +1,271 @@
+# coding: utf-8
+
+import os
+import threading
+from collections import OrderedDict as order_dict
+
+from requests.utils import unquote
+
+from getsub.guess import guessit
+from getsub.downloader.downloader import Downloader
+
+
+''' 按季搜索
+    同一季的多集视频由 Downloader.get_keywords 得到相同的基础关键字（如 'Show s01'），
+    各下载器只以该关键字搜索一次，再按候选字幕名中的季数、集数分配给各集：
+    集数相同的候选字幕在前，季包及无法判断集数的候选字幕在后。
+    分配不到候选字幕的视频仍按原来的关键字单独搜索。
+
+    季包复用
+    解压字幕包时，同一季尚未开始解压的其它视频也在该字幕包中猜测字幕，
+    猜到的一并解压，这些视频不再搜索、下载。
+'''
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+class SeasonSearch(object):
+
+    min_episodes = 2  # 同一季至少有几集待处理的视频时按季搜索
+    max_sub_num = 100  # 按季搜索时每个下载器的最大结果数
+
+    def __init__(self, sub_num):
+        """
+        Args:
+            sub_num: 分配给每集的每个下载器的候选字幕数
+        """
+        self.sub_num = sub_num
+        self.episodes = {}  # {分组: 视频集数}
+        self.results = {}  # {分组: 各下载器的按季搜索结果}
+        self.pending = {}  # {分组: threading.Event}，正在搜索的分组
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def season_keyword(video_name):
+        """ 剧集视频返回基础关键字，如 'Show s01'，无法判断季数、集数时返回 None """
+
+        try:
+            keywords, info_dict = Downloader.get_keywords(video_name)
+        except KeyError:  # guessit 未解析出标题
+            return None
+        if info_dict.get('type') != 'episode' \
+                or not isinstance(info_dict.get('season'), int) \
+                or not info_dict.get('episode'):
+            return None
+        return unquote(keywords[0])
+
+    def add(self, video_name):
+        """ 记录一个待处理的视频 """
+
+        keyword = self.season_keyword(video_name)
+        if keyword is not None:
+            key = keyword.lower()
+            self.episodes[key] = self.episodes.get(key, 0) + 1
+
+    def group(self, video_name):
+        """ 返回视频所在分组的基础关键字，不按季搜索时返回 None """
+
+        keyword = self.season_keyword(video_name)
+        if keyword is None \
+                or self.episodes.get(keyword.lower(), 0) < self.min_episodes:
+            return None
+        return keyword
+
+    def search(self, keyword, search_func):
+
+        """ 每个分组只搜索一次，同一分组的其它视频等待并共用第一次搜索的结果
+        Args:
+            keyword: group 返回的基础关键字
+            search_func: 执行搜索的函数，参数为 (搜索名, 结果数)，
+                         返回各下载器的搜索结果列表
+        Return:
+            各下载器的搜索结果列表，搜索出错时为 None
+        """
+
+        key = keyword.lower()
+        with self.lock:
+            if key in self.results:
+                return self.results[key]
+            event = self.pending.get(key)
+            owner = event is None
+            if owner:
+                event = self.pending[key] = threading.Event()
+        if not owner:
+            event.wait()
+            return self.results.get(key)
+
+        results = None
+        try:
+            sub_num = min(self.sub_num * self.episodes[key], self.max_sub_num)
+            results = search_func(keyword, sub_num)
+        except Exception:
+            # 与等待的视频一样，改为单独搜索
+            results = None
+        finally:
+            with self.lock:
+                self.results[key] = results
+                del self.pending[key]
+            event.set()
+        return results
+
+    @staticmethod
+    def match(sub_name, video_info):
+        """ 候选字幕为同一集返回 'episode'，为季包或无法判断集数返回 'season'，
+            季数或集数不同返回 None """
+
+        sub_info = guessit(sub_name[sub_name.find(']') + 1:])
+        seasons = sub_info.get('season')
+        if seasons is not None \
+                and video_info['season'] not in _as_list(seasons):
+            return None
+        episodes = sub_info.get('episode')
+        if episodes is None:
+            return 'season'
+        if set(_as_list(video_info['episode'])) & set(_as_list(episodes)):
+            return 'episode'
+        return None
+
+    def assign(self, results, video_name):
+
+        """ 从各下载器的按季搜索结果中挑选该集的候选字幕
+        Return:
+            字幕字典，格式同 Downloader.get_subtitles，
+            按下载器顺序合并，每个下载器最多 sub_num 个
+        """
+
+        video_info = guessit(video_name)
+        sub_dict = order_dict()
+        for result in results:
+            if not result:
+                continue
+            episodes, packs = [], []
+            for sub_name, sub_info in result.items():
+                match = self.match(sub_name, video_info)
+                if match == 'episode':
+                    episodes.append(sub_name)
+                elif match == 'season':
+                    packs.append(sub_name)
+            for sub_name in (episodes + packs)[:self.sub_num]:
+                # 各集分别从候选字幕字典中移除已尝试的字幕
+                sub_dict[sub_name] = dict(result[sub_name])
+        return sub_dict
+
+
+class SeasonPacks(object):
+
+    """ 批量模式下待处理的剧集视频。
+        视频开始解压自己的字幕包前 claim，结束后 finish；
+        解压字幕包时 borrow 同一季的其它视频，解压出字幕的 serve，其余 release。 """
+
+    def __init__(self):
+        self.groups = {}  # {分组: [视频标识]}
+        self.videos = {}  # {视频标识: (分组, 视频名, 视频信息)}
+        self.claimed = set()  # 已开始解压自己的字幕包的视频
+        self.borrowed = set()  # 正在其它视频的字幕包中猜测字幕的视频
+        self.served = {}  # {视频标识: (解压结果, (候选字幕名, 字幕包链接))}
+        self.prefetched = set()  # 已预先下载的 (分组, 字幕包链接)
+        self.extracting = set()  # 正在解压的 (分组, 第一个字幕包链接)
+        self.cond = threading.Condition()
+
+    @staticmethod
+    def video_id(video_name, video_info):
+        return video_info.get('file') \
+            or os.path.join(video_info['path'], video_name)
+
+    def add(self, video_name, video_info):
+        """ 记录一个待处理的视频 """
+
+        keyword = SeasonSearch.season_keyword(video_name)
+        if keyword is None:
+            return
+        video_id = self.video_id(video_name, video_info)
+        key = keyword.lower()
+        self.groups.setdefault(key, []).append(video_id)
+        self.videos[video_id] = (key, video_name, video_info)
+
+    def claim(self, video_name, video_info, link=None):
+        """ 视频开始解压自己的字幕包，已由其它视频的字幕包解压出字幕时返回 False。
+            该视频正被其它视频的字幕包猜测，或同一季其它视频正在解压同一字幕包时，
+            等待其结果
+        Args:
+            link: 该视频第一个要下载的字幕包链接
+        """
+
+        video_id = self.video_id(video_name, video_info)
+        key = None
+        if video_id in self.videos and link is not None:
+            key = (self.videos[video_id][0], link)
+        with self.cond:
+            while video_id in self.borrowed or key in self.extracting:
+                self.cond.wait()
+            if video_id in self.served:
+                return False
+            self.claimed.add(video_id)
+            if key is not None:
+                self.extracting.add(key)
+            return True
+
+    def finish(self, video_name, video_info, link=None):
+        """ 视频解压完自己的字幕包，参数同 claim """
+
+        video_id = self.video_id(video_name, video_info)
+        if video_id not in self.videos or link is None:
+            return
+        with self.cond:
+            self.extracting.discard((self.videos[video_id][0], link))
+            self.cond.notify_all()
+
+    def borrow(self, video_name, video_info):
+        """ 返回同一季中其它尚未开始解压的视频 [(视频名, 视频信息)]，
+            在 release 之前这些视频的 claim 等待 """
+
+        video_id = self.video_id(video_name, video_info)
+        if video_id not in self.videos:
+            return []
+        others = []
+        with self.cond:
+            for one in self.groups[self.videos[video_id][0]]:
+                if one == video_id or one in self.claimed \
+                        or one in self.borrowed or one in self.served:
+                    continue
+                self.borrowed.add(one)
+                others.append(self.videos[one][1:])
+        return others
+
+    def prefetch(self, video_name, video_info, link):
+        """ 流水线模式下是否预先下载字幕包：同一季已有视频预先下载同一链接时返回 False，
+            该视频在解压阶段等待季包的解压结果，没有得到字幕时再自行下载 """
+
+        video_id = self.video_id(video_name, video_info)
+        if video_id not in self.videos:
+            return True
+        key = (self.videos[video_id][0], link)
+        with self.cond:
+            if key in self.prefetched:
+                return False
+            self.prefetched.add(key)
+            return True
+
+    def serve(self, video_name, video_info, result, chosen):
+        """ 记录由其它视频的字幕包解压出的字幕 """
+
+        with self.cond:
+            self.served[self.video_id(video_name, video_info)] = \
+                (result, chosen)
+
+    def release(self, videos):
+        """ 结束 borrow，未解压出字幕的视频之后自行搜索、下载 """
+
+        with self.cond:
+            for video_name, video_info in videos:
+                self.borrowed.discard(self.video_id(video_name, video_info))
+            self.cond.notify_all()
+
+    def get(self, video_name, video_info):
+        """ 返回由其它视频的字幕包解压出的 (解压结果, (候选字幕名, 字幕包链接))，
+            没有则返回 None """
+
+        with self.cond:
+            return self.served.get(self.video_id(video_name, video_info))
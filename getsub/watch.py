@@ -0,0 +1,202 @@
+# coding: utf-8
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+from getsub.scan import DirectoryScanner
+
+
+''' 监视视频文件夹
+    通过 Linux inotify 得知新写入或移入的文件，不再定时扫描整个文件夹。
+    文件关闭写入或移入后，在一段时间内大小不再变化才认为下载完成。
+'''
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+_event = struct.Struct('iIII')
+
+
+class Inotify(object):
+
+    """ 基于 ctypes 的 inotify 接口 """
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    @staticmethod
+    def available():
+        try:
+            Inotify().close()
+        except (OSError, AttributeError):
+            return False
+        return True
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """ 监视目录，返回 watch descriptor，目录不存在返回 None """
+
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return None
+            raise OSError(error, os.strerror(error))
+        return wd
+
+    def read(self, timeout=None):
+
+        """ 读取事件，没有事件时最多等待 timeout 秒
+        Return:
+            [(wd, mask, 文件名)]
+        """
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, offset)
+            offset += _event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class VideoWatcher(object):
+
+    settle = 5  # 文件大小保持不变的秒数
+    interval = 1  # 检查停止标记的最长间隔（秒）
+
+    def __init__(self, top, video_formats, scan_jobs=None):
+        """
+        Args:
+            top: 监视的文件夹，包括其子文件夹
+            video_formats: 视频后缀列表
+            scan_jobs: 添加监视时同时列出目录的线程数
+        """
+        self.top = top
+        self.video_formats = video_formats
+        self.scanner = DirectoryScanner(scan_jobs)
+        self.inotify = Inotify()
+        self.dirs = {}  # {wd: 目录路径}
+        self.pending = {}  # {文件路径: (事件时间, 文件大小)}
+        self.stopped = threading.Event()
+        self._watch_tree(top)
+
+    def _is_video(self, name):
+        return os.path.splitext(name)[1] in self.video_formats
+
+    def _watch_tree(self, top, pending=False):
+        # 监视目录及其子目录，pending 为 True 时将其中已有的视频加入等待列表
+        for root, files in self.scanner.walk(top):
+            wd = self.inotify.add_watch(root)
+            if wd is not None:
+                self.dirs[wd] = root
+            if pending:
+                for name in files:
+                    if self._is_video(name):
+                        self._touch(os.path.join(root, name))
+
+    def _touch(self, path):
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return
+        self.pending[path] = (time.monotonic(), size)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # 事件队列溢出，重新扫描整个文件夹
+            self._watch_tree(self.top, pending=True)
+            return
+        if mask & IN_IGNORED:
+            self.dirs.pop(wd, None)
+            return
+        root = self.dirs.get(wd)
+        if root is None or not name:
+            return
+        path = os.path.join(root, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path, pending=True)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and self._is_video(name):
+            self._touch(path)
+
+    def _ready(self):
+        # 等待时间已到且大小未变的文件
+        now = time.monotonic()
+        ready = []
+        for path, (changed, size) in list(self.pending.items()):
+            if now - changed < self.settle:
+                continue
+            try:
+                current = os.stat(path).st_size
+            except OSError:
+                del self.pending[path]
+                continue
+            if current != size:
+                self.pending[path] = (now, current)
+                continue
+            del self.pending[path]
+            ready.append(path)
+        return sorted(ready)
+
+    def _timeout(self):
+        if not self.pending:
+            return self.interval
+        earliest = min(changed for changed, _ in self.pending.values())
+        return max(0, min(self.interval,
+                          earliest + self.settle - time.monotonic()))
+
+    def __iter__(self):
+
+        """ 产出写入完成的视频文件路径，直到调用 stop """
+
+        try:
+            while not self.stopped.is_set():
+                for wd, mask, name in self.inotify.read(self._timeout()):
+                    self._handle(wd, mask, name)
+                for path in self._ready():
+                    yield path
+        finally:
+            self.inotify.close()
+
+    def stop(self):
+        self.stopped.set()
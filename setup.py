@@ -17,6 +17,12 @@ setup(
         'rarfile>=3.0',
         'pylzma>=0.5.0'
     ],
+    extras_require={
+        'async': ['httpx[http2]>=0.18'],
+        'brotli': ['brotli'],
+        'libarchive': ['libarchive-c'],
+        'lxml': ['lxml']
+    },
     entry_points={
         'console_scripts': [
             'getsub = getsub.main: main'
@@ -0,0 +1,274 @@
+# coding: utf-8
+
+import gzip
+import zlib
+import shutil
+import struct
+import zipfile
+import unittest
+import subprocess
+from unittest import mock
+from io import BytesIO, StringIO
+from contextlib import redirect_stdout
+
+from getsub.main import GetSubtitles
+from getsub.guess import guessit
+from getsub.archive import sniff_format, open_archive
+from getsub.archive_backends import BACKENDS, get_backend, set_preference
+from getsub.archive_backends import read_members
+from getsub.archive_backends import ZipfileBackend, BsdtarBackend
+from getsub.archive_backends import LibarchiveBackend, SevenZipBackend
+from getsub.archive_backends import RarArchive
+
+
+def make_zip(files):
+    buff = BytesIO()
+    with zipfile.ZipFile(buff, 'w') as z:
+        for name, data in files:
+            z.writestr(name, data)
+    return buff.getvalue()
+
+
+def make_rar(files):
+    """ 生成未压缩的 RAR4 字幕包 """
+
+    def block(head_type, flags, body):
+        header = struct.pack('<BHH', head_type, flags, 7 + len(body)) + body
+        return struct.pack('<H', zlib.crc32(header) & 0xffff) + header
+
+    data = b'Rar!\x1a\x07\x00' + block(0x73, 0, b'\0' * 6)
+    for name, content in files:
+        name = name.encode('utf-8')
+        body = struct.pack('<IIBIIBBHI', len(content), len(content), 3,
+                           zlib.crc32(content), 0x21, 20, 0x30, len(name),
+                           0o100644 << 16) + name
+        data += block(0x74, 0x8000, body) + content
+    return data + block(0x7b, 0x4000, b'')
+
+
+class TestArchiveIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.getsub = GetSubtitles('', False, False, False, False, False,
+                                   False, False, 5, None, None)
+        self.video_info = guessit('Show.S01E02.720p.HDTV.x264-GRP.mkv')
+
+    def index(self, files):
+        handler = zipfile.ZipFile(BytesIO(make_zip(files)))
+        return self.getsub.get_file_list(handler)
+
+    def test_lazy_nested(self):
+        index = self.index([
+            ('Show.S01E01.zip', make_zip([('Show.S01E01.chs.srt', b'1')])),
+            ('Show.S01E02.zip', make_zip([('Show.S01E02.chs.srt', b'2')])),
+            ('readme.txt', b'')
+        ])
+        self.assertEqual([e.name for e in index.archives],
+                         ['Show.S01E01.zip', 'Show.S01E02.zip'])
+        self.assertEqual(index.subtitles, [])
+        self.assertEqual(index.children, {})
+
+        entry = self.getsub.choose_archive_entry(
+            index, self.video_info, False)
+        self.assertEqual(entry.display_path,
+                         'Show.S01E02.zip/Show.S01E02.chs.srt')
+        self.assertEqual(entry.read(), b'2')
+        # 只解压了被选中的嵌套压缩包
+        self.assertEqual(list(index.children), ['Show.S01E02.zip'])
+
+    def test_expand_all(self):
+        # 嵌套压缩包名无法判断时展开全部
+        index = self.index([
+            ('a.zip', make_zip([('Show.S01E01.srt', b'1')])),
+            ('b.zip', make_zip([('Show.S01E02.srt', b'2')]))
+        ])
+        with redirect_stdout(StringIO()):
+            entry = self.getsub.choose_archive_entry(
+                index, self.video_info, False)
+        self.assertEqual(entry.display_path, 'b.zip/Show.S01E02.srt')
+        self.assertEqual(sorted(index.children), ['a.zip', 'b.zip'])
+
+    def test_nested_fallback(self):
+        # 进入的嵌套压缩包中没有符合的字幕时，在整个字幕包中选择
+        index = self.index([
+            ('Show.S01E02.zip', make_zip([('Show.S01E01.srt', b'1')])),
+            ('extra.zip', make_zip([('Show.S01E02.chs.srt', b'2')]))
+        ])
+        with redirect_stdout(StringIO()):
+            entry = self.getsub.choose_archive_entry(
+                index, self.video_info, False)
+        self.assertEqual(entry.display_path, 'extra.zip/Show.S01E02.chs.srt')
+        self.assertEqual(entry.read(), b'2')
+
+    def test_names(self):
+        name = '简体.srt'.encode('gbk').decode('cp437')
+        index = self.index([(name, b'1'), ('dir/', b''), ('a.ass', b'22')])
+        self.assertEqual([(e.display_name, e.size) for e in index.subtitles],
+                         [('简体.srt', 1), ('a.ass', 2)])
+        self.assertIsNotNone(index.get(name))
+
+
+class TestSniffFormat(unittest.TestCase):
+
+    def test_signatures(self):
+        srt = '1\r\n00:00:01,000 --> 00:00:02,000\r\n字幕\r\n'.encode('gbk')
+        ass = '\ufeff[Script Info]\nTitle: a\n'.encode('utf-8')
+        cases = [
+            (make_zip([('a.srt', b'1')]), '.zip'),
+            (b'Rar!\x1a\x07\x00' + b'\0' * 20, '.rar'),
+            (b'Rar!\x1a\x07\x01\x00' + b'\0' * 20, '.rar'),
+            (b'7z\xbc\xaf\x27\x1c' + b'\0' * 20, '.7z'),
+            (gzip.compress(srt), '.gz'),
+            (srt, '.srt'),
+            ('1\n00:00:01.000 --> 00:00:02.000\n'.encode('utf-16'),
+             '.srt'),
+            (ass, '.ass'),
+            (b'<html></html>', None),
+            (b'', None)
+        ]
+        for data, datatype in cases:
+            self.assertEqual(sniff_format(data), datatype, data[:10])
+
+        # 文件对象只读取文件头并恢复位置
+        buff = BytesIO(srt)
+        buff.seek(3)
+        self.assertEqual(sniff_format(buff), '.srt')
+        self.assertEqual(buff.tell(), 3)
+
+    def test_open(self):
+        srt = b'1\n00:00:01,000 --> 00:00:02,000\nsub\n'
+        handler = open_archive(BytesIO(gzip.compress(srt)), '.gz', 'Show')
+        self.assertEqual(handler.namelist(), ['Show.srt'])
+        self.assertEqual(handler.read('Show.srt'), srt)
+        with self.assertRaises(ValueError):
+            open_archive(BytesIO(b''), 'Unknown')
+
+
+class TestArchiveBackends(unittest.TestCase):
+
+    def tearDown(self):
+        set_preference([])
+
+    def test_backends(self):
+        files = [('dir/Show.S01E01.srt', b'1' * 100), ('a.ass', b'2')]
+        data = make_zip(files)
+        for backend in BACKENDS:
+            if '.zip' not in backend.formats or not backend.available():
+                continue
+            handler = backend.open(BytesIO(data))
+            self.assertEqual(
+                [n for n in handler.namelist() if not n.endswith('/')],
+                [name for name, _ in files], backend.name)
+            for name, content in reversed(files):
+                self.assertEqual(handler.read(name), content, backend.name)
+                self.assertEqual(handler.open(name).read(), content)
+
+    @unittest.skipUnless(LibarchiveBackend.available(),
+                         'libarchive not installed')
+    def test_libarchive_cache(self):
+        # 途经的文件只在大小上限内保留
+        files = [('%d.srt' % i, str(i).encode() * 100) for i in range(5)]
+        handler = LibarchiveBackend.open(BytesIO(make_zip(files)))
+        handler.max_cache_size = 250
+        for name, content in reversed(files):
+            self.assertEqual(handler.read(name), content)
+        self.assertLessEqual(handler.cache_size, 250)
+        self.assertEqual(handler.read('0.srt'), files[0][1])
+
+        handler = LibarchiveBackend.open(BytesIO(make_zip(files)))
+        self.assertEqual(handler.read_many(['3.srt', '1.srt']),
+                         dict(files[1:4:2]))
+        self.assertEqual(handler.cache, {})
+        with self.assertRaises(KeyError):
+            handler.read_many(['missing.srt'])
+
+    def test_seven_zip_args(self):
+        # 单个文件与多个文件的解压都不把成员名作为通配符
+        self.assertIn('-spd', SevenZipBackend.read_args('a', '[G] S - 01.ass'))
+        self.assertIn('-spd', SevenZipBackend.extract_args(
+            'a', ['[G] S - 01.ass'], 'list', 'dir'))
+
+    def test_preference(self):
+        self.assertIs(get_backend('.zip'), ZipfileBackend)
+        set_preference(['bsdtar'])
+        if BsdtarBackend.available():
+            self.assertIs(get_backend('.zip'), BsdtarBackend)
+        self.assertIs(get_backend('.zip', names=['zipfile']), ZipfileBackend)
+        with self.assertRaises(ValueError):
+            set_preference(['unknown'])
+        with self.assertRaises(ValueError):
+            get_backend('.gz')
+
+
+class TestRarBatch(unittest.TestCase):
+
+    files = [('dir/[字幕组]Show.S01E01.srt', b'1' * 100), ('a.ass', b'2')]
+
+    def archive(self):
+        return RarArchive(BytesIO(make_rar(self.files)))
+
+    def test_stored(self):
+        # 未压缩的文件直接读取，不启动外部程序
+        archive = self.archive()
+        self.assertEqual(archive.namelist(), [n for n, _ in self.files])
+        with mock.patch('subprocess.run') as run:
+            self.assertEqual(archive.read_many([n for n, _ in self.files]),
+                             dict(self.files))
+        run.assert_not_called()
+
+    def check_batch(self, tool):
+        archive = self.archive()
+        archive.batch_tools = (tool,)
+        with mock.patch('subprocess.run', wraps=subprocess.run) as run:
+            result = archive._extract_batch([n for n, _ in self.files])
+        self.assertEqual(result, dict(self.files))
+        self.assertEqual(run.call_count, 1)
+
+    def read_all(self, handler):
+        names = [n for n, _ in self.files]
+        with mock.patch('subprocess.run', wraps=subprocess.run) as run:
+            self.assertEqual(read_members(handler, names), dict(self.files))
+        return run.call_count
+
+    def test_default_order(self):
+        # 按默认顺序选中的后端读取多个文件时至多启动一次外部程序
+        handler = open_archive(BytesIO(make_rar(self.files)), '.rar')
+        self.assertLessEqual(self.read_all(handler), 1)
+
+    def test_command_backends(self):
+        # 各可用后端读取多个文件时至多启动一次外部程序
+        tested = 0
+        for backend in BACKENDS:
+            if '.rar' not in backend.formats or not backend.available():
+                continue
+            handler = backend.open(BytesIO(make_rar(self.files)))
+            self.assertLessEqual(self.read_all(handler), 1, backend.name)
+            tested += 1
+        if not tested:
+            self.skipTest('no rar backend available')
+
+    @unittest.skipUnless(shutil.which('unrar'), 'unrar not installed')
+    def test_unrar(self):
+        self.check_batch('unrar')
+
+    @unittest.skipUnless(shutil.which('bsdtar'), 'bsdtar not installed')
+    def test_bsdtar(self):
+        self.check_batch('bsdtar')
+
+    def test_nested(self):
+        # 展开全部嵌套压缩包时一次读取
+        getsub = GetSubtitles('', False, False, False, False, False,
+                              False, False, 5, None, None)
+        data = make_rar([('a.zip', make_zip([('Show.S01E01.srt', b'1')])),
+                         ('b.zip', make_zip([('Show.S01E02.srt', b'2')]))])
+        index = getsub.get_file_list(RarArchive(BytesIO(data)))
+        with mock.patch.object(RarArchive, 'read_many',
+                               wraps=index.handler.read_many) as read_many:
+            subtitles = index.all_subtitles()
+        self.assertEqual([e.display_path for e in subtitles],
+                         ['a.zip/Show.S01E01.srt', 'b.zip/Show.S01E02.srt'])
+        self.assertEqual(read_many.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
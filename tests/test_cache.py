@@ -0,0 +1,319 @@
+# coding: utf-8
+
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from io import StringIO
+from unittest import mock
+from contextlib import redirect_stdout
+from collections import OrderedDict as order_dict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from getsub.cache import SearchCache, ArchiveStore, HTTPCache, LibraryState
+from getsub.cache import NegativeCache
+from getsub.downloader.transport import Transport
+from getsub.guess import GuessCache
+from getsub.downloader.downloader import Downloader
+from getsub.downloader import DownloaderManager
+from getsub.main import GetSubtitles
+
+
+class TestSearchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'search.sqlite')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_put(self):
+        cache = SearchCache(self.path)
+        identity = SearchCache.identity(
+            Downloader.get_keywords('Homeland.S02E12.720p.HDTV.x264-EVOLVE.mkv')[0])
+        self.assertEqual(identity, 'homeland%20s02|e12|hdtv|evolve|720p')
+        sub_dict = order_dict([
+            ('[SUBHD]b', {'lan': 8, 'link': 'b', 'session': None}),
+            ('[SUBHD]a', {'lan': 4, 'link': 'a', 'session': None})
+        ])
+        self.assertIsNone(cache.get('subhd', identity, 5))
+        cache.put('subhd', identity, 5, sub_dict)
+        self.assertEqual(cache.get('subhd', identity, 5), sub_dict)
+        self.assertEqual(list(cache.get('subhd', identity, 5)),
+                         ['[SUBHD]b', '[SUBHD]a'])
+        self.assertIsNone(cache.get('zimuku', identity, 5))
+        cache.close()
+
+        # 结果保存在本地文件中
+        cache = SearchCache(self.path)
+        self.assertEqual(cache.get('subhd', identity, 5), sub_dict)
+        cache.close()
+
+    def test_ttl(self):
+        cache = SearchCache(self.path, ttl=0.1)
+        cache.put('subhd', 'a', 5, {})
+        self.assertEqual(cache.get('subhd', 'a', 5), {})
+        time.sleep(0.2)
+        self.assertIsNone(cache.get('subhd', 'a', 5))
+        cache.close()
+
+    def test_eviction(self):
+        value = {'[SUBHD]a': {'lan': 8, 'link': 'x' * 20, 'session': None}}
+        size = len(json.dumps(list(value.items())))
+        cache = SearchCache(self.path, max_size=size * 3)
+        for name in 'abc':
+            cache.put('subhd', name, 5, value)
+            time.sleep(0.01)
+        cache.get('subhd', 'a', 5)  # a 最近被使用
+        cache.put('subhd', 'd', 5, value)
+        self.assertIsNotNone(cache.get('subhd', 'a', 5))
+        self.assertIsNone(cache.get('subhd', 'b', 5))
+        self.assertIsNotNone(cache.get('subhd', 'd', 5))
+        cache.close()
+
+    def test_search_site(self):
+        """
+        Test cached results are reported without --debug and empty results
+        are not cached
+        """
+
+        class FakeDownloader(object):
+            name = 'fake'
+            sub_dict = order_dict()
+
+            def get_subtitles(self, video_name, sub_num=5):
+                return self.sub_dict
+
+        fake = FakeDownloader()
+        getsub = GetSubtitles('', False, False, False, False, False,
+                              False, False, 5, None, None)
+        getsub.search_cache = SearchCache(self.path)
+        sub_dict = order_dict(
+            [('[FAKE]a', {'lan': 8, 'link': 'a', 'session': None})])
+        with mock.patch.object(fake, 'get_subtitles',
+                               wraps=fake.get_subtitles) as search:
+            outputs = []
+            # (网站返回的结果, search_site 的结果)，最后一次来自缓存
+            for returned, result in (({}, {}), ({}, {}),
+                                     (sub_dict, sub_dict), ({}, sub_dict)):
+                fake.sub_dict = returned
+                out = StringIO()
+                with redirect_stdout(out):
+                    self.assertEqual(
+                        getsub.search_site(fake, 'Show.S01E01.mkv', 'a'),
+                        result)
+                outputs.append(out.getvalue())
+        self.assertEqual(search.call_count, 3)
+        self.assertNotIn('from the cache', ''.join(outputs[:3]))
+        self.assertIn('fake: 1 search results from the cache', outputs[3])
+        getsub.search_cache.close()
+
+    def test_negative_ttl(self):
+        # 没有结果的查询记录的有效时间远短于搜索结果
+        negative, cache = NegativeCache(), SearchCache(self.path)
+        self.assertLess(negative.ttl * 10, cache.ttl)
+        cache.close()
+        negative.add('subhd', 'a')
+        self.assertTrue(negative.get('subhd', 'a'))
+        negative.clear()
+        self.assertFalse(negative.get('subhd', 'a'))
+        negative.close()
+
+
+class TestArchiveStore(unittest.TestCase):
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = ArchiveStore(directory, max_size=25)
+            self.assertIsNone(store.get('subhd', 'a'))
+            digest = store.put('subhd', 'a', '.zip', b'0' * 10)
+            self.assertEqual(store.get('subhd', 'a'), ('.zip', b'0' * 10))
+            # 内容相同的字幕包只保存一份
+            self.assertEqual(store.put('zimuku', 'b', '.zip', b'0' * 10),
+                             digest)
+            self.assertEqual(store.get('zimuku', 'b'), ('.zip', b'0' * 10))
+            time.sleep(0.01)
+            store.put('subhd', 'c', '.rar', b'1' * 10)
+            time.sleep(0.01)
+            store.get('subhd', 'a')
+            store.put('subhd', 'd', '.7z', b'2' * 10)
+            self.assertIsNone(store.get('subhd', 'c'))
+            self.assertIsNotNone(store.get('subhd', 'a'))
+            self.assertIsNotNone(store.get('subhd', 'd'))
+            store.close()
+
+    def test_download_archive(self):
+        """
+        Test only recognized archives are kept in the store
+        """
+
+        class FakeDownloader(object):
+            name = 'fake'
+            body = b'<html><body>captcha</body></html>'
+
+            def download_file(self, file_name, sub_url, session=None):
+                return 'Unknown', self.body, ''
+
+        fake = FakeDownloader()
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(DownloaderManager,
+                                  'get_downloader_by_choice_prefix',
+                                  return_value=fake), \
+                redirect_stdout(StringIO()):
+            getsub = GetSubtitles('', False, False, False, False, False,
+                                  False, False, 5, None, None)
+            getsub.archive_store = ArchiveStore(directory)
+            getsub.download_archive('[FAKE]a', 'a', None)
+            self.assertIsNone(getsub.archive_store.get('fake', 'a'))
+
+            fake.body = b'PK\x05\x06' + b'\x00' * 18
+            getsub.download_archive('[FAKE]a', 'a', None)
+            self.assertEqual(getsub.archive_store.get('fake', 'a'),
+                             ('.zip', fake.body))
+            getsub.archive_store.close()
+
+
+class CachingHandler(BaseHTTPRequestHandler):
+
+    requests = []
+
+    def do_GET(self):
+        etag = self.headers.get('If-None-Match')
+        CachingHandler.requests.append((self.path, etag))
+        if self.path == '/etag' and etag == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = '页面'.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/etag':
+            self.send_header('ETag', '"v1"')
+        else:
+            self.send_header('Cache-Control', 'max-age=60')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPCache(unittest.TestCase):
+
+    def test_revalidate(self):
+        server = HTTPServer(('127.0.0.1', 0), CachingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%d' % server.server_port
+        with tempfile.TemporaryDirectory() as directory:
+            transport = Transport()
+            transport.cache = HTTPCache(os.path.join(directory, 'http.sqlite'))
+            try:
+                for _ in range(2):
+                    self.assertEqual(
+                        transport.request('t', 'GET', url + '/etag').text,
+                        '页面')
+                    self.assertEqual(
+                        transport.request('t', 'GET', url + '/max-age').text,
+                        '页面')
+            finally:
+                transport.cache.close()
+                transport.close()
+                server.shutdown()
+        # max-age 内不再请求，ETag 发送条件请求
+        self.assertEqual(CachingHandler.requests, [
+            ('/etag', None), ('/max-age', None), ('/etag', '"v1"')])
+
+
+    def test_revalidated_headers(self):
+        # 304 响应中的新验证信息与缓存时间合并到保存的响应头
+        with tempfile.TemporaryDirectory() as directory:
+            cache = HTTPCache(os.path.join(directory, 'http.sqlite'))
+            cache.put('u', {'etag': '"v1"', 'Cache-Control': 'no-cache',
+                            'Content-Type': 'text/html'}, 'utf-8', b'body')
+            entry = cache.get('u')
+            self.assertFalse(entry['fresh'])
+            self.assertEqual(cache.validators(entry),
+                             {'If-None-Match': '"v1"'})
+            headers = cache.revalidated(
+                'u', {'ETag': '"v2"', 'Cache-Control': 'max-age=60',
+                      'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+            entry = cache.get('u')
+            self.assertEqual(entry['headers'], headers)
+            self.assertTrue(entry['fresh'])
+            self.assertEqual(cache.validators(entry), {
+                'If-None-Match': '"v2"',
+                'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+            self.assertEqual(entry['headers']['Content-Type'], 'text/html')
+            self.assertIsNone(cache.revalidated('missing', {}))
+            cache.close()
+
+
+class TestGuessCache(unittest.TestCase):
+
+    def test_guess(self):
+        name = 'Homeland.S02E12.PROPER.720p.HDTV.x264-EVOLVE.mkv'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'guess.sqlite')
+            cache = GuessCache(max_size=1)
+            cache.open(path)
+            info = cache.guess(name)
+            self.assertEqual((info['title'], info['season'], info['episode']),
+                             ('Homeland', 2, 12))
+            info['title'] = 'changed'  # 返回副本，不影响缓存
+            self.assertEqual(cache.guess(name)['title'], 'Homeland')
+            cache.guess('Other.S01E01.mkv')  # 超出内存容量
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            cache.close()
+
+            cache = GuessCache()
+            cache.open(path)
+            self.assertEqual(cache.guess(name)['season'], 2)
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+            cache.close()
+
+
+class TestLibraryState(unittest.TestCase):
+
+    def test_backoff(self):
+        with tempfile.TemporaryDirectory() as path:
+            state = LibraryState(os.path.join(path, 'library.sqlite'),
+                                 backoff=100, max_backoff=300)
+            video = os.path.join(path, 'a.mkv')
+            self.assertIsNone(state.check(video, 1, 2.0))
+
+            sub = os.path.join(path, 'a.ass')
+            open(sub, 'w').close()
+            state.record(video, 1, 2.0, 'success', candidate='[SUBHD]a',
+                         archive='http://a/1', subtitles=[sub])
+            self.assertEqual(state.check(video, 1, 2.0), 'success')
+            self.assertEqual(state.get(video)['candidate'], '[SUBHD]a')
+            self.assertEqual(state.get(video)['subtitles'], [sub])
+            # 字幕被删除后清除记录，重新处理
+            os.remove(sub)
+            self.assertIsNone(state.check(video, 1, 2.0))
+            self.assertIsNone(state.get(video))
+            # 文件改变后重新处理
+            state.record(video, 1, 2.0, 'success', subtitles=[sub])
+            self.assertIsNone(state.check(video, 1, 3.0))
+
+            retry = []
+            for _ in range(4):
+                state.record(video, 1, 3.0, 'failed', error='no_results')
+                entry = state.get(video)
+                retry.append(round(entry['retry_after'] - entry['attempted']))
+            self.assertEqual(retry, [100, 200, 300, 300])
+            self.assertEqual(state.check(video, 1, 3.0), 'backoff')
+
+            # 其它错误下次运行时重试
+            state.record(video, 1, 3.0, 'failed', error='Timeout')
+            self.assertIsNone(state.check(video, 1, 3.0))
+            self.assertEqual(state.get(video)['failures'], 0)
+            state.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
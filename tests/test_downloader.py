@@ -1,10 +1,114 @@
 # coding: utf-8
 
 import os
+import asyncio
+import zipfile
 import inspect
 import importlib
+import importlib.util
+import threading
 import unittest
-from getsub.downloader.downloader import Downloader
+from unittest import mock
+from contextlib import redirect_stdout
+from io import StringIO, BytesIO
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from getsub.cache import NegativeCache
+from getsub.downloader.downloader import Downloader, Request, DownloadBuffer
+from getsub.downloader.downloader import SearchCancelled
+from getsub.downloader.query_planner import QueryPlanner
+from getsub.downloader.zimuku import ZimukuDownloader
+from getsub.downloader.subhd import SubHDDownloader
+from getsub.downloader.html_parser import PARSERS, available, parser
+from getsub.downloader.html_parser import set_parser, parse_html
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.startswith('/q/'):
+            # 只有单个关键字的查询有结果
+            body = b'found' if '%20' not in self.path else b'empty'
+        else:
+            body = self.path.encode() * 100
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ZimukuHandler(BaseHTTPRequestHandler):
+
+    """ 模拟 Zimuku 的搜索页、详情页与下载页 """
+
+    search = (
+        '<div class="item"><div class="title"><p>Show</p><p>Show</p></div>'
+        '<table><tr><td class="first"><a href="/detail/1.html">'
+        'Show.S01E02.WEB-GRP</a></td><td class="tac lang">'
+        '<img src="/static/img/lang/china.gif"/>'
+        '<img src="http://uk.zimuku.la/lang/uk.gif"/></td>'
+        '<td><img src="/lang/jollyroger.gif"/></td></tr>'
+        # 语言格以外的图标及文件名中含有语言名的图标不计入语言值
+        '<tr><td class="first"><a href="/detail/2.html">'
+        'Show.S01E02.HDTV-GRP</a></td><td class="tac lang">'
+        '<img src="/static/uk/star.gif"/><img src="/lang/china-old.gif"/>'
+        '</td><td><img src="/lang/china.gif"/></td></tr></table></div>')
+    detail = ('<ul class="subinfo"><li><img src="/lang/jollyroger.gif"/>'
+              '</li></ul><a id="down1" href="/dld/%s.html">down</a>')
+    down = '<a rel="nofollow" href="/download/%s.zip">zip</a>'
+
+    def do_GET(self):
+        number = self.path.split('/')[-1].split('.')[0]
+        if self.path.startswith('/search'):
+            body = self.search
+        elif self.path.startswith('/detail/'):
+            body = self.detail % number
+        elif self.path.startswith('/dld/'):
+            body = self.down % number
+        else:
+            body = 'PK\x05\x06' + '\0' * 18
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalDownloader(Downloader):
+
+    name = 'local'
+    choice_prefix = '[LOCAL]'
+
+    def search(self, video_name, sub_num=5):
+        r = yield Request('GET', self.site_url + '/search')
+        return {self.choice_prefix + r.text[:7]:
+                {'lan': 8, 'link': self.site_url + '/sub', 'session': None}}
+
+    def fetch(self, file_name, sub_url, session=None):
+        response, data = yield Request('GET', sub_url, download=file_name)
+        return '.zip', data, ''
+
+    def plan(self, keywords):
+        planner = QueryPlanner(self.name, ' '.join(keywords), keywords,
+                               strip=True)
+        found = []
+        while not planner.finished:
+            batch = yield from planner.next_batch(
+                lambda query: Request('GET', self.site_url + '/q/' + query))
+            for query, r in batch:
+                if r.text == 'empty':
+                    planner.empty(query)
+                    continue
+                found.append(query)
+                planner.finish()
+                break
+        return found
 
 
 class TestDownloader(unittest.TestCase):
@@ -39,6 +143,293 @@ class TestDownloader(unittest.TestCase):
         for n, r in zip(names, results):
             self.assertEqual(Downloader.get_keywords(n)[0], r)
 
+    def test_transport(self):
+        """
+        Test downloaders share one session per site
+        """
+        from getsub.downloader import DownloaderManager
+
+        sessions = [d.session() for d in DownloaderManager.downloaders]
+        self.assertEqual(len(set(map(id, sessions))), len(sessions))
+        for d, s in zip(DownloaderManager.downloaders, sessions):
+            self.assertIs(d.session(), s)
+            self.assertEqual(s.headers['Accept-Language'],
+                             Downloader.header['Accept-Language'])
+
+    @unittest.skipUnless(importlib.util.find_spec('httpx'),
+                         'httpx not installed')
+    def test_sync_and_async_flow(self):
+        """
+        Test one downloader flow runs with both sync and async drivers
+        """
+
+        server = HTTPServer(('127.0.0.1', 0), LocalHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        downloader = LocalDownloader()
+        downloader.site_url = 'http://127.0.0.1:%d' % server.server_port
+        try:
+            with redirect_stdout(StringIO()):
+                sync_result = (
+                    downloader.get_subtitles('a.mkv'),
+                    downloader.download_file('sub', downloader.site_url + '/sub'))
+            self.assertEqual(list(sync_result[0].keys()), ['[LOCAL]/search'])
+            datatype, data, err_msg = sync_result[1]
+            self.assertEqual((datatype, data.getvalue(), err_msg),
+                             ('.zip', b'/sub' * 100, ''))
+            sync_result = (sync_result[0],
+                           (datatype, data.getvalue(), err_msg))
+
+            async def run():
+                result = (
+                    await downloader.async_get_subtitles('a.mkv'),
+                    await downloader.async_download_file(
+                        'sub', downloader.site_url + '/sub'))
+                await Downloader.async_transport.aclose()
+                return result
+
+            loop = asyncio.new_event_loop()
+            with redirect_stdout(StringIO()):
+                async_result = loop.run_until_complete(run())
+            loop.close()
+            datatype, data, err_msg = async_result[1]
+            self.assertEqual(
+                (async_result[0], (datatype, data.getvalue(), err_msg)),
+                sync_result)
+        finally:
+            server.shutdown()
+
+    @unittest.skipUnless(importlib.util.find_spec('httpx'),
+                         'httpx not installed')
+    def test_batch_errors(self):
+        """
+        Test a request batch keeps order and returns errors in place
+        """
+
+        server = HTTPServer(('127.0.0.1', 0), LocalHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        site_url = 'http://127.0.0.1:%d' % server.server_port
+
+        def flow():
+            responses = yield [
+                Request('GET', site_url + '/%d' % i, return_error=True)
+                for i in range(5)
+            ] + [Request('GET', 'http://127.0.0.1:1/', return_error=True)]
+            return [r if isinstance(r, Exception) else r.text[:2]
+                    for r in responses]
+
+        downloader = LocalDownloader()
+        downloader.concurrency = 2
+        try:
+            with Downloader.request_stats() as stats:
+                result = downloader.run_sync(flow())
+            self.assertEqual(result[:5], ['/%d' % i for i in range(5)])
+            self.assertIsInstance(result[5], Exception)
+            self.assertEqual(stats.requests, 6)
+
+            async def run():
+                result = await downloader.run_async(flow())
+                await Downloader.async_transport.aclose()
+                return result
+
+            loop = asyncio.new_event_loop()
+            with Downloader.request_stats() as stats:
+                result = loop.run_until_complete(run())
+            loop.close()
+            self.assertEqual(result[:5], ['/%d' % i for i in range(5)])
+            self.assertIsInstance(result[5], Exception)
+            self.assertEqual(stats.requests, 6)
+        finally:
+            server.shutdown()
+
+    def test_cancel(self):
+        """
+        Test a cancelled flow stops before its next command
+        """
+
+        server = HTTPServer(('127.0.0.1', 0), LocalHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        site_url = 'http://127.0.0.1:%d' % server.server_port
+        cancel = threading.Event()
+        closed = []
+
+        def flow():
+            try:
+                for i in range(3):
+                    yield Request('GET', site_url + '/%d' % i)
+                    cancel.set()  # 第一个请求完成后取消
+            finally:
+                closed.append(True)
+
+        downloader = LocalDownloader()
+        try:
+            with Downloader.request_stats() as stats, \
+                    Downloader.cancel_on(cancel):
+                with self.assertRaises(SearchCancelled):
+                    downloader.run_sync(flow())
+            self.assertEqual((stats.requests, closed), (1, [True]))
+        finally:
+            server.shutdown()
+
+    def test_zimuku_lazy_links(self):
+        """
+        Test Zimuku resolves download links only for the chosen candidate
+        """
+
+        server = HTTPServer(('127.0.0.1', 0), ZimukuHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        site_url = 'http://127.0.0.1:%d' % server.server_port
+        negative_cache = Downloader.negative_cache
+        Downloader.negative_cache = None
+        try:
+            with mock.patch.multiple(ZimukuDownloader, site_url=site_url,
+                                     search_url=site_url + '/search?q='), \
+                    mock.patch.object(Downloader, 'query_width', 1):
+                downloader = ZimukuDownloader()
+                with Downloader.request_stats() as stats, \
+                        redirect_stdout(StringIO()):
+                    sub_dict = downloader.get_subtitles(
+                        'Show.S01E02.720p.WEB-GRP.mkv', sub_num=2)
+                # 一次搜索，只有缺少语言图标的候选字幕获取详情页
+                self.assertEqual(stats.requests, 2)
+                self.assertEqual(
+                    [(info['lan'], info['link'], info['resolve'])
+                     for info in sub_dict.values()],
+                    [(8, site_url + '/dld/2.html', 'down'),
+                     (5, site_url + '/detail/1.html', 'detail')])
+
+                # 详情页出错时保留候选字幕，被选中时再解析
+                with mock.patch.object(ZimukuHandler, 'detail', 'error %s'), \
+                        redirect_stdout(StringIO()):
+                    sub_dict = downloader.get_subtitles(
+                        'Show.S01E02.720p.WEB-GRP.mkv', sub_num=2)
+                self.assertEqual(
+                    [(info['lan'], info['link'], info['resolve'])
+                     for info in sub_dict.values()],
+                    [(5, site_url + '/detail/1.html', 'detail'),
+                     (0, site_url + '/detail/2.html', 'detail')])
+
+                with Downloader.request_stats() as stats:
+                    link = downloader.resolve_link(
+                        site_url + '/detail/1.html', 'detail')
+                self.assertEqual(link, site_url + '/download/1.zip')
+                self.assertEqual(stats.requests, 2)
+                self.assertIsNone(downloader.resolve_link(
+                    site_url + '/download/1.zip', 'down'))
+
+                # 按季搜索不获取详情页，语言值在结果中缺少时为 0
+                with Downloader.request_stats() as stats, \
+                        redirect_stdout(StringIO()):
+                    sub_dict = downloader.get_subtitles('Show s01', sub_num=10)
+                self.assertEqual(stats.requests, 1)
+                self.assertEqual(
+                    [(info['lan'], info['resolve'])
+                     for info in sub_dict.values()],
+                    [(5, 'detail'), (0, 'detail')])
+        finally:
+            Downloader.negative_cache = negative_cache
+            server.shutdown()
+
+    def test_html_parser(self):
+        """
+        Test strainers keep the needed nodes with every available parser
+        """
+
+        html = ('<html><head><script>var a;</script></head><body>'
+                '<ul class="nav"><li>nav</li></ul>'
+                '<div class="item prel clearfix"><table><tr>'
+                '<td class="first"><a href="/detail/1.html">sub</a></td>'
+                '</tr></table></div><div class="persub"><h1>shooter</h1></div>'
+                '<a rel="nofollow noopener" href="/download/1">zip</a>'
+                '</body></html>')
+        subhd_html = ('<html><body><div class="container"><div class="row">'
+                      '<small class="text-secondary">总共 1 条</small>'
+                      '<div class="mb-4 bg-white rounded shadow-sm">'
+                      '<div class="f12 pt-1"><a href="/a/1">sub</a></div>'
+                      '</div><div class="footer">footer</div>'
+                      '</div></div></body></html>')
+        try:
+            for name in PARSERS:
+                if not available(name):
+                    continue
+                set_parser(name)
+                self.assertEqual(parser(), name)
+                bs_obj = parse_html(html, ZimukuDownloader.search_only)
+                self.assertEqual(
+                    [div['class'] for div in bs_obj.find_all('div')],
+                    [['item', 'prel', 'clearfix'], ['persub']])
+                self.assertEqual(bs_obj.find('td', {'class': 'first'})
+                                 .parent.name, 'tr')
+                self.assertIsNone(bs_obj.find('ul'))
+                bs_obj = parse_html(html, ZimukuDownloader.down_only)
+                self.assertEqual(bs_obj.find('a', {'rel': 'nofollow'})
+                                 .attrs['href'], '/download/1')
+                self.assertIsNone(bs_obj.find('script'))
+                # 只保留结果数与结果框，不保留外层的 div
+                bs_obj = parse_html(subhd_html, SubHDDownloader.search_only)
+                self.assertEqual(bs_obj.find('small').text, '总共 1 条')
+                self.assertEqual(
+                    [div['class'] for div in bs_obj.find_all('div')],
+                    [['mb-4', 'bg-white', 'rounded', 'shadow-sm'],
+                     ['f12', 'pt-1']])
+            with self.assertRaises(ValueError):
+                set_parser('unknown')
+        finally:
+            set_parser(None)
+
+    def test_download_buffer(self):
+        """
+        Test download buffer spills to a temporary file and reads as a file
+        """
+
+        raw = BytesIO()
+        with zipfile.ZipFile(raw, 'w') as z:
+            z.writestr('a.srt', 'subtitle' * 10)
+        raw = raw.getvalue()
+
+        buffer = DownloadBuffer(max_size=len(raw) - 1)
+        buffer.write(raw[:10])
+        self.assertFalse(buffer.spilled)
+        buffer.write(raw[10:])
+        self.assertTrue(buffer.spilled)
+        self.assertEqual((len(buffer), buffer.getvalue()), (len(raw), raw))
+        self.assertEqual(b''.join(buffer.chunks(7)), raw)
+        buffer.seek(0)
+        with zipfile.ZipFile(buffer) as z:
+            self.assertEqual(z.read('a.srt'), b'subtitle' * 10)
+        buffer.close()
+
+        # 已知内容大小超出限制时直接写入临时文件
+        self.assertTrue(DownloadBuffer(size=100, max_size=10).spilled)
+        self.assertFalse(DownloadBuffer(size=10, max_size=10).spilled)
+
+    def test_query_planner(self):
+        """
+        Test keyword relaxation ladder and negative cache
+        """
+
+        planner = QueryPlanner('t', 'a b c', ['a', 'b', 'c'])
+        self.assertEqual(planner.pending, ['a b c', 'a b ', 'a  '])
+
+        server = HTTPServer(('127.0.0.1', 0), LocalHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        downloader = LocalDownloader()
+        downloader.site_url = 'http://127.0.0.1:%d' % server.server_port
+        negative_cache = Downloader.negative_cache
+        Downloader.negative_cache = NegativeCache()
+        keywords = ['show', 'e01', 'web', 'grp']
+        try:
+            with Downloader.request_stats() as stats:
+                found = downloader.run_sync(downloader.plan(keywords))
+            self.assertEqual(found, ['show'])
+            self.assertEqual((stats.requests, stats.skipped), (4, 0))
+            with Downloader.request_stats() as stats:
+                found = downloader.run_sync(downloader.plan(keywords))
+            self.assertEqual(found, ['show'])
+            self.assertEqual((stats.requests, stats.skipped), (1, 3))
+        finally:
+            Downloader.negative_cache = negative_cache
+            server.shutdown()
+
 
 class TestSubDownloaders(unittest.TestCase):
 
@@ -91,7 +482,10 @@ class TestSubDownloaders(unittest.TestCase):
             _check_format(result, dname)
 
             # test download
-            link = list(result.values())[0]['link']
+            sub_info = list(result.values())[0]
+            link = sub_info['link']
+            if sub_info.get('resolve'):
+                link = downloader().resolve_link(link, sub_info['resolve'])
             data_type, sub_date_bytes, _ = downloader().download_file('', link)
             self.assertIsNotNone(sub_date_bytes, dname +
                                  ' fails downloading file')
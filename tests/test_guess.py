@@ -0,0 +1,70 @@
+# coding: utf-8
+
+import unittest
+
+from guessit import guessit
+
+from getsub.guess import parse_release
+
+
+FIELDS = ('title', 'season', 'episode', 'year', 'type', 'source',
+          'release_group', 'screen_size', 'streaming_service')
+
+# 快速解析应与 guessit 一致的名称
+STANDARD = [
+    'Show.S01E01.ShowName.1080p.AMZN.WEB-DL.DDP5.1.H.264-GRP.mkv',
+    'Homeland.S02E12.PROPER.720p.HDTV.x264-EVOLVE.mkv',
+    'La.La.Land.2016.1080p.BluRay.x264.Atmos.TrueHD.7.1-HDChina.mkv',
+    'Westworld.S02E10.720p.HDTV.x264-AVS.mkv',
+    'Game.of.Thrones.S08E06.The.Iron.Throne.1080p.AMZN.WEB-DL.DDP5.1.H.264-GoT.mkv',
+    'Stranger.Things.S03E01.1080p.NF.WEBRip.DDP5.1.x264-NTG.mkv',
+    'Inception.2010.1080p.BluRay.x264-SPARKS.mkv',
+    'The.Handmaids.Tale.S02E01.June.1080p.HULU.WEBRip.AAC2.0.x264-TBS.mkv',
+    'Friends.S01E01.DVDRip.XviD-SAiNTS.avi',
+    'Breaking.Bad.S05E16.REPACK.720p.HDTV.x264-IMMERSE.mkv',
+    'Chernobyl.S01E05.1080p.AMZN.WEB-DL.DDP5.1.H.264-NTb',
+    'Joker.2019.1080p.BluRay.x265.10bit.AAC5.1-RARBG.mkv',
+    'Ozark.S03E01.INTERNAL.1080p.WEB.H264-AMRAP.mkv',
+    'Better.Call.Saul.S05E01.1080p.AMZN.WEB-DL.DD+5.1.H.264-AJP69.mkv',
+    'Mindhunter.S02E01.1080p.NF.WEB-DL.DDP5.1.HDR.HEVC-NTb.mkv',
+    'Show.S01E01.1080i.HDTV.MPEG2-GRP.ts',
+    'Show.s01e01.720p.hdtv.x264-grp.mkv',
+]
+
+# 可能有歧义，应交给 guessit 的名称
+AMBIGUOUS = [
+    'Hanzawa.Naoki.Ep10.Final.Chi_Jap.BDrip.1280X720-ZhuixinFan.mp4',
+    'The.Office.US.S05E14.720p.WEB-DL.DD5.1.H.264-NTb.mkv',
+    'Arrival.2016.2160p.UHD.BluRay.x265-TERMiNAL.mkv',
+    'Blade.Runner.2049.2017.1080p.WEB-DL.H264.AC3-EVO.mkv',
+    'The.Mandalorian.S01E01.1080p.DSNP.WEB-DL.DDP5.1.H.264-MZABI.mkv',
+    'Parasite.2019.KOREAN.1080p.BluRay.x264.DTS-HDChina.mkv',
+    'Movie.2019.1080p.BluRay.x264.DTS-HDChina.mkv',
+    'Lost.S01E01.Pilot.Part.1.720p.BluRay.x264-SiNNERS.mkv',
+    'Movie.Title.2018.1080p.HDRip.x264-GRP.mkv',
+    '1917.2019.1080p.BluRay.x264-SPARKS.mkv',
+    '[字幕组] 名称 第01集.mp4',
+    'Show.S01E01.720p.HDTV.x264.mkv',
+]
+
+
+class TestParseRelease(unittest.TestCase):
+
+    def test_conformance(self):
+        for name in STANDARD:
+            info = parse_release(name)
+            self.assertIsNotNone(info, name)
+            expected = guessit(name)
+            for field in FIELDS:
+                value = expected.get(field)
+                if value is not None:
+                    value = value if isinstance(value, int) else str(value)
+                self.assertEqual(info.get(field), value, (name, field))
+
+    def test_fallback(self):
+        for name in AMBIGUOUS:
+            self.assertIsNone(parse_release(name), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,359 @@
+# coding: utf-8
+
+import io
+import os
+import re
+import time
+import random
+import zipfile
+import tempfile
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+
+from getsub import guess
+from getsub.main import GetSubtitles
+from getsub.extract_pool import _init_worker
+from getsub.archive_backends import preference
+from getsub.cache import LibraryState, SearchCache
+from getsub.downloader.downloader import Downloader, Sleep
+from getsub.downloader import DownloaderManager
+from getsub.pipeline import Pipeline, OutputRouter, VideoTask
+from getsub.pipeline import parse_stage_jobs
+
+
+class FakeDownloader(object):
+
+    name = 'fake'
+    choice_prefix = '[FAKE]'
+
+    def get_subtitles(self, video_name, sub_num=5):
+        time.sleep(random.random() * 0.05)
+        if video_name == 'Show s01':
+            # 按季搜索，结果中每集一个字幕包
+            names = ['Show.S01E%02d.720p.HDTV.x264-GRP.mkv' % i
+                     for i in (1, 2, 4, 5, 6)]
+            return {self.choice_prefix + name:
+                    {'lan': 8, 'link': name, 'session': None}
+                    for name in names}
+        if 'E03' in video_name:
+            return {}
+        return {self.choice_prefix + video_name:
+                {'lan': 8, 'link': video_name, 'session': None}}
+
+    def download_file(self, file_name, sub_url, session=None):
+        time.sleep(random.random() * 0.05)
+        buff = io.BytesIO()
+        with zipfile.ZipFile(buff, 'w') as z:
+            z.writestr(sub_url.replace('.mkv', '.chs.ass'), 'sub')
+        return '.zip', buff.getvalue(), ''
+
+
+class FakePackDownloader(FakeDownloader):
+
+    """ 按季搜索只有一个包含所有集字幕的季包 """
+
+    def get_subtitles(self, video_name, sub_num=5):
+        return {self.choice_prefix + 'Show.S01.720p.HDTV.x264-GRP':
+                {'lan': 8, 'link': 'pack', 'session': None}}
+
+    def download_file(self, file_name, sub_url, session=None):
+        time.sleep(random.random() * 0.05)
+        buff = io.BytesIO()
+        with zipfile.ZipFile(buff, 'w') as z:
+            for i in range(1, 7):
+                z.writestr('Show.S01E%02d.720p.HDTV.x264-GRP.chs.ass' % i,
+                           'sub %d' % i)
+        return '.zip', buff.getvalue(), ''
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_parse_stage_jobs(self):
+        self.assertEqual(
+            parse_stage_jobs(4, 'search=8, extract=2'),
+            {'parse': 1, 'search': 8, 'download': 4, 'extract': 2})
+        with self.assertRaises(ValueError):
+            parse_stage_jobs(4, 'upload=2')
+
+    def test_render(self):
+        buffer = ['a\n', 'Searching...', '\r', 'b\n', 'Get 10%\r']
+        self.assertEqual(OutputRouter.render(buffer), 'a\nb\n')
+
+    def test_pipeline_order(self):
+        """
+        Test pipeline keeps output and summary ordered per video
+        """
+
+        fake = FakeDownloader()
+        with tempfile.TemporaryDirectory() as path:
+            names = ['Show.S01E%02d.720p.HDTV.x264-GRP.mkv' % i
+                     for i in range(1, 7)]
+            for name in names:
+                open(os.path.join(path, name), 'w').close()
+
+            results = []
+            # 串行、流水线、流水线 + 解压进程池，及边扫描边处理
+            for jobs, procs, stream in ((None, None, False),
+                                        (4, None, False), (4, 2, False),
+                                        (None, None, True), (4, None, True)):
+                out = io.StringIO()
+                with mock.patch.object(DownloaderManager, 'downloaders',
+                                       (fake,)), \
+                        mock.patch.object(DownloaderManager,
+                                          'get_downloader_by_choice_prefix',
+                                          return_value=fake), \
+                        redirect_stdout(out):
+                    getsub = GetSubtitles(
+                        path, False, False, False, False, True, False,
+                        False, None, None, None, jobs=jobs,
+                        extract_procs=procs, stream=stream)
+                    result = getsub.start()
+                # 边扫描边处理时汇总中显示到第一个字幕的时间，比较输出时去掉
+                output, timed = re.subn(
+                    r'  first subtitle: [\d.]+s  total time: [\d.]+s', '',
+                    out.getvalue())
+                self.assertEqual(timed, int(stream))
+                results.append(output)
+                self.assertEqual(
+                    (result['total'], result['success'], result['fail']),
+                    (6, 5, 1))
+                self.assertGreater(result['first_subtitle'], 0)
+                for name in names:
+                    if 'E03' in name:
+                        continue
+                    sub = os.path.join(path, name.replace('.mkv', '.ass'))
+                    self.assertTrue(os.path.exists(sub))
+                    os.remove(sub)
+
+            for one in results[1:]:
+                self.assertEqual(results[0], one)
+
+    def test_library_state(self):
+        """
+        Test videos without results are skipped and deleted subtitles
+        are downloaded again
+        """
+
+        fake = FakeDownloader()
+        with tempfile.TemporaryDirectory() as path:
+            videos = os.path.join(path, 'videos')
+            os.mkdir(videos)
+            names = ['Show.S01E%02d.720p.HDTV.x264-GRP.mkv' % i
+                     for i in range(1, 4)]
+            for name in names:
+                open(os.path.join(videos, name), 'w').close()
+
+            results = []
+            for _ in range(2):
+                with mock.patch.object(DownloaderManager, 'downloaders',
+                                       (fake,)), \
+                        mock.patch.object(DownloaderManager,
+                                          'get_downloader_by_choice_prefix',
+                                          return_value=fake), \
+                        mock.patch.object(fake, 'get_subtitles',
+                                          wraps=fake.get_subtitles) as search, \
+                        redirect_stdout(io.StringIO()):
+                    getsub = GetSubtitles(
+                        videos, False, False, False, False, False, False,
+                        False, None, None, None)
+                    getsub.library_state = LibraryState(
+                        os.path.join(path, 'library.sqlite'))
+                    result = getsub.start()
+                    getsub.library_state.close()
+                results.append((result['success'], result['fail'],
+                                result['skipped'], search.call_count))
+                # 删除下载的字幕，第二次运行由记录判断
+                for name in os.listdir(videos):
+                    if name.endswith('.ass'):
+                        os.remove(os.path.join(videos, name))
+
+            # 第一次运行：按季搜索一次，E03 没有分配到候选字幕再单独搜索；
+            # 第二次运行：字幕已被删除的 E01、E02 重新按季搜索，E03 等待重试
+            self.assertEqual(results, [(2, 1, 0, 2), (2, 0, 1, 1)])
+
+    def test_season_search(self):
+        """
+        Test episodes of a season share one search
+        """
+
+        fake = FakeDownloader()
+        with tempfile.TemporaryDirectory() as path:
+            names = ['Show.S01E%02d.720p.HDTV.x264-GRP.mkv' % i
+                     for i in range(1, 7)]
+            for name in names:
+                open(os.path.join(path, name), 'w').close()
+
+            counts = []
+            for jobs, season_search in ((None, True), (4, True),
+                                        (None, False)):
+                with mock.patch.object(DownloaderManager, 'downloaders',
+                                       (fake,)), \
+                        mock.patch.object(DownloaderManager,
+                                          'get_downloader_by_choice_prefix',
+                                          return_value=fake), \
+                        mock.patch.object(fake, 'get_subtitles',
+                                          wraps=fake.get_subtitles) as search, \
+                        redirect_stdout(io.StringIO()):
+                    getsub = GetSubtitles(
+                        path, False, False, False, False, True, False,
+                        False, None, None, None, jobs=jobs,
+                        season_search=season_search)
+                    result = getsub.start()
+                self.assertEqual((result['success'], result['fail']), (5, 1))
+                counts.append(search.call_count)
+                for name in names:
+                    sub = os.path.join(path, name.replace('.mkv', '.ass'))
+                    if os.path.exists(sub):
+                        os.remove(sub)
+            self.assertEqual(counts, [2, 2, 6])
+
+    def test_season_packs(self):
+        """
+        Test one season pack provides subtitles for all episodes
+        """
+
+        fake = FakePackDownloader()
+        with tempfile.TemporaryDirectory() as path:
+            names = ['Show.S01E%02d.720p.HDTV.x264-GRP.mkv' % i
+                     for i in range(1, 7)]
+            for name in names:
+                open(os.path.join(path, name), 'w').close()
+
+            downloads = []
+            for jobs, procs, season_packs in ((None, None, True),
+                                              (4, None, True), (4, 2, True),
+                                              (None, None, False)):
+                with mock.patch.object(DownloaderManager, 'downloaders',
+                                       (fake,)), \
+                        mock.patch.object(DownloaderManager,
+                                          'get_downloader_by_choice_prefix',
+                                          return_value=fake), \
+                        mock.patch.object(fake, 'download_file',
+                                          wraps=fake.download_file) as fetch, \
+                        redirect_stdout(io.StringIO()):
+                    getsub = GetSubtitles(
+                        path, False, False, False, False, True, False,
+                        False, None, None, None, jobs=jobs,
+                        extract_procs=procs, season_packs=season_packs)
+                    result = getsub.start()
+                self.assertEqual((result['success'], result['fail']), (6, 0))
+                downloads.append(fetch.call_count)
+                for i, name in enumerate(names):
+                    sub = os.path.join(path, name.replace('.mkv', '.ass'))
+                    with open(sub) as f:
+                        self.assertEqual(f.read(), 'sub %d' % (i + 1))
+                    os.remove(sub)
+
+            # 流水线模式下只有第一个视频预先下载季包，
+            # 先到解压阶段的视频可能再下载一次
+            self.assertEqual(downloads[0], 1)
+            self.assertLessEqual(max(downloads[1:3]), 2)
+            self.assertEqual(downloads[3], 6)
+
+    def test_extract_worker(self):
+        """
+        Test extract workers do not reuse the parent's guess cache
+        """
+
+        cache = guess.guess_cache
+        try:
+            with mock.patch('getsub.extract_pool._worker_ready', False):
+                _init_worker(preference())
+            self.assertIsNot(guess.guess_cache, cache)
+            self.assertIsNone(guess.guess_cache.conn)
+        finally:
+            guess.guess_cache = cache
+
+        with redirect_stdout(io.StringIO()) as out:
+            one = GetSubtitles('', False, False, False, False, False, False,
+                               False, None, None, None, extract_procs=2)
+        self.assertIsNone(one.extract_pool)
+        self.assertIn('--extract-procs', out.getvalue())
+
+    def test_scan_error(self):
+        """
+        Test an error raised while scanning reaches the main thread
+        """
+
+        def videos():
+            yield 'Show.S01E01.mkv', {'path': '', 'have_subtitle': 1}
+            raise OSError('scan failed')
+
+        getsub = GetSubtitles('', False, False, False, False, False, False,
+                              False, None, None, None)
+        pipeline = Pipeline(getsub, parse_stage_jobs(2))
+        with redirect_stdout(io.StringIO()):
+            with self.assertRaises(OSError):
+                list(pipeline.run(videos()))
+
+    def test_search_fan_out(self):
+        """
+        Test sites are searched concurrently and merged in priority order
+        """
+
+        class SlowDownloader(FakeDownloader):
+            def __init__(self, choice_prefix, delay):
+                self.choice_prefix = choice_prefix
+                self.delay = delay
+
+            def get_subtitles(self, video_name, sub_num=5):
+                time.sleep(self.delay)
+                return {self.choice_prefix + video_name:
+                        {'lan': 8, 'link': video_name, 'session': None}}
+
+        downloaders = (SlowDownloader('[A]', 0.3), SlowDownloader('[B]', 0.3),
+                       SlowDownloader('[C]', 5))
+        name = 'Show.S01E01.mkv'
+        with mock.patch.object(DownloaderManager, 'downloaders', downloaders),\
+                redirect_stdout(io.StringIO()):
+            getsub = GetSubtitles(name, False, False, False, False, False,
+                                  False, False, 5, None, None,
+                                  search_timeout=1)
+            task = VideoTask(0, name, {})
+            begin = time.time()
+            getsub.search_video(task)
+        self.assertLess(time.time() - begin, 2)
+        self.assertEqual(list(task.sub_dict.keys()),
+                         ['[A]' + name, '[B]' + name])
+
+    def test_search_cancel(self):
+        """
+        Test searches still running after the timeout stop and are not cached
+        """
+
+        steps = []
+
+        class FlowDownloader(Downloader):
+            name = 'flow'
+
+            def search(self, video_name, sub_num=5):
+                for i in range(50):
+                    steps.append(i)
+                    yield Sleep(0.05)
+                return {'[FLOW]a': {'lan': 8, 'link': 'a', 'session': None}}
+
+        name = 'Show.S01E01.mkv'
+        with tempfile.TemporaryDirectory() as path, \
+                mock.patch.object(DownloaderManager, 'downloaders',
+                                  (FlowDownloader(),)), \
+                redirect_stdout(io.StringIO()):
+            getsub = GetSubtitles(name, False, False, False, False, False,
+                                  False, False, 5, None, None,
+                                  search_timeout=0.3)
+            getsub.search_cache = SearchCache(
+                os.path.join(path, 'search.sqlite'))
+            task = VideoTask(0, name, {})
+            getsub.search_video(task)
+            time.sleep(0.2)
+            stopped = len(steps)
+            time.sleep(0.3)
+            self.assertEqual(len(steps), stopped)
+            identity = SearchCache.identity(Downloader.get_keywords(name)[0])
+            self.assertIsNone(getsub.search_cache.get('flow', identity, 5))
+            getsub.search_cache.close()
+        self.assertEqual(len(task.sub_dict), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# coding: utf-8
+
+import os
+import tempfile
+import unittest
+from io import StringIO
+from contextlib import redirect_stdout
+
+from getsub.main import GetSubtitles
+from getsub.scan import DirectoryScanner, subtitle_stems
+
+
+class TestDirectoryScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        for path in ('a/b/c', 'a/d', 'e', 'store/x'):
+            os.makedirs(os.path.join(self.root, path))
+        for path in ('Show.S01E01.mkv', 'Show.S01E01.srt',
+                     'a/Show.S01E02.mp4', 'a/Show.S01E02.zh.ass',
+                     'a/b/Show.S01E03.mkv', 'a/b/c/Show.S01E04.mkv',
+                     'a/d/readme.txt', 'e/Show.S01E05.avi',
+                     'store/x/Show.S01E03.ssa'):
+            open(os.path.join(self.root, path), 'w').close()
+        os.symlink(os.path.join(self.root, 'a'),
+                   os.path.join(self.root, 'e', 'link'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_walk_order(self):
+        expected = [(root, sorted(files)) for root, dirs, files
+                    in os.walk(self.root)]
+        for workers in (None, 4):
+            result = [(root, sorted(files)) for root, files
+                      in DirectoryScanner(workers).walk(self.root)]
+            self.assertEqual(sorted(result), sorted(expected))
+            # 子目录顺序与 os.walk 相同
+            walk_roots = [root for root, _, _ in os.walk(self.root)]
+            self.assertEqual([root for root, _ in result], walk_roots)
+
+    def test_subtitle_stems(self):
+        self.assertEqual(
+            subtitle_stems(['a.srt', 'b.zh.ass', 'c.mkv', 'd.zh'],
+                           ['.srt', '.ass']),
+            {'a', 'b', 'b.zh'})
+
+    def test_get_path_name(self):
+        getsub = GetSubtitles('', False, False, False, False, False,
+                              False, False, 5, None, None)
+        with redirect_stdout(StringIO()):
+            video_dict = getsub.get_path_name(self.root, '')
+        have_subtitle = {'Show.S01E01.mkv': 1, 'Show.S01E02.mp4': 1,
+                         'Show.S01E03.mkv': 0, 'Show.S01E04.mkv': 0,
+                         'Show.S01E05.avi': 0}
+        expected = [(name, os.path.abspath(root), have_subtitle[name])
+                    for root, dirs, files in os.walk(self.root)
+                    for name in files if name in have_subtitle]
+        self.assertEqual(
+            [(name, info['path'], info['have_subtitle'])
+             for name, info in video_dict.items()], expected)
+
+        # 字幕存放目录中的字幕按文件名匹配
+        getsub.scan_jobs = 2
+        store = os.path.join(self.root, 'store')
+        with redirect_stdout(StringIO()):
+            video_dict = getsub.get_path_name(
+                os.path.join(self.root, 'a'), store)
+        self.assertEqual(
+            {name: (info['path'], info['have_subtitle'])
+             for name, info in video_dict.items()},
+            {'Show.S01E02.mp4': (store, 1),
+             'Show.S01E03.mkv': (store, 1),
+             'Show.S01E04.mkv': (store, 0)})
+
+
+if __name__ == '__main__':
+    unittest.main()
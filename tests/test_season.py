@@ -0,0 +1,118 @@
+# coding: utf-8
+
+import threading
+import unittest
+
+from getsub.season import SeasonSearch, SeasonPacks
+
+
+class TestSeasonSearch(unittest.TestCase):
+
+    def test_group(self):
+        season = SeasonSearch(5)
+        for name in ('Show.S01E01.720p.HDTV.x264-GRP.mkv',
+                     'show.s01e02.720p.HDTV.x264-GRP.mkv',
+                     'Show.S02E01.720p.HDTV.x264-GRP.mkv',
+                     'Movie.2019.1080p.BluRay.x264-GRP.mkv'):
+            season.add(name)
+        self.assertEqual(
+            season.group('Show.S01E03.720p.HDTV.x264-GRP.mkv'), 'Show s01')
+        # 只有一集的季与电影单独搜索
+        self.assertIsNone(
+            season.group('Show.S02E01.720p.HDTV.x264-GRP.mkv'))
+        self.assertIsNone(
+            season.group('Movie.2019.1080p.BluRay.x264-GRP.mkv'))
+
+    def test_assign(self):
+        season = SeasonSearch(2)
+        results = [
+            {'[A]Show.S01E01.720p.HDTV': {'lan': 4, 'link': 'a1'},
+             '[A]Show.S01.Complete.720p': {'lan': 8, 'link': 'a0'},
+             '[A]Show.S01E02.720p.HDTV': {'lan': 4, 'link': 'a2'},
+             '[A]Show.S02E02.720p.HDTV': {'lan': 4, 'link': 'b2'},
+             '[A]Show.S01E02.1080p.WEB': {'lan': 1, 'link': 'c2'}},
+            None,
+            {'[B]Show 第一季': {'lan': 4, 'link': 'd0'}}
+        ]
+        sub_dict = season.assign(
+            results, 'Show.S01E02.720p.HDTV.x264-GRP.mkv')
+        # 同一集在前，季包在后，每个下载器最多 sub_num 个
+        self.assertEqual(
+            list(sub_dict),
+            ['[A]Show.S01E02.720p.HDTV', '[A]Show.S01E02.1080p.WEB',
+             '[B]Show 第一季'])
+        # 各集得到独立的字典
+        sub_dict['[A]Show.S01E02.720p.HDTV']['link'] = 'changed'
+        self.assertEqual(results[0]['[A]Show.S01E02.720p.HDTV']['link'], 'a2')
+
+    def test_search_once(self):
+        season = SeasonSearch(5)
+        for i in range(1, 9):
+            season.add('Show.S01E%02d.720p.HDTV.x264-GRP.mkv' % i)
+        calls = []
+        gate = threading.Event()
+
+        def search(name, sub_num):
+            calls.append((name, sub_num))
+            gate.wait(5)
+            return [{'[A]Show.S01E01': {'lan': 4, 'link': 'a1'}}]
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(season.search('Show s01', search)))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        gate.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(calls, [('Show s01', 40)])
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(one is results[0] for one in results))
+
+    def test_search_error(self):
+        season = SeasonSearch(5)
+        for i in range(1, 3):
+            season.add('Show.S01E%02d.720p.HDTV.x264-GRP.mkv' % i)
+
+        def search(name, sub_num):
+            raise ValueError('unknown page')
+
+        # 出错时返回 None，各集改为单独搜索
+        self.assertIsNone(season.search('Show s01', search))
+        self.assertIsNone(season.search('Show s01', search))
+
+
+class TestSeasonPacks(unittest.TestCase):
+
+    def test_borrow(self):
+        packs = SeasonPacks()
+        videos = [('Show.S01E%02d.mkv' % i, {'path': '/tv'})
+                  for i in range(1, 5)]
+        videos.append(('Show.S02E01.mkv', {'path': '/tv'}))
+        for name, info in videos:
+            packs.add(name, info)
+
+        self.assertTrue(packs.claim(*videos[1], link='pack'))
+        # 已开始解压的视频与其它季的视频不会被 borrow
+        others = packs.borrow(*videos[0])
+        self.assertEqual(others, [videos[2], videos[3]])
+        self.assertEqual(packs.borrow(*videos[0]), [])
+
+        packs.serve(*videos[2], result=[['E03.ass', '.ass']],
+                    chosen=('[A]pack', 'pack'))
+        packs.release(others)
+        self.assertFalse(packs.claim(*videos[2]))
+        self.assertEqual(packs.get(*videos[2])[1], ('[A]pack', 'pack'))
+        self.assertTrue(packs.claim(*videos[3]))
+        self.assertIsNone(packs.get(*videos[3]))
+
+        # 同一季同一字幕包只预先下载一次
+        self.assertTrue(packs.prefetch(*videos[0], link='pack'))
+        self.assertFalse(packs.prefetch(*videos[3], link='pack'))
+        packs.finish(*videos[1], link='pack')
+        self.assertEqual(packs.extracting, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
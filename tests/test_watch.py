@@ -0,0 +1,109 @@
+# coding: utf-8
+
+import os
+import time
+import tempfile
+import unittest
+import threading
+from io import StringIO
+from unittest import mock
+from contextlib import redirect_stdout
+
+from getsub.main import GetSubtitles
+from getsub.watch import Inotify, VideoWatcher
+
+
+@unittest.skipUnless(Inotify.available(), 'inotify is not available')
+class TestVideoWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        os.makedirs(os.path.join(self.root, 'old'))
+        open(os.path.join(self.root, 'old', 'exists.mkv'), 'w').close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def collect(self, watcher, found, count):
+        for path in watcher:
+            found.append(path)
+            if len(found) == count:
+                watcher.stop()
+
+    def test_new_videos(self):
+        watcher = VideoWatcher(self.root, ['.mkv', '.mp4'])
+        watcher.settle = 0.3
+        watcher.interval = 0.1
+        found = []
+        thread = threading.Thread(
+            target=self.collect, args=(watcher, found, 3))
+        thread.daemon = True
+        thread.start()
+
+        # 分两次写入，写入完成后才产出
+        with open(os.path.join(self.root, 'a.mkv'), 'w') as f:
+            f.write('a')
+        # 下载完成后改名
+        part = os.path.join(self.root, 'old', 'b.mkv.part')
+        with open(part, 'w') as f:
+            f.write('b')
+        os.rename(part, os.path.join(self.root, 'old', 'b.mkv'))
+        # 新建的文件夹及其中的视频
+        new_dir = os.path.join(self.root, 'new', 'Season 01')
+        os.makedirs(new_dir)
+        with open(os.path.join(new_dir, 'c.mp4'), 'w') as f:
+            f.write('c')
+        open(os.path.join(self.root, 'readme.txt'), 'w').close()
+
+        thread.join(10)
+        watcher.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(sorted(found), sorted([
+            os.path.join(self.root, 'a.mkv'),
+            os.path.join(self.root, 'old', 'b.mkv'),
+            os.path.join(new_dir, 'c.mp4')]))
+
+    def test_settle(self):
+        watcher = VideoWatcher(self.root, ['.mkv'])
+        watcher.settle = 0.3
+        path = os.path.join(self.root, 'a.mkv')
+        open(path, 'w').close()
+        for wd, mask, name in watcher.inotify.read(1):
+            watcher._handle(wd, mask, name)
+        self.assertEqual(watcher._ready(), [])
+        time.sleep(0.4)
+        # 等待期间大小改变，重新计时
+        with open(path, 'w') as f:
+            f.write('more')
+        self.assertEqual(watcher._ready(), [])
+        time.sleep(0.4)
+        self.assertEqual(watcher._ready(), [path])
+        watcher.inotify.close()
+
+    def test_watch_path_name(self):
+        getsub = GetSubtitles(self.root, False, False, False, False, False,
+                              False, False, 5, None, None, watch=True)
+        open(os.path.join(self.root, 'old', 'exists.srt'), 'w').close()
+        videos = getsub.watch_path_name(self.root, '')
+        with redirect_stdout(StringIO()) as out, \
+                mock.patch.object(getsub, 'store_index',
+                                  wraps=getsub.store_index) as store_index:
+            name, info = next(videos)
+        self.assertEqual((name, info['have_subtitle']), ('exists.mkv', 1))
+        # 字幕存放目录只扫描一次
+        self.assertEqual(store_index.call_count, 1)
+        self.assertEqual(out.getvalue().count('no valid path'), 1)
+        getsub.watcher.settle = 0.1
+        with open(os.path.join(self.root, 'new.mkv'), 'w') as f:
+            f.write('new')
+        name, info = next(videos)
+        self.assertEqual(
+            (name, info['path'], info['have_subtitle'], info['file']),
+            ('new.mkv', self.root, 0, os.path.join(self.root, 'new.mkv')))
+        getsub.watcher.stop()
+        self.assertEqual(list(videos), [])
+
+
+if __name__ == '__main__':
+    unittest.main()